@@ -0,0 +1,979 @@
+#!/usr/bin/env python3
+#
+# evio.py - python module for fast streaming access to the block
+#           and bank structure of evio raw data files.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# Blocks, events and banks are returned as lightweight header views
+# that hold a reference to the underlying buffer and the offset of
+# the header within it, so the payload is never copied unless the
+# caller asks for it. Files are memory-mapped by default, or can be
+# read one block at a time from any binary file object, eg. a pipe.
+
+import os
+import re
+import mmap
+import array
+import errno
+import struct
+
+# numpy is optional, and only imported by the functions that use it
+# so that it does not add to the startup time of the other tools
+numpy = None
+
+block_magic = 0xc0da0100
+
+contentTypes = ["unknown", "unsigned int", "float", "char*",
+                "short", "unsigned short", "char", "unsigned char",
+                "double", "long int", "long unsigned int", "int",
+                "TAGSEGMENT", "SEGMENT", "BANK", "COMPOSITE",
+                "BANK", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "",
+                "SEGMENT", "Hollerit*", "N-value*"]
+
+BANK = 0
+SEGMENT = 1
+TAGSEGMENT = 2
+
+bank_types = (0xe, 0x10)
+segment_types = (0xd, 0x20)
+tagsegment_types = (0xc,)
+
+block_struct = struct.Struct(">IIIIIIII")
+word_struct = struct.Struct(">I")
+bank_struct = struct.Struct(">II")
+
+# flag set in the version word of the last block in a file
+last_block_flag = 0x200
+
+# input urls name slices of a raw data file as path+block1,block2
+# where the blocks block1 ... block2-1 are counted from 1
+block_suffix = re.compile(r"^(.*)\+([0-9]+),([0-9]+)$")
+
+# block index sidecar layout, all little-endian:
+#   header: magic, version, block count, bytes of the file indexed
+#   record: block offset in bytes, block length in words, event count
+index_suffix = ".blocks"
+index_magic = b"EVIOBLK1"
+index_header = struct.Struct("<8sIIQ")
+index_record = struct.Struct("<QII")
+
+# event index sidecar layout, all little-endian:
+#   header: magic, version, block count, event count, bytes indexed
+#   record: event offset in bytes, event length in words including
+#           the header, index of the containing block counting from 0,
+#           tag and content type of the top-level event bank
+event_index_suffix = ".events"
+event_index_magic = b"EVIOEVT1"
+event_index_header = struct.Struct("<8sIIQQ")
+event_index_record = struct.Struct("<QIIHBx")
+event_index_chunk = 1 << 16
+# bank statistics sidecar, a numpy npz archive with one row for
+# each combination of bank tag, content type and nesting depth,
+# where depth 0 is the top-level event bank
+stats_suffix = ".stats.npz"
+stats_chunk = 1 << 20
+
+event_index_fields = [("offset", "<u8"), ("length", "<u4"),
+                      ("block", "<u4"), ("tag", "<u2"),
+                      ("type", "u1"), ("pad", "u1")]
+
+# kernel-side copy methods tried in order by copy_range, each call
+# moving on to the next one if a method fails with one of
+# copy_fallback_errors for the pair of files it was given, or copies
+# nothing at all
+copy_methods = ["copy_file_range", "sendfile", "buffered"]
+copy_fallback_errors = (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                        errno.EOPNOTSUPP, errno.EBADF, errno.ESPIPE)
+copy_bufsize = 1 << 24
+last_copy_method = None
+
+def have_numpy():
+   """
+   Imports numpy into this module on first use, returns False if
+   it is not installed.
+   """
+   global numpy
+   if numpy is None:
+      try:
+         import numpy
+      except ImportError:
+         return False
+   return True
+
+class EvioError(Exception):
+   """
+   Raised when the block or bank structure of an evio file is
+   found to be corrupted, with the file offset of the problem.
+   """
+   def __init__(self, message, offset):
+      Exception.__init__(self, message)
+      self.offset = offset
+
+class EvioTruncated(EvioError):
+   """
+   Raised when an evio file ends in the middle of a block.
+   """
+   pass
+
+class BlockHeader:
+   """
+   View of the 8-word header of an evio block at offset in buf,
+   found at byte position in the file.
+   """
+   __slots__ = ("buf", "offset", "position", "words", "number",
+                "hlength", "nevents", "reserved1", "version",
+                "reserved2", "magic")
+
+   def __init__(self, buf, offset, position=None):
+      self.buf = buf
+      self.offset = offset
+      self.position = offset if position is None else position
+      (self.words, self.number, self.hlength, self.nevents,
+       self.reserved1, self.version, self.reserved2,
+       self.magic) = block_struct.unpack_from(buf, offset)
+
+   @property
+   def nbytes(self):
+      return self.words * 4
+
+   @property
+   def data(self):
+      """
+      Offset in buf of the first event in the block.
+      """
+      return self.offset + self.hlength * 4
+
+   @property
+   def end(self):
+      return self.offset + self.words * 4
+
+   def is_last(self):
+      """
+      True for the empty block that terminates an evio file.
+      """
+      return self.words <= self.hlength
+
+   def payload(self):
+      """
+      Returns a memoryview of the events in the block, without copying.
+      """
+      return memoryview(self.buf)[self.data:self.end]
+
+   def pack(self, number=None):
+      """
+      Returns the packed block header, renumbered if number is given.
+      """
+      return block_struct.pack(self.words,
+                               self.number if number is None else number,
+                               self.hlength, self.nevents,
+                               self.reserved1, self.version,
+                               self.reserved2, self.magic)
+
+class BankHeader:
+   """
+   View of the header of an evio bank, segment or tagsegment at
+   offset in buf, nested depth levels below the top-level event.
+   The length attribute counts only the payload words.
+   """
+   __slots__ = ("buf", "offset", "kind", "length", "tag", "type",
+                "num", "depth")
+
+   def __init__(self, buf, offset, kind=BANK, depth=0):
+      self.buf = buf
+      self.offset = offset
+      self.kind = kind
+      self.depth = depth
+      if kind == BANK:
+         head = bank_struct.unpack_from(buf, offset)
+         self.length = head[0] - 1
+         self.tag = head[1] >> 16
+         self.type = (head[1] >> 8) & 0x3f
+         self.num = head[1] & 0xff
+      else:
+         head = word_struct.unpack_from(buf, offset)[0]
+         self.length = head & 0xffff
+         self.num = 0
+         if kind == SEGMENT:
+            self.tag = head >> 24
+            self.type = (head >> 16) & 0x3f
+         else:
+            self.tag = head >> 20
+            self.type = (head >> 16) & 0xf
+
+   @property
+   def data(self):
+      """
+      Offset in buf of the first payload word.
+      """
+      return self.offset + (8 if self.kind == BANK else 4)
+
+   @property
+   def end(self):
+      return self.data + self.length * 4
+
+   @property
+   def content_type(self):
+      try:
+         return contentTypes[self.type]
+      except IndexError:
+         return "unknown"
+
+   def children_kind(self):
+      """
+      Returns the kind of the child structures contained in this
+      bank, or None if its payload is not a container.
+      """
+      if self.type in bank_types:
+         return BANK
+      elif self.type in segment_types:
+         return SEGMENT
+      elif self.type in tagsegment_types:
+         return TAGSEGMENT
+      return None
+
+   def payload(self):
+      """
+      Returns a memoryview of the bank contents, without copying.
+      """
+      return memoryview(self.buf)[self.data:self.end]
+
+class EvioFile:
+   """
+   Read-only access to an evio file, memory-mapped if use_mmap is
+   true and the file supports it, otherwise streamed from the open
+   file one block at a time.
+   """
+   def __init__(self, path, use_mmap=True):
+      self.path = path
+      self.file = open(path, "rb")
+      self.size = os.fstat(self.file.fileno()).st_size
+      self.buf = None
+      if use_mmap and self.size > 0:
+         try:
+            self.buf = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+         except (OSError, ValueError):
+            self.buf = None
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   def close(self):
+      if self.buf is not None:
+         self.buf.close()
+         self.buf = None
+      self.file.close()
+
+   def iter_blocks(self, start=0):
+      if self.buf is not None:
+         return iter_blocks(self.buf, start, self.size)
+      elif self.size == 0:
+         return iter([])
+      self.file.seek(start)
+      return iter_blocks(self.file, start)
+
+def iter_blocks(source, start=0, end=None):
+   """
+   Generates a BlockHeader view for each block in source, which can
+   either be a buffer (bytes, mmap) or a binary file object that is
+   read one block at a time. Raises EvioError if a block with a bad
+   magic word is encountered, or EvioTruncated if the data end in the
+   middle of a block.
+   """
+   if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+      return _iter_buffer_blocks(source, start, end)
+   return _iter_stream_blocks(source, start)
+
+def _iter_buffer_blocks(buf, offset, end):
+   if end is None:
+      end = len(buf)
+   while offset < end:
+      if offset + 32 > end:
+         raise EvioTruncated("truncated block header", offset)
+      block = BlockHeader(buf, offset)
+      if block.magic != block_magic or block.hlength < 8:
+         raise EvioError("corrupted block header", offset)
+      elif block.words < block.hlength or block.end > end:
+         raise EvioTruncated("truncated block", offset)
+      yield block
+      offset = block.end
+
+def _iter_stream_blocks(fin, position):
+   while True:
+      head = fin.read(32)
+      if len(head) == 0:
+         return
+      elif len(head) < 32:
+         raise EvioTruncated("truncated block header", position)
+      block = BlockHeader(head, 0, position)
+      if block.magic != block_magic or block.hlength < 8:
+         raise EvioError("corrupted block header", position)
+      elif block.words < block.hlength:
+         raise EvioTruncated("truncated block", position)
+      rest = fin.read(block.nbytes - 32)
+      if len(rest) < block.nbytes - 32:
+         raise EvioTruncated("truncated block", position)
+      block.buf = head + rest
+      yield block
+      position += block.nbytes
+
+def iter_events(block):
+   """
+   Generates a BankHeader view for each top-level event in block.
+   Raises EvioError if an event overflows the end of the block.
+   """
+   buf = block.buf
+   offset = block.data
+   end = block.end
+   while offset < end:
+      if offset + 8 > end:
+         raise EvioError("bank overflow", offset)
+      event = BankHeader(buf, offset)
+      if event.length < 0 or event.end > end:
+         raise EvioError("bank overflow", offset)
+      yield event
+      offset = event.end
+
+def iter_banks(bank, maxdepth=None):
+   """
+   Generates the BankHeader views for bank and all of the banks,
+   segments and tagsegments nested inside it, in depth-first order,
+   descending no further than maxdepth if given. Raises EvioError
+   if a child structure overflows the end of its parent.
+   """
+   buf = bank.buf
+   stack = [(bank, bank.end)]
+   while stack:
+      node, end = stack.pop()
+      yield node
+      kind = node.children_kind()
+      if kind is None or (maxdepth is not None and node.depth >= maxdepth):
+         continue
+      children = []
+      offset = node.data
+      hsize = 8 if kind == BANK else 4
+      while offset < node.end:
+         if offset + hsize > node.end:
+            raise EvioError("bank overflow", offset)
+         child = BankHeader(buf, offset, kind, node.depth + 1)
+         if child.length < 0 or child.end > node.end:
+            raise EvioError("bank overflow", offset)
+         children.append((child, child.end))
+         offset = child.end
+      stack.extend(reversed(children))
+
+def count_blocks(path):
+   """
+   Returns the number of blocks in the evio file at path, walking
+   the chain of block lengths without decoding anything else. A
+   trailing partial block is counted, as it would be by the reader.
+   If the file has a .blocks sidecar, the walk resumes at the end of
+   the last block recorded there.
+   """
+   blocks = load_block_index(path)
+   if blocks:
+      nblocks = len(blocks)
+      offset = blocks[-1][0] + blocks[-1][1] * 4
+   else:
+      nblocks = 0
+      offset = 0
+   with open(path, "rb") as fin:
+      fd = fin.fileno()
+      size = os.fstat(fd).st_size
+      while offset + 4 <= size:
+         words = word_struct.unpack(os.pread(fd, 4, offset))[0]
+         nblocks += 1
+         if words == 0:
+            break
+         offset += words * 4
+   return nblocks
+
+def block_list(path):
+   """
+   Returns the list of (offset, words) for the data blocks in the evio
+   file at path up to its terminating empty block, together with the
+   BlockHeader of that terminating block, or None if the file ends
+   without one. The .blocks sidecar is used if it covers the whole
+   file, otherwise the chain of block headers is walked.
+   """
+   blocks = []
+   index = load_block_index(path)
+   if index is not None and index[-1][0] + index[-1][1] * 4 == \
+                            os.path.getsize(path):
+      with open(path, "rb") as fin:
+         for offset, words, events in index:
+            if events == 0:
+               block = BlockHeader(os.pread(fin.fileno(), 32, offset),
+                                   0, offset)
+               if block.is_last():
+                  return blocks, block
+            blocks.append((offset, words))
+      return blocks, None
+   with EvioFile(path) as fevio:
+      for block in fevio.iter_blocks():
+         if block.is_last():
+            return blocks, BlockHeader(block.pack(), 0, block.position)
+         blocks.append((block.position, block.words))
+   return blocks, None
+
+def index_blocks(path, start=0, tail=False):
+   """
+   Memory-maps the evio file at path and walks the chain of block
+   headers from byte offset start, decoding each block header and the
+   top-level event headers inside it in place, without touching the
+   event payloads. Returns a list of (offset, words, events) tuples,
+   one per complete block, and the byte offset where the walk ended.
+   Raises EvioError if corruption is found before the end of the file,
+   except that with tail true a partial block at the end of the file
+   is taken to be still in the process of being written, and ends
+   the walk without an error.
+   """
+   blocks = []
+   offset = start
+   with EvioFile(path) as fevio:
+      try:
+         for block in fevio.iter_blocks(start):
+            buf = block.buf
+            end = block.end
+            events = 0
+            pos = block.data
+            while pos < end:
+               pos += (word_struct.unpack_from(buf, pos)[0] + 1) * 4
+               events += 1
+            if pos != end:
+               raise EvioError("bank overflow", block.position)
+            blocks.append((block.position, block.words, events))
+            offset = block.position + block.nbytes
+      except EvioTruncated:
+         if not tail:
+            raise
+   return blocks, offset
+
+def update_block_index(path):
+   """
+   Brings the .blocks sidecar of the evio file at path up to date,
+   indexing only the complete blocks that were appended to the file
+   since the sidecar was last written. Returns the number of new
+   blocks, the total number of blocks indexed, and the size in bytes
+   of the partial block at the end of the file, if any, which is not
+   indexed until it is complete.
+   """
+   blocks = load_block_index(path) or []
+   start = blocks[-1][0] + blocks[-1][1] * 4 if blocks else 0
+   new, nbytes = index_blocks(path, start, tail=True)
+   if not blocks:
+      write_block_index(path, new, nbytes)
+   elif new:
+      append_block_index(path, len(blocks), new, nbytes)
+   return len(new), len(blocks) + len(new), os.path.getsize(path) - nbytes
+
+def write_block_index(path, blocks, nbytes):
+   """
+   Saves the block list returned by index_blocks in the binary
+   sidecar file next to path, returns the sidecar path.
+   """
+   sidecar = path + index_suffix
+   with open(sidecar + ".tmp", "wb") as fidx:
+      fidx.write(index_header.pack(index_magic, 1, len(blocks), nbytes))
+      fidx.write(b"".join([index_record.pack(*block) for block in blocks]))
+   os.rename(sidecar + ".tmp", sidecar)
+   return sidecar
+
+def append_block_index(path, nold, blocks, nbytes):
+   """
+   Appends the new block list returned by index_blocks to the sidecar
+   of path, which already holds nold blocks. The old records are copied
+   into a new sidecar that replaces the old one whole, the same as in
+   write_block_index, so that a crash never leaves a torn sidecar.
+   """
+   sidecar = path + index_suffix
+   with open(sidecar, "rb") as fidx:
+      fidx.seek(index_header.size)
+      old = fidx.read(nold * index_record.size)
+   if len(old) != nold * index_record.size:
+      raise EvioError("short block index sidecar", len(old))
+   with open(sidecar + ".tmp", "wb") as fidx:
+      fidx.write(index_header.pack(index_magic, 1, nold + len(blocks), nbytes))
+      fidx.write(old)
+      fidx.write(b"".join([index_record.pack(*block) for block in blocks]))
+   os.replace(sidecar + ".tmp", sidecar)
+
+def load_block_index(path):
+   """
+   Loads the block list from the sidecar file next to path, returns
+   None if there is no sidecar or it does not match the evio file.
+   """
+   try:
+      with open(path + index_suffix, "rb") as fidx:
+         data = fidx.read()
+      head = index_header.unpack_from(data, 0)
+   except (OSError, struct.error):
+      return None
+   if head[0] != index_magic or head[1] != 1 or head[2] == 0:
+      return None
+   elif head[3] > os.path.getsize(path):
+      return None
+   elif len(data) != index_header.size + head[2] * index_record.size:
+      return None
+   blocks = list(index_record.iter_unpack(data[index_header.size:]))
+   try:
+      with open(path, "rb") as fin:
+         last = BlockHeader(os.pread(fin.fileno(), 32, blocks[-1][0]), 0)
+   except (OSError, struct.error):
+      return None
+   if last.magic != block_magic or last.words != blocks[-1][1]:
+      return None
+   return blocks
+
+def index_events(path):
+   """
+   Walks all of the top-level events in the evio file at path and
+   writes the offset, length, block, tag and content type of each one
+   to the event index sidecar next to the file, streaming the records
+   out in chunks so that memory use stays bounded for any file size.
+   Returns the sidecar path, raises EvioError on a corrupted file.
+   """
+   sidecar = path + event_index_suffix
+   chunk = bytearray(event_index_chunk * event_index_record.size)
+   pack_into = event_index_record.pack_into
+   rsize = event_index_record.size
+   nblocks = 0
+   nevents = 0
+   nbytes = 0
+   try:
+      with EvioFile(path) as fevio, open(sidecar + ".tmp", "wb") as fidx:
+         fidx.write(event_index_header.pack(event_index_magic, 1, 0, 0, 0))
+         n = 0
+         for block in fevio.iter_blocks():
+            buf = block.buf
+            end = block.end
+            delta = block.position - block.offset
+            pos = block.data
+            while pos < end:
+               if pos + 8 > end:
+                  raise EvioError("bank overflow", pos + delta)
+               head = bank_struct.unpack_from(buf, pos)
+               words = head[0] + 1
+               if pos + words * 4 > end:
+                  raise EvioError("bank overflow", pos + delta)
+               pack_into(chunk, n * rsize, pos + delta, words, nblocks,
+                         head[1] >> 16, (head[1] >> 8) & 0x3f)
+               pos += words * 4
+               n += 1
+               if n == event_index_chunk:
+                  fidx.write(chunk)
+                  nevents += n
+                  n = 0
+            nblocks += 1
+            nbytes = block.position + block.nbytes
+         fidx.write(memoryview(chunk)[:n * rsize])
+         nevents += n
+         fidx.seek(0)
+         fidx.write(event_index_header.pack(event_index_magic, 1, nblocks,
+                                            nevents, nbytes))
+   except Exception:
+      if os.path.exists(sidecar + ".tmp"):
+         os.remove(sidecar + ".tmp")
+      raise
+   os.rename(sidecar + ".tmp", sidecar)
+   return sidecar
+
+class EventIndex:
+   """
+   Random access to the event index sidecar of the evio file at path,
+   which is memory-mapped rather than loaded. Indexing returns a tuple
+   (offset, length, block, tag, type) for one event, and array() gives
+   the whole table as a numpy structured array if numpy is available.
+   Raises EvioError if the sidecar is damaged, or stale because the
+   evio file was changed after it was written.
+   """
+   def __init__(self, path):
+      self.path = path
+      self.file = open(path + event_index_suffix, "rb")
+      self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      head = event_index_header.unpack_from(self.buf, 0)
+      if head[0] != event_index_magic or head[1] != 1 or len(self.buf) != \
+         event_index_header.size + head[3] * event_index_record.size:
+         self.close()
+         raise EvioError("bad event index for " + path, 0)
+      stat = os.stat(path)
+      if stat.st_size != head[4] or \
+         stat.st_mtime_ns > os.fstat(self.file.fileno()).st_mtime_ns:
+         self.close()
+         raise EvioError("stale event index for " + path, 0)
+      self.nblocks = head[2]
+      self.nevents = head[3]
+      self.nbytes = head[4]
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   def close(self):
+      if self.buf is not None:
+         self.buf.close()
+         self.buf = None
+      self.file.close()
+
+   def __len__(self):
+      return self.nevents
+
+   def __getitem__(self, n):
+      if n < 0:
+         n += self.nevents
+      if n < 0 or n >= self.nevents:
+         raise IndexError("event index out of range")
+      return event_index_record.unpack_from(self.buf,
+             event_index_header.size + n * event_index_record.size)[:5]
+
+   def records(self, start=0, stop=None):
+      """
+      Generates the index records for events start ... stop-1.
+      """
+      stop = self.nevents if stop is None else min(stop, self.nevents)
+      first = event_index_header.size + start * event_index_record.size
+      last = event_index_header.size + stop * event_index_record.size
+      for record in event_index_record.iter_unpack(self.buf[first:last]):
+         yield record[:5]
+
+   def array(self):
+      """
+      Returns the index as a read-only numpy memmap with a structured
+      dtype made from event_index_fields.
+      """
+      if not have_numpy():
+         raise ImportError("numpy is required for EventIndex.array")
+      return numpy.memmap(self.path + event_index_suffix, mode="r",
+                          dtype=numpy.dtype(event_index_fields), shape=(self.nevents,),
+                          offset=event_index_header.size)
+
+   def read_event(self, n):
+      """
+      Returns the bytes of event n read from the evio file.
+      """
+      offset, length = self[n][:2]
+      with open(self.path, "rb") as fin:
+         return os.pread(fin.fileno(), length * 4, offset)
+
+   def tag_counts(self):
+      """
+      Returns a dict with the number of events of each top-level tag.
+      """
+      if have_numpy():
+         tags = self.array()["tag"]
+         counts = numpy.zeros(1 << 16, dtype=numpy.int64)
+         for step in range(0, self.nevents, event_index_chunk):
+            counts += numpy.bincount(tags[step:step + event_index_chunk],
+                                     minlength=1 << 16)
+         found = numpy.flatnonzero(counts)
+         return dict(zip(found.tolist(), counts[found].tolist()))
+      counts = {}
+      for step in range(0, self.nevents, event_index_chunk):
+         for record in self.records(step, step + event_index_chunk):
+            counts[record[3]] = counts.get(record[3], 0) + 1
+      return counts
+
+   def slices(self, nevents):
+      """
+      Returns a list of block ranges (block1, block2), counting blocks
+      from 1 and excluding block2 as in the slices table, that each
+      hold about nevents events, cut at the first block boundary after
+      every nevents events.
+      """
+      ranges = []
+      block1 = 1
+      count = 0
+      last = None
+      for step in range(0, self.nevents, event_index_chunk):
+         for record in self.records(step, step + event_index_chunk):
+            block = record[2] + 1
+            if block != last and count >= nevents:
+               ranges.append((block1, block))
+               block1 = block
+               count = 0
+            count += 1
+            last = block
+      if count > 0:
+         ranges.append((block1, last + 1))
+      return ranges
+
+def _reduce_statistics(keys, counts, words):
+   """
+   Sums counts and words over repeated keys, returns the unique keys
+   and the sums as numpy arrays, sorted by key.
+   """
+   ukeys, inverse = numpy.unique(keys, return_inverse=True)
+   ucounts = numpy.zeros(len(ukeys), dtype=numpy.int64)
+   uwords = numpy.zeros(len(ukeys), dtype=numpy.int64)
+   numpy.add.at(ucounts, inverse, counts)
+   numpy.add.at(uwords, inverse, words)
+   return ukeys, ucounts, uwords
+
+def _fold_statistics(keys, counts, words, stage_keys, stage_words):
+   """
+   Adds the staged bank keys and word counts to the running totals.
+   """
+   return _reduce_statistics(
+      numpy.concatenate([keys, numpy.frombuffer(stage_keys, numpy.uint32)]),
+      numpy.concatenate([counts, numpy.ones(len(stage_keys), numpy.int64)]),
+      numpy.concatenate([words, numpy.frombuffer(stage_words, numpy.int64)]))
+
+def _statistics_table(keys, counts, words, nevents, nbytes):
+   return {"tag": (keys & 0xffff).astype(numpy.uint16),
+           "type": ((keys >> 16) & 0xff).astype(numpy.uint8),
+           "depth": (keys >> 24).astype(numpy.uint8),
+           "count": counts,
+           "words": words,
+           "nevents": numpy.int64(nevents),
+           "nbytes": numpy.int64(nbytes)}
+
+def bank_statistics(path, maxdepth=None):
+   """
+   Scans all of the banks in the evio file at path, down to maxdepth
+   if given, and counts them by tag, content type and depth. The keys
+   are staged in flat arrays and folded into the running totals with
+   numpy every stats_chunk banks. Returns a dict of numpy columns tag,
+   type, depth, count and words, with one row per distinct combination,
+   plus the scalars nevents and nbytes for the whole file.
+   """
+   if not have_numpy():
+      raise ImportError("numpy is required for bank_statistics")
+   keys = numpy.zeros(0, dtype=numpy.uint32)
+   counts = numpy.zeros(0, dtype=numpy.int64)
+   words = numpy.zeros(0, dtype=numpy.int64)
+   stage_keys = array.array("I")
+   stage_words = array.array("q")
+   nevents = 0
+   with EvioFile(path) as fevio:
+      nbytes = fevio.size
+      for block in fevio.iter_blocks():
+         for event in iter_events(block):
+            nevents += 1
+            for bank in iter_banks(event, maxdepth):
+               stage_keys.append((min(bank.depth, 0xff) << 24) |
+                                 (bank.type << 16) | bank.tag)
+               stage_words.append(bank.length)
+         if len(stage_keys) >= stats_chunk:
+            keys, counts, words = _fold_statistics(keys, counts, words,
+                                                   stage_keys, stage_words)
+            stage_keys = array.array("I")
+            stage_words = array.array("q")
+   keys, counts, words = _fold_statistics(keys, counts, words,
+                                          stage_keys, stage_words)
+   return _statistics_table(keys, counts, words, nevents, nbytes)
+
+def write_statistics(path, stats):
+   """
+   Saves the columns returned by bank_statistics in the compressed
+   npz sidecar next to path, returns the sidecar path.
+   """
+   sidecar = path + stats_suffix
+   numpy.savez_compressed(sidecar, **stats)
+   return sidecar
+
+def merge_statistics(paths):
+   """
+   Loads the statistics sidecars of the evio files in paths, or the
+   npz files themselves if the names end in stats_suffix, and sums
+   them into a single table with the same columns, eg. to summarize
+   a whole run period.
+   """
+   if not have_numpy():
+      raise ImportError("numpy is required for merge_statistics")
+   keys = [numpy.zeros(0, dtype=numpy.uint32)]
+   counts = [numpy.zeros(0, dtype=numpy.int64)]
+   words = [numpy.zeros(0, dtype=numpy.int64)]
+   nevents = 0
+   nbytes = 0
+   for path in paths:
+      if not path.endswith(stats_suffix):
+         path += stats_suffix
+      with numpy.load(path) as stats:
+         keys.append((stats["depth"].astype(numpy.uint32) << 24) |
+                     (stats["type"].astype(numpy.uint32) << 16) |
+                     stats["tag"])
+         counts.append(stats["count"])
+         words.append(stats["words"])
+         nevents += int(stats["nevents"])
+         nbytes += int(stats["nbytes"])
+   keys, counts, words = _reduce_statistics(numpy.concatenate(keys),
+                                            numpy.concatenate(counts),
+                                            numpy.concatenate(words))
+   return _statistics_table(keys, counts, words, nevents, nbytes)
+
+def validate_file(path):
+   """
+   Checks the structure of the evio file at path using only the block
+   and bank headers: block magic words and lengths, the event counts
+   in the block headers, the nesting of banks inside their parents,
+   and the presence of the terminating empty block. Returns a tuple
+   (verdict, message, nblocks, nevents, nbytes) where verdict is one
+   of "OK", "CORRUPT", "OVERFLOW", "TRUNCATED" or "UNREADABLE".
+   """
+   nblocks = 0
+   nevents = 0
+   nbytes = 0
+   last = False
+   try:
+      with EvioFile(path) as fevio:
+         nbytes = fevio.size
+         for block in fevio.iter_blocks():
+            if last:
+               return ("CORRUPT", "data after end-of-file block at offset {0}"
+                       .format(block.position), nblocks, nevents, nbytes)
+            count = 0
+            for event in iter_events(block):
+               for bank in iter_banks(event):
+                  pass
+               count += 1
+            if count != block.nevents:
+               return ("CORRUPT", "block {0} claims {1} events but holds {2}"
+                       .format(nblocks + 1, block.nevents, count),
+                       nblocks, nevents, nbytes)
+            nblocks += 1
+            nevents += count
+            last = block.is_last()
+   except EvioTruncated as err:
+      return ("TRUNCATED", "{0} at offset {1}".format(err, err.offset),
+              nblocks, nevents, nbytes)
+   except EvioError as err:
+      verdict = "OVERFLOW" if str(err) == "bank overflow" else "CORRUPT"
+      return (verdict, "{0} in block {1}".format(err, nblocks + 1),
+              nblocks, nevents, nbytes)
+   except OSError as err:
+      return ("UNREADABLE", str(err), nblocks, nevents, nbytes)
+   if not last:
+      return ("TRUNCATED", "no end-of-file block", nblocks, nevents, nbytes)
+   return ("OK", "", nblocks, nevents, nbytes)
+
+def copy_range(fdin, fdout, offset, count, outoffset=None):
+   """
+   Copies count bytes starting at offset in file descriptor fdin to
+   file descriptor fdout, either at its current position or at byte
+   outoffset if given. The data are moved inside the kernel with
+   copy_file_range or sendfile where the files support it, falling
+   back to large buffered copies otherwise, from wherever the method
+   before it stopped. The choice is made anew on every call, since a
+   method that one pair of files does not support, such as
+   copy_file_range to a socket, may work for the next. Returns the
+   name of the method that finished the copy, raises EvioTruncated if
+   fdin ends early.
+   """
+   global last_copy_method
+   methods = [method for method in copy_methods
+              if method != "sendfile" or outoffset is None]
+   done = 0
+   while done < count:
+      try:
+         n = _copy_step(methods[0], fdin, fdout, offset + done, count - done,
+                        None if outoffset is None else outoffset + done)
+      except OSError as err:
+         if len(methods) == 1 or err.errno not in copy_fallback_errors:
+            raise
+         methods.pop(0)
+         continue
+      if n == 0:
+         # some kernels and filesystems answer copy_file_range between
+         # files they cannot copy across with 0 instead of an error, so
+         # the end of fdin is only trusted once the next method agrees
+         if done == 0 and len(methods) > 1:
+            methods.pop(0)
+            continue
+         raise EvioTruncated("truncated block", offset + done)
+      done += n
+   last_copy_method = methods[0]
+   return methods[0]
+
+def _copy_step(method, fdin, fdout, offset, count, outoffset):
+   if method == "copy_file_range":
+      return os.copy_file_range(fdin, fdout, count, offset, outoffset)
+   elif method == "sendfile":
+      return os.sendfile(fdout, fdin, offset, count)
+   data = os.pread(fdin, min(count, copy_bufsize), offset)
+   if outoffset is None:
+      return os.write(fdout, data)
+   return os.pwrite(fdout, data, outoffset)
+
+def parse_block_suffix(name):
+   """
+   Splits a name of the form path+block1,block2 into its parts,
+   returns (name, None, None) if there is no block range suffix.
+   """
+   match = block_suffix.match(name)
+   if match:
+      return match.group(1), int(match.group(2)), int(match.group(3))
+   return name, None, None
+
+def trailer_block(number, version=4):
+   """
+   Returns the packed empty block that terminates an evio file.
+   """
+   return block_struct.pack(8, number, 8, 0, 0,
+                            (version & 0xff) | last_block_flag,
+                            0, block_magic)
+
+class BlockRange:
+   """
+   Reader for the blocks block1 ... block2-1 of the evio file at path,
+   followed by a terminating empty block, which together form a valid
+   evio file. If blocks is given it must be the block list returned by
+   block_list(path), otherwise it is looked up here.
+   """
+   def __init__(self, path, block1, block2, blocks=None):
+      if blocks is None:
+         blocks = block_list(path)[0]
+      if block1 < 1 or block2 <= block1 or block2 > len(blocks) + 1:
+         raise ValueError("block range {0},{1} is outside evio file {2}"
+                          .format(block1, block2, path))
+      self.path = path
+      self.offset = blocks[block1 - 1][0]
+      last = blocks[block2 - 2]
+      self.count = last[0] + last[1] * 4 - self.offset
+      self.file = open(path, "rb")
+      head = BlockHeader(os.pread(self.file.fileno(), 32, last[0]), 0)
+      self.trailer = trailer_block(head.number + 1, head.version)
+      self.size = self.count + len(self.trailer)
+      self.position = 0
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   def close(self):
+      self.file.close()
+
+   def read(self, n=-1):
+      if n < 0 or n > self.size - self.position:
+         n = self.size - self.position
+      chunks = []
+      if n > 0 and self.position < self.count:
+         data = os.pread(self.file.fileno(), min(n, self.count - self.position),
+                         self.offset + self.position)
+         if len(data) == 0:
+            raise EvioTruncated("truncated block", self.offset + self.position)
+         chunks.append(data)
+         self.position += len(data)
+         n -= len(data)
+      if n > 0 and self.position >= self.count:
+         start = self.position - self.count
+         chunks.append(self.trailer[start:start + n])
+         self.position += n
+      return b"".join(chunks)
+
+   def copy_to(self, fdout):
+      """
+      Writes the whole range to file descriptor fdout, moving the
+      block contents inside the kernel where possible.
+      """
+      copy_range(self.file.fileno(), fdout, self.offset, self.count)
+      os.write(fdout, self.trailer)
+      return self.size
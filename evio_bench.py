@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#
+# evio_bench.py - benchmark harness for the evio tools, which runs
+#                 each of them on synthetic evio files of increasing
+#                 size and reports the throughput and peak memory.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# usage: evio_bench.py [-s <MB>,<MB>,...] [-d <workdir>] [-o <results.csv>]
+#  Each measurement runs in its own child process, so that the peak
+#  resident set size reported by the kernel belongs to that tool alone.
+#  That peak includes the page cache pages of the files the tool maps,
+#  which grow with the input whatever the code does, so the peak of the
+#  anonymous memory of the tool and its children is reported as well,
+#  sampled every anon_interval seconds while it runs.
+#  The synthetic input is written just before it is used, so the rates
+#  are for files that are hot in the page cache. With -o the results
+#  are appended to a csv file, to compare before and after a change.
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import evio_synth
+
+topdir = os.path.dirname(os.path.abspath(__file__))
+python = sys.executable
+anon_interval = 0.01
+
+# the block counting loop of load_rawdata_files before it moved to
+# evio.count_blocks, kept as a reference point for the speedup
+legacy_count_blocks = """
+import os, struct, sys
+path = sys.argv[1]
+nbytes = os.path.getsize(path)
+nblocks = 0
+offset = 0
+fevio = open(path, 'rb')
+while offset < nbytes:
+   try:
+      fevio.seek(offset, 0)
+      bhead = fevio.read(4)
+      wsize = struct.unpack(">I", bhead)
+      offset += wsize[0] * 4
+      nblocks += 1
+   except:
+      break
+"""
+
+def extract_eviocat(workdir):
+   """
+   Writes the python script embedded in the eviocat shell wrapper
+   into workdir and returns its path.
+   """
+   text = open(os.path.join(topdir, "eviocat")).read()
+   script = re.search(r"<<EOI >\.eviocat\.py\n(.*?)\nEOI\n", text, re.S)
+   path = os.path.join(workdir, "eviocat.py")
+   with open(path, "w") as fout:
+      fout.write(script.group(1) + "\n")
+   return path
+
+def anon_rss(pid):
+   """
+   Returns the anonymous resident memory in kB of process pid and all
+   of its descendants, which leaves out the pages of mapped files, or
+   0 for processes that are already gone.
+   """
+   kbytes = 0
+   try:
+      with open("/proc/{0}/status".format(pid)) as fstatus:
+         for line in fstatus:
+            if line.startswith("RssAnon:"):
+               kbytes += int(line.split()[1])
+      with open("/proc/{0}/task/{0}/children".format(pid)) as fchildren:
+         children = fchildren.read().split()
+   except OSError:
+      return kbytes
+   for child in children:
+      kbytes += anon_rss(int(child))
+   return kbytes
+
+def measure(args):
+   """
+   Runs args as a child process with its output discarded, returns
+   the exit code, the elapsed seconds, the peak RSS in MB including
+   mapped file pages, and the peak anonymous memory in MB.
+   """
+   env = os.environ.copy()
+   env["PYTHONPATH"] = topdir + os.pathsep + env.get("PYTHONPATH", "")
+   t0 = time.time()
+   proc = subprocess.Popen(args, env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+   anon = 0
+   while True:
+      pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+      if pid:
+         break
+      anon = max(anon, anon_rss(proc.pid))
+      time.sleep(anon_interval)
+   proc.returncode = os.waitstatus_to_exitcode(status)
+   return (proc.returncode, time.time() - t0, usage.ru_maxrss / 1024.,
+           anon / 1024.)
+
+def benchmarks(evio, eviocat, workdir):
+   """
+   Returns the list of (name, args, setup) for the measurements on
+   file evio, where setup removes any sidecars that would otherwise
+   let the tool skip its work.
+   """
+   scanner = os.path.join(topdir, "evio_scanner.py")
+   output = os.path.join(workdir, "output.evio")
+   def clean():
+      for suffix in (".blocks", ".events", ".stats.npz"):
+         if os.path.exists(evio + suffix):
+            os.remove(evio + suffix)
+   return [("evio_scanner print", [python, scanner, evio], clean),
+           ("evio_scanner -i", [python, scanner, "-i", evio], clean),
+           ("evio_scanner -e", [python, scanner, "-e", evio], clean),
+           ("evio_scanner --validate", [python, scanner, "--validate",
+                                        "-j", "1", evio], clean),
+           ("eviocat", [python, eviocat, "-o", output, evio, evio], clean),
+           ("eviocat -b", [python, eviocat, "-b", "-o", output, evio, evio],
+            clean),
+           ("eviocat -j 4", [python, eviocat, "-j", "4", "-o", output,
+                             evio, evio], clean),
+           ("count_blocks", [python, "-c", "import evio, sys; " +
+                             "evio.count_blocks(sys.argv[1])", evio], clean),
+           ("count_blocks legacy", [python, "-c", legacy_count_blocks, evio],
+            clean),
+          ]
+
+def usage():
+   print("Usage: evio_bench.py [options]")
+   print(" where options include any of the following:")
+   print("   -s <MB>,<MB>,... : synthetic file sizes, default 10,100,1000")
+   print("   -d <workdir> : directory for the synthetic files, default /tmp")
+   print("   -o <results.csv> : append the results to this csv file")
+   sys.exit(1)
+
+sizes = [10, 100, 1000]
+workroot = None
+csvfile = None
+argc = 1
+while argc < len(sys.argv):
+   if sys.argv[argc] == "-s" and argc + 1 < len(sys.argv):
+      sizes = [float(size) for size in sys.argv[argc + 1].split(",")]
+   elif sys.argv[argc] == "-d" and argc + 1 < len(sys.argv):
+      workroot = sys.argv[argc + 1]
+   elif sys.argv[argc] == "-o" and argc + 1 < len(sys.argv):
+      csvfile = sys.argv[argc + 1]
+   else:
+      usage()
+   argc += 2
+
+workdir = tempfile.mkdtemp(prefix="evio_bench.", dir=workroot)
+results = []
+try:
+   eviocat = extract_eviocat(workdir)
+   print("{0:26s} {1:>9s} {2:>9s} {3:>10s} {4:>9s} {5:>9s}"
+         .format("benchmark", "size MB", "seconds", "MB/s", "RSS MB",
+                 "anon MB"))
+   for size in sizes:
+      evio = os.path.join(workdir, "synthetic.evio")
+      block_size = 32 + len(evio_synth.make_event(0, 2, 3, 50)) * 40
+      nbytes = evio_synth.write_synthetic(evio, max(1, int(size * 1e6 /
+                                                          block_size)))
+      for name, args, setup in benchmarks(evio, eviocat, workdir):
+         setup()
+         code, seconds, rss, anon = measure(args)
+         rate = nbytes / 1e6 / max(seconds, 1e-6)
+         print("{0:26s} {1:9.1f} {2:9.3f} {3:10.1f} {4:9.1f} {5:9.1f}{6}"
+               .format(name, nbytes / 1e6, seconds, rate, rss, anon,
+                       "" if code == 0 else "  (exit code {0})".format(code)))
+         results.append((name, nbytes, seconds, rate, rss, code, anon))
+finally:
+   shutil.rmtree(workdir)
+
+if csvfile:
+   stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+   with open(csvfile, "a") as fcsv:
+      for result in results:
+         fcsv.write(stamp + ",{0},{1},{2:.4f},{3:.2f},{4:.1f},{5},{6:.1f}\n"
+                    .format(*result))
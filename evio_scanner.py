@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # evio_scanner.py - script to scan an evio raw data file and record
 #                   the offset into the file of the beginning of data
@@ -6,120 +6,206 @@
 #
 # author: richard.t.jones at uconn.edu
 # version: november 12, 2020
+#
+# usage: evio_scanner.py [-i] [-e] <file.evio> [<file2.evio> ...]
+#  where the -i option selects the fast indexing mode, in which the
+#  file is memory-mapped and only the block and event headers are
+#  decoded, and the list of block offsets and event counts is saved
+#  in a binary sidecar file <file.evio>.blocks next to the input.
+#  If the sidecar already exists, only the blocks appended to the
+#  file since it was written are scanned, so a file that is still
+#  being written can be reindexed cheaply as it grows.
+#  The -e option likewise saves the offset, length, tag and content
+#  type of every event in a sidecar file <file.evio>.events that can
+#  be opened with evio.EventIndex for random access to the events.
+#
+# usage: evio_scanner.py --validate [-j <n>] <file.evio> [...]
+#  checks the block and bank structure of all of the files using a
+#  pool of n processes and prints a one-line verdict for each file,
+#  then a summary with the aggregate rate. The exit status is 0 if
+#  all of the files passed, 1 if any of them failed.
+#
+# usage: evio_scanner.py --stats <file.evio> [...]
+#  counts the banks in each file by tag, content type and nesting
+#  depth, and saves the table in a numpy sidecar <file.evio>.stats.npz
+#
+# usage: evio_scanner.py --summarize <file.evio> [...]
+#  sums the statistics sidecars of all of the files and prints the
+#  combined table, eg. for all of the files of a run period.
 
+import os
 import sys
-import struct
 import time
+import multiprocessing
+import evio
 
-pitch = 10
 print_level = 0
 
-contentTypes = ["unknown", "unsigned int", "float", "char*",
-                "short", "unsigned short", "char", "unsigned char",
-                "double", "long int", "long unsigned int", "int",
-                "TAGSEGMENT", "SEGMENT", "BANK", "COMPOSITE",
-                "BANK", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "",
-                "SEGMENT", "Hollerit*", "N-value*"]
+def print_banks(event):
+   """
+   Prints the headers of all banks in event down to print_level.
+   """
+   for bank in evio.iter_banks(event, print_level):
+      if bank.kind == evio.BANK:
+         kind = "bank tag"
+      elif bank.kind == evio.SEGMENT:
+         kind = "bank segment tag"
+      else:
+         kind = "bank tagsegment tag"
+      print(" " * bank.depth, kind, bank.tag, "of", bank.length, "words",
+            "of", bank.content_type)
 
-def scan_segment(fin, level):
-   try:
-      buf = fin.read(4)
-      head = struct.unpack(">BBH", buf)
-   except:
-      print "broken segment at level", level
-      return 1e99
-   length = head[2]
-   btag = head[0]
-   btype = head[1] & 0x3f
-   if level <= print_level:
-      print "".join([" " for i in range(0, level)]),
-      print "bank segment tag", btag, "of", length, "words",
-      print "of", contentTypes[btype]
-   fin.read(4 * length)
-   return length + 1
+def scan_file(path):
+   """
+   Prints the header of every block in the evio file at path,
+   followed by the bank headers of its events down to print_level.
+   """
+   count = 0
+   with evio.EvioFile(path) as fevio:
+      try:
+         for block in fevio.iter_blocks():
+            print("new chunk of", block.words - 8, "words")
+            print("    * block words", block.words)
+            print("    * block number", block.number)
+            print("    * header length", block.hlength)
+            print("    * event count", block.nevents)
+            print("    * Reserved 1", block.reserved1)
+            print("    * version", block.version)
+            print("    * Reserved 2", block.reserved2)
+            print("    * magic", hex(block.magic))
+            for event in evio.iter_events(block):
+               print_banks(event)
+            count += 1
+      except evio.EvioTruncated as err:
+         print("truncated block at count", count, "offset", err.offset)
+      except evio.EvioError as err:
+         if str(err) == "bank overflow":
+            print("bank overflow, giving up")
+         else:
+            print("corrupted block at count", count)
+            if fevio.buf is not None:
+               print(" ".join([hex(c) for c in
+                               fevio.buf[err.offset:err.offset + 32]]))
 
-def scan_tagsegment(fin, level):
-   try:
-      buf = fin.read(4)
-      head = struct.unpack(">BBH", buf)
-   except:
-      print "broken tagsegment at level", level
-      return 1e99
-   length = head[2]
-   btag = head[0]
-   btype = head[1] & 0xf
-   if level <= print_level:
-      print "".join([" " for i in range(0, level)]),
-      print "bank tagsegment tag", btag, "of", length, "words",
-      print "of", contentTypes[btype]
-   fin.read(4 * length)
-   return length + 1
+def validate_files(paths, nprocs):
+   """
+   Validates paths in parallel on nprocs processes, printing a verdict
+   line for each and a summary at the end. Returns the number of files
+   that failed validation.
+   """
+   t0 = time.time()
+   nbad = 0
+   nbytes = 0
+   with multiprocessing.Pool(nprocs) as pool:
+      for path, result in zip(paths, pool.imap(evio.validate_file, paths)):
+         verdict, message, nblocks, nevents, size = result
+         print("{0:10s} {1} {2} blocks {3} events {4:.1f} MB {5}"
+               .format(verdict, path, nblocks, nevents, size / 1e6, message))
+         nbytes += size
+         if verdict != "OK":
+            nbad += 1
+   dt = max(time.time() - t0, 1e-6)
+   print("validated {0} files, {1:.2f} GB in {2:.1f} s, {3:.2f} GB/s,"
+         .format(len(paths), nbytes / 1e9, dt, nbytes / 1e9 / dt),
+         nbad, "failed")
+   return nbad
 
-def scan_bank(fin, level):
-   try:
-      buf = fin.read(8)
-      head = struct.unpack(">IHBB", buf)
-   except:
-      print "broken bank at level", level
-      return 1e99
-   length = head[0] - 1
-   btag = head[1]
-   btype = head[2] & 0x3f
-   if level <= print_level:
-      print "".join([" " for i in range(0, level)]),
-      print "bank tag", btag, "of", length, "words",
-      print "of", contentTypes[btype]
-   words = 0
-   while words < length:
-      if btype == 0xe or btype == 0x10: # BANK
-         words += scan_bank(fin, level + 1)
-      elif btype == 0xd or btype == 0x20: # SEGMENT
-         words += scan_segment(fin, level + 1)
-      elif btype == 0xc: # TAGSEGMENT
-         words += scan_tagsegment(fin, level + 1)
-      elif btype == 0xf: # COMPOSITE
-         words += scan_composite(fin, level + 1)
-      else:
-         fin.read(length * 4)
-         words += length
-   if words != length:
-      print "bank overflow, giving up"
-      return 1e99
-   return length + 2
+def print_statistics(stats):
+   """
+   Prints the table returned by evio.bank_statistics, by depth and
+   then in order of decreasing bank count.
+   """
+   print("{0} events, {1:.2f} GB".format(int(stats["nevents"]),
+                                        stats["nbytes"] / 1e9))
+   print("depth    tag  type             count         words")
+   order = sorted(range(len(stats["count"])),
+                  key=lambda n: (stats["depth"][n], -stats["count"][n]))
+   for n in order:
+      print("{0:5d} {1:6d}  {2:16s} {3:10d} {4:13d}"
+            .format(stats["depth"][n], stats["tag"][n],
+                    evio.contentTypes[stats["type"][n]]
+                    if stats["type"][n] < len(evio.contentTypes)
+                    else "unknown", stats["count"][n], stats["words"][n]))
 
-for evio in sys.argv[1:]:
-   print "scanning", evio
-   fin = open(evio, "rb")
-   offset = 0
-   count = 0
-   while True:
+def usage():
+   print("Usage: evio_scanner.py [options] <input_file> [<input_file2> ... ]")
+   print(" where options include any of the following:")
+   print("   -i : write a block index sidecar instead of printing headers")
+   print("   -e : write an event index sidecar instead of printing headers")
+   print("   --validate : check the structure of the files and print verdicts")
+   print("   -j <n> : number of processes used by --validate")
+   print("   --stats : save the bank tag, type and depth counts in a sidecar")
+   print("   --summarize : print the sum of the statistics sidecars")
+   sys.exit(1)
+
+indexing = False
+event_indexing = False
+validating = False
+statistics = False
+nprocs = os.cpu_count()
+argc = 1
+while argc < len(sys.argv):
+   if sys.argv[argc] == "-i":
+      indexing = True
+   elif sys.argv[argc] == "-e":
+      event_indexing = True
+   elif sys.argv[argc] == "--validate":
+      validating = True
+   elif sys.argv[argc] == "--stats":
+      statistics = True
+   elif sys.argv[argc] == "--summarize":
+      print_statistics(evio.merge_statistics(sys.argv[argc + 1:]))
+      sys.exit(0)
+   elif sys.argv[argc] == "-j" and argc + 1 < len(sys.argv):
+      nprocs = int(sys.argv[argc + 1])
+      argc += 1
+   elif sys.argv[argc][0] == "-":
+      usage()
+   else:
+      break
+   argc += 1
+if argc == len(sys.argv):
+   usage()
+elif validating:
+   sys.exit(1 if validate_files(sys.argv[argc:], nprocs) else 0)
+
+for path in sys.argv[argc:]:
+   if indexing:
+      t0 = time.time()
+      try:
+         nnew, nblocks, partial = evio.update_block_index(path)
+      except evio.EvioError as err:
+         print("error indexing", path, "-", err, "at offset", err.offset)
+         continue
+      print("indexed", nnew, "new blocks of", path, "in",
+            round(time.time() - t0, 3), "s,", nblocks, "blocks in",
+            path + evio.index_suffix)
+      if partial:
+         print("   ", partial, "bytes in a partial block at the end of",
+               path, "are not indexed yet")
+   if event_indexing:
+      t0 = time.time()
+      try:
+         sidecar = evio.index_events(path)
+      except evio.EvioError as err:
+         print("error indexing events of", path, "-", err,
+               "at offset", err.offset)
+         continue
+      with evio.EventIndex(path) as events:
+         print("indexed", len(events), "events in", events.nblocks, "blocks",
+               "of", path, "in", round(time.time() - t0, 3), "s into", sidecar)
+   if statistics:
+      t0 = time.time()
       try:
-         buf = fin.read(32)
-         head = struct.unpack(">IIIIIIII", buf)
-      except:
-         break
-      if head[7] != 0xc0da0100:
-         print "corrupted block at count", count
-         for c in buf:
-            print hex(ord(c)),
-         print
-      length = head[0] - 8
-      print "new chunk of", length, "words"
-      print "    * block words", head[0]
-      print "    * block number", head[1]
-      print "    * header length", head[2]
-      print "    * event count", head[3]
-      print "    * Reserved 1", head[4]
-      print "    * version", head[5]
-      print "    * Reserved 2", head[6]
-      print "    * magic", hex(head[7])
-      words = 0
-      while words < length:
-         words += scan_bank(fin, 0)
-      offset += head[0] * 4
-      #fin.seek(offset)
-      count += 1
-   try:
-      fin.close()
-   except:
-      continue
+         stats = evio.bank_statistics(path)
+      except evio.EvioError as err:
+         print("error counting banks of", path, "-", err,
+               "at offset", err.offset)
+         continue
+      sidecar = evio.write_statistics(path, stats)
+      print("counted", int(stats["count"].sum()), "banks of",
+            len(stats["count"]), "kinds in", path, "in",
+            round(time.time() - t0, 3), "s into", sidecar)
+   if not indexing and not event_indexing and not statistics:
+      print("scanning", path)
+      scan_file(path)
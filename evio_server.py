@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# evio_server.py - local stand-in for the xrootd server plugin that
+#                  serves slices of evio raw data files named with the
+#                  file.evio+block1,block2 suffix convention over http.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# usage: evio_server.py [-p <port>] [-r <root_dir>]
+#  A request for http://<host>:<port>/path/to/file.evio+17,19 returns
+#  blocks 17 and 18 of <root_dir>/path/to/file.evio followed by an
+#  end-of-file block, and a request without a block range suffix
+#  returns the whole file. The block lists of the files are taken from
+#  their .blocks sidecars if present, otherwise the block headers are
+#  scanned on first access, and kept in memory after that. Of a file
+#  that is still being written, the blocks that are already complete
+#  are served, and ranges past them are refused. To send the
+#  osgprod workers to this server, set the xrootdprefix of the project
+#  to http://<host>:<port> with root_dir /dcache.
+
+import os
+import sys
+import threading
+import urllib.parse
+import http.server
+import evio
+
+port = 8080
+docroot = "/dcache"
+
+block_lists = {}
+block_lists_lock = threading.Lock()
+
+def lookup_blocks(path):
+   """
+   Returns the data block list of the evio file at path, cached for
+   as long as the size and modification time of the file are unchanged.
+   A file that ends in a partial block is taken to be still in the
+   process of being written, and the list holds its complete blocks,
+   extended from the cached list as the file grows.
+   """
+   stat = os.stat(path)
+   key = (stat.st_size, stat.st_mtime_ns)
+   with block_lists_lock:
+      cached = block_lists.get(path)
+   if cached and cached[0] == key:
+      return cached[1]
+   try:
+      blocks = evio.block_list(path)[0]
+   except evio.EvioTruncated:
+      blocks = []
+      if cached and cached[0][0] < key[0] and cached[1]:
+         try:
+            last = cached[1][-1]
+            new = evio.index_blocks(path, last[0] + last[1] * 4, tail=True)
+            blocks = cached[1] + [block[:2] for block in new[0]]
+         except evio.EvioError:
+            blocks = []
+      if not blocks:
+         blocks = [block[:2] for block in
+                   evio.index_blocks(path, tail=True)[0]]
+   with block_lists_lock:
+      block_lists[path] = (key, blocks)
+   return blocks
+
+class BlockRangeHandler(http.server.BaseHTTPRequestHandler):
+   """
+   Serves GET and HEAD requests for evio files and block ranges
+   under docroot, sending the data with evio.copy_range.
+   """
+   protocol_version = "HTTP/1.1"
+
+   def do_HEAD(self):
+      self.serve(False)
+
+   def do_GET(self):
+      self.serve(True)
+
+   def serve(self, body):
+      name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+      name, block1, block2 = evio.parse_block_suffix(name)
+      path = os.path.normpath(docroot + "/" + name)
+      if not path.startswith(docroot.rstrip("/") + "/"):
+         self.send_error(403)
+         return
+      try:
+         if block1 is None:
+            source = open(path, "rb")
+            size = os.fstat(source.fileno()).st_size
+         else:
+            source = evio.BlockRange(path, block1, block2, lookup_blocks(path))
+            size = source.size
+      except (FileNotFoundError, IsADirectoryError):
+         self.send_error(404)
+         return
+      except (ValueError, evio.EvioError) as err:
+         self.send_error(416, str(err))
+         return
+      with source:
+         self.send_response(200)
+         self.send_header("Content-Type", "application/octet-stream")
+         self.send_header("Content-Length", str(size))
+         self.end_headers()
+         if body:
+            self.wfile.flush()
+            if block1 is None:
+               evio.copy_range(source.fileno(), self.connection.fileno(),
+                               0, size)
+            else:
+               source.copy_to(self.connection.fileno())
+
+def usage():
+   print("Usage: evio_server.py [options]")
+   print(" where options include any of the following:")
+   print("   -p <port> : listen on this port, default", port)
+   print("   -r <root_dir> : serve files under this directory, default",
+         docroot)
+   sys.exit(1)
+
+argc = 1
+while argc < len(sys.argv):
+   if sys.argv[argc] == "-p" and argc + 1 < len(sys.argv):
+      port = int(sys.argv[argc + 1])
+      argc += 1
+   elif sys.argv[argc] == "-r" and argc + 1 < len(sys.argv):
+      docroot = os.path.abspath(sys.argv[argc + 1])
+      argc += 1
+   else:
+      usage()
+   argc += 1
+
+server = http.server.ThreadingHTTPServer(("", port), BlockRangeHandler)
+print("serving evio files under", docroot, "on port", port)
+try:
+   server.serve_forever()
+except KeyboardInterrupt:
+   server.server_close()
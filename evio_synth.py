@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# evio_synth.py - script to write synthetic evio files with a valid
+#                 block and bank structure, for testing and benchmarking
+#                 the evio tools without real detector data.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# usage: evio_synth.py [options] <output.evio>
+#  Every event is a top-level bank of banks nested depth levels deep
+#  with fanout children at each level, and the leaf banks carry words
+#  words of unsigned int data. The event tags cycle through the list
+#  of trigger tags so that tag statistics come out non-trivial. One
+#  kind of deliberate corruption can be injected into a random block
+#  to exercise the error handling of the tools.
+
+import sys
+import random
+import struct
+
+block_magic = 0xc0da0100
+trigger_tags = [0xff50, 0xff51, 0xff58, 0xff70]
+corruptions = ["magic", "overflow", "count", "truncate", "eof"]
+
+def make_bank(tag, btype, payload, num=0):
+   return struct.pack(">IHBB", len(payload) // 4 + 1, tag, btype, num) + payload
+
+def make_event(tag, depth, fanout, words):
+   """
+   Returns the bytes of one event, a bank of banks nested depth
+   levels deep with fanout children per level and leaf banks of
+   words unsigned ints, plus one bank holding a segment.
+   """
+   def level(d):
+      if d == depth:
+         return make_bank(d, 0x1, struct.pack(">I", d) * words)
+      return make_bank(d, 0x10, b"".join([level(d + 1) for n in range(fanout)]))
+   segment = struct.pack(">BBH", 1, 0x1, 2) + b"\0" * 8
+   body = b"".join([level(1) for n in range(fanout)])
+   body += make_bank(0xe1, 0xd, segment)
+   return make_bank(tag, 0x10, body)
+
+def make_block(number, events, last=False):
+   body = b"".join(events)
+   version = 4 | (0x200 if last else 0)
+   return struct.pack(">IIIIIIII", 8 + len(body) // 4, number, 8, len(events),
+                      0, version, 0, block_magic) + body
+
+def write_synthetic(path, nblocks, events_per_block=40, depth=2, fanout=3,
+                    words=50, corrupt=None, seed=None):
+   """
+   Writes nblocks blocks of events_per_block synthetic events each to
+   path, followed by the end-of-file block, with one corruption of the
+   kinds listed in corruptions injected if corrupt is given. Returns
+   the number of bytes written.
+   """
+   rand = random.Random(seed)
+   events = [make_event(tag, depth, fanout, words) for tag in trigger_tags]
+   blocks = []
+   for n in range(len(trigger_tags)):
+      blocks.append(bytearray(make_block(0, [events[(n + i) % len(events)]
+                                             for i in range(events_per_block)])))
+   bad = rand.randint(1, nblocks) if corrupt else 0
+   nbytes = 0
+   with open(path, "wb") as fout:
+      for number in range(1, nblocks + 1):
+         block = blocks[number % len(blocks)]
+         struct.pack_into(">I", block, 4, number)
+         if number == bad:
+            block = bytearray(block)
+            if corrupt == "magic":
+               struct.pack_into(">I", block, 28, 0xdeadbeef)
+            elif corrupt == "overflow":
+               struct.pack_into(">I", block, 40, 0x7fffff)
+            elif corrupt == "count":
+               struct.pack_into(">I", block, 12, events_per_block + 1)
+            elif corrupt == "truncate":
+               block = block[:len(block) // 2]
+         fout.write(block)
+         nbytes += len(block)
+         if number == bad and corrupt == "truncate":
+            return nbytes
+      if corrupt != "eof":
+         fout.write(make_block(nblocks + 1, [], True))
+         nbytes += 32
+   return nbytes
+
+def usage():
+   print("Usage: evio_synth.py [options] <output.evio>")
+   print(" where options include any of the following:")
+   print("   -b <nblocks> : number of blocks to write, default 100")
+   print("   -s <megabytes> : write blocks up to about this file size instead")
+   print("   -e <nevents> : events per block, default 40")
+   print("   -d <depth> : bank nesting depth of each event, default 2")
+   print("   -f <fanout> : banks at each level of nesting, default 3")
+   print("   -w <words> : data words in each leaf bank, default 50")
+   print("   -c <kind> : inject one corruption, one of", ", ".join(corruptions))
+   print("   -r <seed> : random seed for the placement of the corruption")
+   sys.exit(1)
+
+if __name__ == "__main__":
+   nblocks = 100
+   megabytes = None
+   options = {}
+   argc = 1
+   while argc < len(sys.argv) - 1:
+      opt = sys.argv[argc]
+      val = sys.argv[argc + 1]
+      if opt == "-b":
+         nblocks = int(val)
+      elif opt == "-s":
+         megabytes = float(val)
+      elif opt == "-e":
+         options["events_per_block"] = int(val)
+      elif opt == "-d":
+         options["depth"] = int(val)
+      elif opt == "-f":
+         options["fanout"] = int(val)
+      elif opt == "-w":
+         options["words"] = int(val)
+      elif opt == "-c" and val in corruptions:
+         options["corrupt"] = val
+      elif opt == "-r":
+         options["seed"] = int(val)
+      else:
+         usage()
+      argc += 2
+   if argc != len(sys.argv) - 1 or sys.argv[argc][0] == "-":
+      usage()
+   if megabytes is not None:
+      event = make_event(0, options.get("depth", 2), options.get("fanout", 3),
+                         options.get("words", 50))
+      block_size = 32 + len(event) * options.get("events_per_block", 40)
+      nblocks = max(1, int(megabytes * 1e6 / block_size))
+   nbytes = write_synthetic(sys.argv[argc], nblocks, **options)
+   print("wrote", nblocks, "blocks,", nbytes, "bytes to", sys.argv[argc])
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+#
+# osgprod_asgi.py - asyncio work dispatcher for the osgprod Gluex grid
+#                   raw data production environment, which speaks the
+#                   same protocol as osgprod_wsgi.py under an ASGI server.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# usage: uvicorn --app-dir /var/www/wsgi-scripts osgprod_asgi:application \
+#                [--host <addr>] [--port <port>]
+#  A single process keeps thousands of pilot requests in flight while
+#  they wait on the database. Every request of the protocol is one SQL
+#  statement, so the statements from concurrent requests are queued and
+#  sent down a few autocommit connections in pipeline mode, many per
+#  round trip, each in its own transaction. The configuration and the request handling are taken
+#  from osgprod_wsgi.py, which must be installed in the same directory
+#  together with osgprod_pool.py. This script needs psycopg version 3.
+
+import os
+import sys
+import time
+import asyncio
+import psycopg
+
+# the shared osgprod modules live next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import osgprod_wsgi
+import osgprod_metrics
+
+# requests may come with the url prefix under which the workers know
+# the dispatcher, as when it is reached through an Apache proxy
+path_prefix = "/osgprod"
+pipeline_connections = 8
+pipeline_batch = 64
+
+pipeline = None
+reaper = None
+project_table = (None, 0)
+project_loader = None
+backlog = (None, 0)
+
+class QueryPipeline:
+   """
+   Runs single-statement queries over nconn autocommit connections in
+   pipeline mode. Queries that arrive while a connection is busy are
+   queued, and each connection sends up to batch of them at a time in
+   one round trip, with a sync point after every statement so that each
+   one runs in its own implicit transaction and commits or fails by
+   itself, and a failing request never rolls back the work of the
+   others. The statements that failed are run again by themselves to
+   give each request its own error. Requests in a batch that was cut
+   off by a lost connection fail, and the connection is opened again
+   for the next.
+   """
+   def __init__(self, conninfo, nconn, batch):
+      self.conninfo = conninfo
+      self.nconn = nconn
+      self.batch = batch
+      self.queue = asyncio.Queue()
+      self.workers = []
+      self.stats = {"queries": 0,
+                    "batches": 0,
+                    "errors": 0,
+                    "connects": 0,
+                    "failures": 0}
+
+   def start(self):
+      self.workers = [asyncio.ensure_future(self.worker())
+                      for n in range(self.nconn)]
+
+   async def stop(self):
+      for worker in self.workers:
+         worker.cancel()
+      await asyncio.gather(*self.workers, return_exceptions=True)
+
+   async def execute(self, query, args=None):
+      """
+      Runs query with args and returns the rows that it returned.
+      """
+      future = asyncio.get_running_loop().create_future()
+      self.queue.put_nowait((query, args, future))
+      return await future
+
+   async def worker(self):
+      conn = None
+      try:
+         while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch and not self.queue.empty():
+               batch.append(self.queue.get_nowait())
+            try:
+               if conn is None or conn.closed:
+                  conn = await psycopg.AsyncConnection.connect(self.conninfo,
+                                                               autocommit=True)
+                  self.stats["connects"] += 1
+               await self.run_batch(conn, batch)
+            except Exception as err:
+               self.stats["failures"] += 1
+               for query, args, future in batch:
+                  if not future.done():
+                     future.set_exception(err)
+      finally:
+         if conn is not None:
+            await conn.close()
+
+   async def run_batch(self, conn, batch):
+      self.stats["batches"] += 1
+      self.stats["queries"] += len(batch)
+      cursors = []
+      async with conn.pipeline() as p:
+         for query, args, future in batch:
+            cursor = conn.cursor()
+            cursors.append(cursor)
+            try:
+               await cursor.execute(query, args)
+            except psycopg.OperationalError:
+               raise
+            except psycopg.Error:
+               pass
+            # psycopg has no public call that queues a sync point
+            # without waiting for the results before it
+            p._enqueue_sync()
+         try:
+            await p.sync()
+         except psycopg.OperationalError:
+            raise
+         except psycopg.Error:
+            pass
+      # errors come back from the pipeline without saying whose they
+      # are, but only the statements that succeeded have results
+      for cursor, (query, args, future) in zip(cursors, batch):
+         try:
+            if cursor.pgresult is None:
+               self.stats["errors"] += 1
+               cursor = await conn.execute(query, args)
+            rows = await cursor.fetchall()
+         except psycopg.OperationalError:
+            raise
+         except psycopg.Error as err:
+            if conn.closed:
+               raise
+            if not future.done():
+               future.set_exception(err)
+            continue
+         if not future.done():
+            future.set_result(rows)
+
+def conninfo():
+   return psycopg.conninfo.make_conninfo(user=osgprod_wsgi.dbuser,
+                                         password=osgprod_wsgi.dbpass,
+                                         host=osgprod_wsgi.dbserver,
+                                         port="5432",
+                                         dbname=osgprod_wsgi.dbname,
+                                         client_encoding="utf8")
+
+async def run_query(name, query, args=None):
+   """
+   Runs query with args through the pipeline and returns the rows,
+   recording the time it took in the metrics of the query name.
+   """
+   t0 = time.perf_counter()
+   try:
+      rows = await pipeline.execute(query, args)
+   except Exception:
+      osgprod_metrics.observe_query(name, time.perf_counter() - t0, True)
+      raise
+   osgprod_metrics.observe_query(name, time.perf_counter() - t0)
+   return rows
+
+async def load_project_table():
+   global project_table
+   rows = await run_query("projects", osgprod_wsgi.projects_query)
+   project_table = (osgprod_wsgi.build_project_table(rows), time.time())
+
+async def reload_project_table(wait):
+   """
+   Starts reloading the projects table unless a reload is already
+   under way, and waits for it to finish if wait is True.
+   """
+   global project_loader
+   if project_loader is None or project_loader.done():
+      project_loader = asyncio.ensure_future(load_project_table())
+      project_loader.add_done_callback(lambda task: task.cancelled() or
+                                                    task.exception())
+   if wait:
+      await project_loader
+
+async def lookup_project(project, client):
+   """
+   Returns the projects row for project whose workersubnet contains
+   the client address, with the same caching as osgprod_wsgi.
+   """
+   table, loaded = project_table
+   if table is None or time.time() - loaded > osgprod_wsgi.project_cache_ttl:
+      await reload_project_table(table is None)
+      table, loaded = project_table
+   row = None
+   if project in table:
+      row = osgprod_wsgi.match_project(table[project], client)
+   if row is None and time.time() - loaded > osgprod_wsgi.project_cache_retry:
+      await reload_project_table(True)
+      table, loaded = project_table
+      if project in table:
+         row = osgprod_wsgi.match_project(table[project], client)
+   if row is None:
+      raise LookupError("no project " + project + " for " + client)
+   return row
+
+async def checkout_workscript(pars, client, bundle=False):
+   count = osgprod_wsgi.batch_count(pars) if bundle else 1
+   row = await lookup_project(pars["project"], client)
+   claims = await run_query("checkout", osgprod_wsgi.checkout_query,
+                            osgprod_wsgi.checkout_arguments(pars, client,
+                                                            row, count))
+   osgprod_wsgi.count_claims(claims)
+   # the template file is checked and maybe read again off the event loop
+   plan = None
+   if any([claim[1] == "ok" for claim in claims]):
+      plan = await asyncio.to_thread(osgprod_wsgi.lookup_template,
+                                     osgprod_wsgi.template_path(pars, row))
+   return osgprod_wsgi.checkout_reply(pars, row, claims, bundle, plan)
+
+async def checkout_batch(pars, client):
+   return await checkout_workscript(pars, client, True)
+
+async def return_workscript(pars, client):
+   args = osgprod_wsgi.exit_arguments(pars, client)
+   rows = await run_query("exit", osgprod_wsgi.exit_query, args)
+   osgprod_wsgi.count_exits(args, rows)
+   return osgprod_wsgi.exit_reply(rows)
+
+async def renew_lease(pars, client):
+   rows = await run_query("heartbeat", osgprod_wsgi.heartbeat_query,
+                          osgprod_wsgi.heartbeat_arguments(pars, client))
+   return osgprod_wsgi.heartbeat_reply(rows)
+
+async def count_backlog():
+   global backlog
+   counts = (await run_query("backlog", osgprod_wsgi.backlog_query))[0]
+   backlog = (counts, time.time())
+
+async def report_metrics(pars, client):
+   """
+   Returns the metrics of this process in the Prometheus text format,
+   with the state of the query pipeline and the slice backlog.
+   """
+   gauges = [("osgprod_pipeline_queue_depth", "gauge",
+              "Queries waiting for a pipeline connection.",
+              [((), pipeline.queue.qsize())])]
+   for key in sorted(pipeline.stats):
+      gauges.append(("osgprod_pipeline_" + key + "_total", "counter",
+                     "Pipeline " + key + " since the process started.",
+                     [((), pipeline.stats[key])]))
+   if backlog[0] is not None:
+      gauges += osgprod_wsgi.backlog_gauges(*backlog)
+   return osgprod_metrics.render(gauges)
+
+handlers = {"/workscript.bash": checkout_workscript,
+            "/workscript.batch": checkout_batch,
+            "/workscript.heartbeat": renew_lease,
+            "/workscript.exit": return_workscript}
+
+async def reaper_loop():
+   reaped = time.time()
+   while True:
+      try:
+         await count_backlog()
+      except Exception:
+         pass
+      await asyncio.sleep(min(osgprod_wsgi.backlog_interval,
+                              osgprod_wsgi.reap_interval))
+      if time.time() - reaped < osgprod_wsgi.reap_interval:
+         continue
+      reaped = time.time()
+      try:
+         await run_query("reap", osgprod_wsgi.reap_query,
+                         (osgprod_wsgi.reap_lock_key,
+                          osgprod_wsgi.max_starts))
+      except Exception:
+         pass
+      try:
+         await run_query("fold", osgprod_wsgi.fold_query,
+                         (osgprod_wsgi.fold_lock_key,))
+      except Exception:
+         pass
+
+def startup():
+   global pipeline, reaper
+   if pipeline is None:
+      pipeline = QueryPipeline(conninfo(), pipeline_connections,
+                               pipeline_batch)
+      pipeline.start()
+      reaper = asyncio.ensure_future(reaper_loop())
+
+async def shutdown():
+   global pipeline, reaper
+   if pipeline is not None:
+      reaper.cancel()
+      await pipeline.stop()
+      pipeline = None
+      reaper = None
+
+async def lifespan(receive, send):
+   while True:
+      message = await receive()
+      if message["type"] == "lifespan.startup":
+         startup()
+         await send({"type": "lifespan.startup.complete"})
+      elif message["type"] == "lifespan.shutdown":
+         await shutdown()
+         await send({"type": "lifespan.shutdown.complete"})
+         return
+
+async def application(scope, receive, send):
+   """
+   ASGI entry point, which answers the same requests as the
+   application in osgprod_wsgi with the same replies.
+   """
+   if scope["type"] == "lifespan":
+      await lifespan(receive, send)
+      return
+   elif scope["type"] != "http":
+      return
+   startup()
+   t0 = time.perf_counter()
+   pars = osgprod_wsgi.query_parameters(scope["query_string"].decode("latin-1"))
+   client = scope["client"][0] if scope.get("client") else ""
+   path = scope["path"]
+   for prefix in (scope.get("root_path"), path_prefix):
+      if prefix and path.startswith(prefix):
+         path = path[len(prefix):]
+   status = 200
+   content_type = b"text/plain"
+   if path == "/metrics":
+      output = await report_metrics(pars, client)
+      content_type = b"text/plain; version=0.0.4"
+   elif not "magic" in pars or pars["magic"] != osgprod_wsgi.magic_words:
+      output = "Be gone with your crazy magic!"
+   elif path in handlers:
+      try:
+         output = await handlers[path](pars, client)
+      except Exception:
+         status = 400
+         output = ""
+   elif path and path != "/":
+      output = "Be gone with your unknown path "
+   else:
+      output = "Be gone with you."
+      for var in scope:
+         output += var + ": " + str(scope[var]) + "\n"
+
+   body = output.encode("utf-8")
+   headers = [(b"content-type", content_type)]
+   cacheable = path not in handlers
+   if status == 200:
+      request_headers = dict(scope.get("headers", []))
+      accept = request_headers.get(b"accept-encoding", b"").decode("latin-1")
+      match = request_headers.get(b"if-none-match", b"").decode("latin-1")
+      not_modified, encoding, body = osgprod_wsgi.encode_reply(body, accept,
+                                                               match,
+                                                               cacheable)
+      if not_modified:
+         status = 304
+      headers += [(key.lower().encode(), value.encode())
+                  for key, value in encoding]
+   elif not cacheable:
+      headers.append((b"cache-control", b"no-store"))
+   headers.append((b"content-length", str(len(body)).encode()))
+   await send({"type": "http.response.start",
+               "status": status,
+               "headers": headers})
+   await send({"type": "http.response.body", "body": body})
+   if path not in handlers and path != "/metrics":
+      path = "other"
+   osgprod_metrics.observe_request(path, status, time.perf_counter() - t0)
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+#
+# osgprod_bench.py - benchmark of the slice checkout of the osgprod
+#                    work dispatcher against a scratch postgres database.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# usage: osgprod_bench.py [options]
+#  The tables of the scratch database (osgprod_bench by default, which
+#  must already exist on the server) are dropped and reseeded with
+#  synthetic rawdata rows before each measurement, so never point this
+#  script at the production database. Each method checks out slices
+#  for distinct cluster.process job ids from a number of threads at
+#  once, the way the threads of a mod_wsgi daemon would, and the rate
+#  and latency percentiles of the checkouts are reported, together
+#  with a check that no two claimed slices overlap. With -m http the
+#  checkouts go instead over http to the dispatcher itself, started in
+#  a child process once under a threaded wsgi server, as the wsgi path
+#  through Apache would see them, and once under uvicorn as the asgi
+#  dispatcher, with -c requests in flight at any time.
+
+import os
+import sys
+import time
+import shutil
+import socket
+import asyncio
+import tempfile
+import threading
+import subprocess
+import osgprod_db
+import osgprod_wsgi
+
+dbserver = "localhost"
+dbname = "osgprod_bench"
+nthreads = 16
+ncheckouts = 2000
+nfiles = 500
+nblocks = 1000
+cpus = 4
+maxblockspercore = 2
+workscript = "osgprod_work.bash"
+concurrency = 256
+mode = "db"
+
+topdir = os.path.dirname(os.path.abspath(__file__))
+python = sys.executable
+
+# the dispatchers under test in http mode, each run as a child process
+# pointed at the scratch database and at a document root that holds a
+# copy of the worker script for the bench project
+server_setup = """
+import sys
+import osgprod_wsgi
+port = int(sys.argv[1])
+osgprod_wsgi.dbserver, osgprod_wsgi.dbname = sys.argv[2:4]
+osgprod_wsgi.documentroot = sys.argv[4]
+"""
+wsgi_server = server_setup + """
+import socketserver
+from wsgiref import simple_server
+class Handler(simple_server.WSGIRequestHandler):
+   def log_message(self, *args):
+      pass
+class Server(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+   daemon_threads = True
+   request_queue_size = 1024
+simple_server.make_server("127.0.0.1", port, osgprod_wsgi.application,
+                          Server, Handler).serve_forever()
+"""
+asgi_server = server_setup + """
+import uvicorn
+import osgprod_asgi
+uvicorn.run(osgprod_asgi.application, host="127.0.0.1", port=port,
+            backlog=1024, log_level="warning")
+"""
+
+def legacy_claim_slice(iproject, client, cluster, process):
+   """
+   The sequence of statements that checkout_workscript used to issue
+   before the osgprod_checkout function, kept here as the reference
+   point for the speedup.
+   """
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as curr:
+         curr.execute("""SELECT id, projectname, workersubnet,
+                                workscript, xrootdprefix,
+                                maxblockspercore
+                         FROM projects
+                         WHERE id = %s;
+                      """, (iproject,))
+         curr.fetchone()
+         curr.execute("""SELECT jobs.id, jobs.cluster, jobs.process,
+                                jobs.nstarts, projects.projectname
+                         FROM jobs LEFT JOIN projects
+                         ON projects.id = jobs.project
+                         WHERE jobs.cluster = %s
+                         AND jobs.process = %s
+                         AND projects.projectname = %s
+                         AND jobs.endtime IS NOT NULL
+                         AND jobs.exitcode IS NOT NULL
+                         FOR UPDATE OF jobs;
+                      """, (cluster, process, "bench"))
+         if curr.fetchone():
+            return "completed"
+         curr.execute("""SELECT jobs.id, jobs.cluster, jobs.process,
+                                jobs.nstarts, projects.projectname
+                         FROM jobs LEFT JOIN projects
+                         ON projects.id = jobs.project
+                         WHERE jobs.cluster = %s
+                         AND jobs.process = %s
+                         AND projects.projectname = %s
+                         AND jobs.endtime IS NULL
+                         AND jobs.exitcode IS NULL
+                         FOR UPDATE OF jobs;
+                      """, (cluster, process, "bench"))
+         row = curr.fetchone()
+         if row:
+            ijob = int(row[0])
+            nstarts = int(row[3])
+         else:
+            curr.execute("""INSERT INTO jobs
+                            (project, cluster, process)
+                            VALUES (%s, %s, %s)
+                            RETURNING id;
+                         """, (iproject, cluster, process))
+            ijob = int(curr.fetchone()[0])
+            nstarts = 0
+         curr.execute("SELECT TIMEZONE('GMT', NOW());")
+         now = curr.fetchone()[0]
+         curr.execute("""UPDATE jobs SET script = %s,
+                                         worker = %s,
+                                         ncpus = %s,
+                                         nstarts = %s,
+                                         starttime = %s
+                         WHERE id = %s;
+                      """, (workscript, client, cpus, nstarts + 1, now, ijob))
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as curr:
+         curr.execute("""SELECT id, ijob, iraw, block1, block2
+                         FROM slices
+                         WHERE ijob = %s;
+                      """, (ijob,))
+         row = curr.fetchone()
+         if not row:
+            curr.execute("""SELECT id, ijob, iraw, block1, block2
+                            FROM slices
+                            WHERE ijob ISNULL
+                            ORDER BY id
+                            LIMIT 1
+                            FOR UPDATE SKIP LOCKED;
+                         """)
+            row = curr.fetchone()
+            if not row:
+               return "nowork"
+            lastblock = int(row[3]) + maxblockspercore * cpus
+            lastblock = row[4] if lastblock + 1 >= row[4] else lastblock
+            curr.execute("""UPDATE slices SET
+                            ijob = %s, block2 = %s
+                            WHERE id = %s;
+                         """, (ijob, lastblock, row[0]))
+            if lastblock < row[4]:
+               curr.execute("""INSERT INTO slices
+                               (iraw, block1, block2)
+                               VALUES (%s, %s, %s);
+                            """, (row[2], lastblock, row[4]))
+         curr.execute("""SELECT path
+                         FROM rawdata
+                         WHERE id = %s;
+                      """, (row[2],))
+         curr.fetchone()
+   return "ok"
+
+def function_claim_slice(iproject, client, cluster, process):
+   """
+   The checkout as done by the dispatcher now, a project lookup in
+   the in-process cache and one call to osgprod_checkout.
+   """
+   row = osgprod_wsgi.lookup_project("bench", client)
+   pars = {"cluster": cluster, "process": process, "cpus": cpus}
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as curr:
+         curr.execute(osgprod_wsgi.checkout_query,
+                      osgprod_wsgi.checkout_arguments(pars, client, row, 1))
+         return curr.fetchone()[1]
+
+methods = [("legacy", legacy_claim_slice),
+           ("osgprod_checkout", function_claim_slice)]
+
+servers = [("wsgi threaded", wsgi_server),
+           ("asgi pipelined", asgi_server)]
+
+def create_schema():
+   """
+   Drops and recreates the tables and functions of the scratch
+   database, without the indexes added by osgprod_db.migrate, and adds
+   the bench project to it. Returns the project id.
+   """
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("DROP TABLE IF EXISTS bindings, slices, jobs, " +
+                        "rawdata, projects, blockrates, " +
+                        "blockrates_folded, schema_version CASCADE;")
+   osgprod_db.create_table_projects()
+   osgprod_db.create_table_rawdata()
+   osgprod_db.create_table_jobs()
+   osgprod_db.create_table_slices()
+   osgprod_db.create_table_bindings()
+   osgprod_db.create_table_blockrates()
+   osgprod_db.create_function_blockrates()
+   osgprod_db.create_function_checkout()
+   osgprod_db.create_function_reap()
+   osgprod_db.add_project("bench", "%", workscript, "root://localhost",
+                          maxblockspercore)
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("SELECT id FROM projects WHERE projectname = 'bench';")
+         return cursor.fetchone()[0]
+
+def insert_rawdata():
+   """
+   Fills the rawdata table with nfiles files of nblocks blocks each,
+   100 files to a run.
+   """
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("""INSERT INTO rawdata
+                           (run, seqno, path, nbytes, nblocks)
+                           SELECT 70000 + n / 100, n %% 100,
+                                  '/dcache/bench/hd_rawdata_' ||
+                                  (70000 + n / 100) || '_' ||
+                                  lpad((n %% 100)::TEXT, 3, '0') || '.evio',
+                                  %s::BIGINT * 20000000, %s
+                           FROM generate_series(0, %s) AS n;
+                        """, (nblocks, nblocks, nfiles - 1))
+
+def seed():
+   """
+   Drops and recreates the tables of the scratch database, and fills
+   them with one project and nfiles rawdata files of nblocks blocks,
+   each of them one unassigned slice. Returns the project id.
+   """
+   iproject = create_schema()
+   insert_rawdata()
+   osgprod_db.load_slices()
+   osgprod_db.migrate()
+   return iproject
+
+def overlaps():
+   """
+   Returns the number of pairs of slices that share any blocks.
+   """
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("""SELECT COUNT(*)
+                           FROM slices a JOIN slices b
+                           ON a.iraw = b.iraw
+                           AND a.id < b.id
+                           AND a.block1 < b.block2
+                           AND b.block1 < a.block2;
+                        """)
+         return cursor.fetchone()[0]
+
+def run(claim, iproject):
+   """
+   Runs ncheckouts checkouts with claim spread over nthreads threads,
+   returns the elapsed seconds, the sorted list of checkout latencies,
+   and the number of checkouts that did not return ok.
+   """
+   latencies = []
+   failures = [0]
+   lock = threading.Lock()
+   def worker(thread):
+      mine = []
+      nfail = 0
+      for process in range(thread, ncheckouts, nthreads):
+         client = "10.0.{0}.{1}".format(thread, process % 250 + 1)
+         t0 = time.perf_counter()
+         try:
+            if claim(iproject, client, 1000, process) != "ok":
+               nfail += 1
+         except Exception as err:
+            sys.stderr.write("checkout error: " + str(err) + "\n")
+            nfail += 1
+         mine.append(time.perf_counter() - t0)
+      with lock:
+         latencies.extend(mine)
+         failures[0] += nfail
+   threads = [threading.Thread(target=worker, args=(n,))
+              for n in range(nthreads)]
+   t0 = time.time()
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+   return time.time() - t0, sorted(latencies), failures[0]
+
+def start_server(script, docroot):
+   """
+   Starts the dispatcher in script as a child process listening on
+   a free local port, and returns the process and the port once the
+   server accepts connections.
+   """
+   with socket.socket() as sock:
+      sock.bind(("127.0.0.1", 0))
+      port = sock.getsockname()[1]
+   env = os.environ.copy()
+   env["PYTHONPATH"] = topdir + os.pathsep + env.get("PYTHONPATH", "")
+   proc = subprocess.Popen([python, "-c", script, str(port), dbserver,
+                            dbname, docroot], env=env)
+   for n in range(300):
+      try:
+         socket.create_connection(("127.0.0.1", port)).close()
+         return proc, port
+      except OSError:
+         if proc.poll() is not None:
+            break
+         time.sleep(0.1)
+   proc.kill()
+   raise RuntimeError("dispatcher failed to start on port " + str(port))
+
+def make_docroot():
+   """
+   Returns a new temporary document root holding the worker script
+   of the bench project, for the dispatchers started by start_server.
+   """
+   docroot = tempfile.mkdtemp(prefix="osgprod_bench.")
+   os.mkdir(os.path.join(docroot, "bench"))
+   shutil.copy(os.path.join(topdir, "osgprod_work.bash"),
+               os.path.join(docroot, "bench", workscript))
+   return docroot
+
+async def http_get(port, path, source_addr=None, **pars):
+   """
+   Sends a request for path with query parameters pars and the magic
+   words to the dispatcher on port, from local address source_addr if
+   given, and returns the http status code and the text of the reply.
+   """
+   query = "&".join(["magic=" + osgprod_wsgi.magic_words] +
+                    [key + "=" + str(pars[key]) for key in pars])
+   local_addr = (source_addr, 0) if source_addr else None
+   reader, writer = await asyncio.open_connection("127.0.0.1", port,
+                                                  local_addr=local_addr)
+   try:
+      writer.write(("GET " + path + "?" + query + " HTTP/1.0\r\n" +
+                    "Host: localhost\r\n\r\n").encode())
+      reply = await reader.read()
+   finally:
+      writer.close()
+   head, sep, body = reply.partition(b"\r\n\r\n")
+   return int(head.split(b" ")[1]), body.decode("utf-8", "replace")
+
+async def http_checkout(port, cluster, process):
+   """
+   Requests a workscript for job cluster.process from the dispatcher
+   on port, and returns True if one came back.
+   """
+   status, reply = await http_get(port, "/workscript.bash", project="bench",
+                                  cluster=cluster, process=process, cpus=cpus)
+   return status == 200 and reply.startswith("#!/bin/bash")
+
+def run_http(port):
+   """
+   Runs ncheckouts checkouts over http against the dispatcher on port
+   with up to concurrency of them in flight, returns the elapsed
+   seconds, the sorted list of checkout latencies, and the number of
+   checkouts that did not return a workscript.
+   """
+   latencies = []
+   async def checkout(slots, process):
+      async with slots:
+         t0 = time.perf_counter()
+         try:
+            ok = await http_checkout(port, 1000, process)
+         except Exception as err:
+            sys.stderr.write("checkout error: " + str(err) + "\n")
+            ok = False
+         latencies.append(time.perf_counter() - t0)
+         return ok
+   async def checkouts():
+      slots = asyncio.Semaphore(concurrency)
+      return await asyncio.gather(*[checkout(slots, process)
+                                    for process in range(ncheckouts)])
+   t0 = time.time()
+   results = asyncio.run(checkouts())
+   return time.time() - t0, sorted(latencies), results.count(False)
+
+def percentile(values, fraction):
+   return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def usage():
+   print("Usage: osgprod_bench.py [options]")
+   print(" where options include any of the following:")
+   print("   -s <server> : postgres server host, default localhost")
+   print("   -d <dbname> : scratch database, default osgprod_bench")
+   print("   -t <threads> : concurrent checkouts, default", nthreads)
+   print("   -n <checkouts> : checkouts per method, default", ncheckouts)
+   print("   -f <files> : rawdata files to seed, default", nfiles)
+   print("   -b <blocks> : blocks per rawdata file, default", nblocks)
+   print("   -m <mode> : db to call the database directly, or http to go")
+   print("               through the wsgi and asgi dispatchers, default", mode)
+   print("   -c <requests> : http requests in flight, default", concurrency)
+   sys.exit(1)
+
+def report(name, seconds, latencies, failed):
+   print("{0:18s} {1:9d} {2:9.2f} {3:11.1f} {4:9.2f} {5:9.2f} {6:8d} {7:8d}"
+         .format(name, len(latencies), seconds, len(latencies) / seconds,
+                 percentile(latencies, 0.5) * 1e3,
+                 percentile(latencies, 0.99) * 1e3, failed, overlaps()))
+
+if __name__ == "__main__":
+   argc = 1
+   while argc < len(sys.argv):
+      if argc + 1 >= len(sys.argv):
+         usage()
+      opt = sys.argv[argc]
+      val = sys.argv[argc + 1]
+      if opt == "-s":
+         dbserver = val
+      elif opt == "-d":
+         dbname = val
+      elif opt == "-t":
+         nthreads = int(val)
+      elif opt == "-n":
+         ncheckouts = int(val)
+      elif opt == "-f":
+         nfiles = int(val)
+      elif opt == "-b":
+         nblocks = int(val)
+      elif opt == "-m" and val in ("db", "http"):
+         mode = val
+      elif opt == "-c":
+         concurrency = int(val)
+      else:
+         usage()
+      argc += 2
+
+   for module in (osgprod_db, osgprod_wsgi):
+      module.dbserver = dbserver
+      module.dbname = dbname
+      module.dbpool_size = nthreads
+
+   print("{0:18s} {1:>9s} {2:>9s} {3:>11s} {4:>9s} {5:>9s} {6:>8s} {7:>8s}"
+         .format("method", "checkouts", "seconds", "checkouts/s", "p50 ms",
+                 "p99 ms", "failed", "overlaps"))
+   if mode == "db":
+      for name, claim in methods:
+         iproject = seed()
+         report(name, *run(claim, iproject))
+   else:
+      docroot = make_docroot()
+      try:
+         for name, script in servers:
+            seed()
+            proc, port = start_server(script, docroot)
+            try:
+               results = run_http(port)
+            finally:
+               proc.terminate()
+               proc.wait()
+            report(name, *results)
+      finally:
+         shutil.rmtree(docroot)
+   osgprod_db.db_close()
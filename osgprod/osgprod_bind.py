@@ -13,7 +13,7 @@ import sys
 import time
 import random
 import struct
-import psycopg2
+import osgprod_pool
 import subprocess
 import shutil
 import re
@@ -22,6 +22,7 @@ dbserver = "cn445.storrs.hpc.uconn.edu"
 dbname = "osgprod"
 dbuser = "gluex"
 dbpass = "slicing+dicing"
+dbpool_size = 2
 
 xrootd_url = "root://cn442.storrs.hpc.uconn.edu"
 src_url = "srm://cn446.storrs.hpc.uconn.edu:8443"
@@ -30,22 +31,20 @@ dst_dn = "/C=US/O=Globus Consortium/OU=Globus Connect Service/CN=226c2da8-5236-1
 dst_cred = os.path.expanduser("~") + "/.globus/proxy_scosg16"
 input_area = "/gluex/resilient"
 output_area = "/recon/ver01"
+eviocat_threads = 4
 
 def db_connection():
    """
-   Returns a persistent connection to the osgprod database.
+   Returns a context manager that checks out a connection to the
+   osgprod database from the shared pool for the duration of a with
+   block, committing at the end or rolling back on an exception.
    """
-   global dbconnection
-   try:
-      conn = dbconnection
-   except:
-      dbconnection = psycopg2.connect(user = dbuser,
-                                      password = dbpass,
-                                      host = dbserver,
-                                      port = "5432",
-                                      database = dbname)
-      conn = dbconnection
-   return conn
+   return osgprod_pool.shared_pool(dbpool_size,
+                                   user = dbuser,
+                                   password = dbpass,
+                                   host = dbserver,
+                                   port = "5432",
+                                   database = dbname).connection()
 
 def upload(outfile, outdir):
    """
@@ -73,6 +72,15 @@ def upload(outfile, outdir):
                             dst_url + outpath], env=my_env)
    return 0
 
+def job_tarfile(cluster, process, task):
+   """
+   Returns the name of the output tarball of task task of job
+   cluster.process, as written by osgprod_exec.sh.
+   """
+   if task == 0:
+      return "job_{0}_{1}.tar.gz".format(cluster, process)
+   return "job_{0}_{1}_{2}.tar.gz".format(cluster, process, task)
+
 def next():
    """
    Gets the next output set to bind from the database, unpacks them into
@@ -91,7 +99,7 @@ def next():
          try:
             curs.execute("""SELECT rawdata.id,rawdata.run,rawdata.seqno,
                                    slices.block1,slices.block2,
-                                   jobs.cluster,jobs.process
+                                   jobs.cluster,jobs.process,jobs.task
                             FROM rawdata
                             LEFT JOIN bindings
                             ON bindings.iraw = rawdata.id
@@ -121,7 +129,8 @@ def next():
                if row[5] is not None and row[6] is not None:
                   cluster = int(row[5])
                   process = int(row[6])
-                  slices.append((block1,block2,cluster,process))
+                  task = int(row[7])
+                  slices.append((block1,block2,cluster,process,task))
                else:
                   print("slices missing on", row[5], row[6])
                   slices_missing += 1
@@ -153,7 +162,7 @@ def next():
    for sl in slices:
       sdir = str(sl[0]) + "," + str(sl[1])
       os.mkdir(sdir)
-      tarfile = "job_{0}_{1}.tar.gz".format(sl[2], sl[3])
+      tarfile = job_tarfile(sl[2], sl[3], sl[4])
       tarpath = input_area + "/" + tarfile
       try:
          subprocess.check_output(["gfal-copy", src_url + tarpath,
@@ -193,7 +202,7 @@ def next():
    badslices += merge_job_info(run, seqno, slices)
    badslices += merge_root_histos(run, seqno, slices)
    exitcode = -len(badslices)
-   with db_connection() as comm:
+   with db_connection() as conn:
       with conn.cursor() as curs:
          curs.execute("SELECT TIMEZONE('GMT', NOW());")
          now = curs.fetchone()[0]
@@ -252,7 +261,8 @@ def merge_evio_skims(run, seqno, slices):
                  )
             continue
          ifiles.append(ifile)
-      cmd = subprocess.Popen(["eviocat", "-o", ofile] + ifiles,
+      cmd = subprocess.Popen(["eviocat", "-j", str(eviocat_threads),
+                              "-o", ofile] + ifiles,
                              stderr=subprocess.PIPE)
       elog = cmd.communicate()
       if cmd.returncode != 0:
@@ -425,7 +435,7 @@ def unpack(run=0, seqno=0, iraw=0):
          with conn.cursor() as curs:
             curs.execute("""SELECT rawdata.id,rawdata.run,rawdata.seqno,
                                    slices.block1,slices.block2,
-                                   jobs.cluster,jobs.process
+                                   jobs.cluster,jobs.process,jobs.task
                             FROM rawdata
                             JOIN slices
                             ON slices.iraw = rawdata.id
@@ -443,13 +453,14 @@ def unpack(run=0, seqno=0, iraw=0):
                block2 = int(row[4])
                cluster = int(row[5])
                process = int(row[6])
-               slices.append((block1,block2,cluster,process))
+               task = int(row[7])
+               slices.append((block1,block2,cluster,process,task))
    elif run:
       with db_connection() as conn:
          with conn.cursor() as curs:
             curs.execute("""SELECT rawdata.id,rawdata.run,rawdata.seqno,
                                    slices.block1,slices.block2,
-                                   jobs.cluster,jobs.process
+                                   jobs.cluster,jobs.process,jobs.task
                             FROM rawdata
                             JOIN slices
                             ON slices.iraw = rawdata.id
@@ -467,7 +478,8 @@ def unpack(run=0, seqno=0, iraw=0):
                block2 = int(row[4])
                cluster = int(row[5])
                process = int(row[6])
-               slices.append((block1,block2,cluster,process))
+               task = int(row[7])
+               slices.append((block1,block2,cluster,process,task))
    workdir = str(iraw)
    os.mkdir(workdir)
    os.chdir(workdir)
@@ -475,7 +487,7 @@ def unpack(run=0, seqno=0, iraw=0):
    for sl in slices:
       sdir = str(sl[0]) + "," + str(sl[1])
       os.mkdir(sdir)
-      tarfile = "job_{0}_{1}.tar.gz".format(sl[2], sl[3])
+      tarfile = job_tarfile(sl[2], sl[3], sl[4])
       tarpath = input_area + "/" + tarfile
       try:
          subprocess.check_output(["gfal-copy", src_url + tarpath,
@@ -12,36 +12,189 @@
 #   CREATE DATABASE osgprod;
 #
 
+import io
 import os
 import re
-import struct
-import psycopg2
+import csv
+import sys
+import time
+import multiprocessing
+import osgprod_pool
+
+# the evio module lives in the top-level directory of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import evio
 
 dbserver = "cn445.storrs.hpc.uconn.edu"
 dbname = "osgprod"
 dbuser = "gluex"
 dbpass = "slicing+dicing"
+dbpool_size = 4
+
+# raw data files are scanned for their block counts on a pool of
+# scan_procs processes, and merged into the rawdata table every
+# merge_every files, with a progress report every progress_interval s
+scan_procs = 8
+merge_every = 2000
+progress_interval = 30
+rawdata_pattern = re.compile(r"hd_rawdata_([0-9]+)_([0-9]+)\.evio$")
+
+# sync_rawdata_files remembers the size, mtime, inode and block count of
+# every file it has scanned in this manifest, keyed by path
+rawdata_manifest = os.path.join(os.path.expanduser("~"),
+                                ".osgprod_rawdata_manifest")
+
+# argument lists of earlier versions of the osgprod_checkout function,
+# which are dropped when the current one is created
+checkout_signatures_old = ["(INT, TEXT, TEXT, INT, INT, INT, INT)",
+                           "(INT, TEXT, TEXT, INT, INT, INT, INT, INT)",
+                           "(INT, TEXT, TEXT, INT, INT, INT, INT, INT, INT)",
+                           "(INT, TEXT, TEXT, INT, INT, INT, INT, INT, INT, INT)",
+                           "(INT, TEXT, TEXT, INT, INT, INT, INT, INT, INT, INT, " +
+                           "INT)"]
+
+# versioned steps that bring the schema of an osgprod database up to
+# date, applied in order by migrate() and recorded in schema_version;
+# each statement must be harmless if its change is already there,
+# because the create_table functions make tables with the latest
+# columns but leave all of the secondary indexes to these steps
+migrate_lock_key = 0x6f736772
+schema_migrations = [
+   (1, "task, lease and locality columns of jobs",
+    ["""ALTER TABLE jobs
+        ADD COLUMN IF NOT EXISTS task INT DEFAULT 0 NOT NULL,
+        ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP WITH TIME ZONE,
+        ADD COLUMN IF NOT EXISTS site TEXT,
+        ADD COLUMN IF NOT EXISTS local BOOLEAN;
+     """,
+     """ALTER TABLE jobs
+        DROP CONSTRAINT IF EXISTS jobs_project_cluster_process_key;
+     """,
+     """CREATE UNIQUE INDEX IF NOT EXISTS jobs_project_cluster_process_task_key
+        ON jobs (project, cluster, process, task);
+     """]),
+   (2, "indexes for the dispatcher, reaper, estimator and binder queries",
+    [# next unassigned slice in id order, for osgprod_checkout
+     """CREATE INDEX IF NOT EXISTS slices_free_idx
+        ON slices (id)
+        WHERE ijob ISNULL;
+     """,
+     # unassigned slices of a rawdata file, for locality-aware checkout
+     """CREATE INDEX IF NOT EXISTS slices_free_iraw_idx
+        ON slices (iraw, id)
+        WHERE ijob ISNULL;
+     """,
+     # slice held by a job, for checkout, heartbeat and the reaper
+     """CREATE INDEX IF NOT EXISTS slices_ijob_idx
+        ON slices (ijob);
+     """,
+     # slices of a rawdata file in block order, for the binder and
+     # recycle_slices
+     """CREATE INDEX IF NOT EXISTS slices_iraw_block1_idx
+        ON slices (iraw, block1);
+     """,
+     # jobs finished since the last fold, for osgprod_fold_blockrates
+     """CREATE INDEX IF NOT EXISTS jobs_endtime_idx
+        ON jobs (endtime);
+     """,
+     # recent jobs at a site, for locality-aware checkout
+     """CREATE INDEX IF NOT EXISTS jobs_site_starttime_idx
+        ON jobs (site, starttime);
+     """,
+     # running jobs by lease expiry, for osgprod_reap
+     """CREATE INDEX IF NOT EXISTS jobs_lease_idx
+        ON jobs (lease_expires)
+        WHERE endtime ISNULL;
+     """,
+     "ANALYZE slices;",
+     "ANALYZE jobs;"]),
+   (3, "start counts of slices, and leases of jobs from before leases",
+    ["""ALTER TABLE slices
+        ADD COLUMN IF NOT EXISTS nstarts INT DEFAULT 0 NOT NULL;
+     """,
+     # jobs still running from before leases never expire otherwise
+     """UPDATE jobs
+        SET lease_expires = COALESCE(starttime, NOW()) + INTERVAL '1 hour'
+        WHERE endtime ISNULL
+        AND lease_expires ISNULL;
+     """]),
+   (4, "unassigned slices of a rawdata file in block order",
+    [# for locality-aware checkout, which takes the first free block
+     """CREATE INDEX IF NOT EXISTS slices_free_iraw_block1_idx
+        ON slices (iraw, block1)
+        WHERE ijob ISNULL;
+     """,
+     "DROP INDEX IF EXISTS slices_free_iraw_idx;"]),
+]
 
 def db_connection():
    """
-   Returns a persistent connection to the osgprod database.
+   Returns a context manager that checks out a connection to the
+   osgprod database from the shared pool for the duration of a with
+   block, committing at the end or rolling back on an exception.
    """
-   global dbconnection
-   try:
-      conn = dbconnection
-   except:
-      dbconnection = psycopg2.connect(user = dbuser,
-                                      password = dbpass,
-                                      host = dbserver,
-                                      port = "5432",
-                                      database = dbname)
-      conn = dbconnection
-   return conn
+   return osgprod_pool.shared_pool(dbpool_size,
+                                   user = dbuser,
+                                   password = dbpass,
+                                   host = dbserver,
+                                   port = "5432",
+                                   database = dbname).connection()
 
 def db_close():
-   if dbconnection:
-      dbconnection.close()
-      print("PostgreSQL connection is closed")
+   osgprod_pool.close_pools()
+   print("PostgreSQL connections are closed")
+
+def migrate(target=None):
+   """
+   Applies the steps of schema_migrations newer than the version
+   recorded in the schema_version table, up to version target if it is
+   given, and returns the list of versions applied. Each step runs in a
+   transaction of its own together with the record of its version,
+   under an advisory lock so that two callers cannot apply it twice.
+   Creating an index locks its table against writes while it is built,
+   so run this on a busy database at a quiet time.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version
+                           (version     INT     PRIMARY KEY     NOT NULL,
+                            description TEXT                    NOT NULL,
+                            applied     TIMESTAMP WITH TIME ZONE
+                                        DEFAULT NOW()           NOT NULL);
+                        """)
+   applied = []
+   for version, description, statements in schema_migrations:
+      if target is not None and version > target:
+         break
+      with db_connection() as conn:
+         with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);",
+                           (migrate_lock_key,))
+            cursor.execute("SELECT version FROM schema_version " +
+                           "WHERE version = %s;", (version,))
+            if cursor.fetchone():
+               continue
+            for statement in statements:
+               cursor.execute(statement)
+            cursor.execute("""INSERT INTO schema_version
+                              (version, description)
+                              VALUES (%s, %s);
+                           """, (version, description))
+            applied.append(version)
+   return applied
+
+def schema_version():
+   """
+   Returns the latest version in schema_version, or 0 for a database
+   that has never been migrated.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+         if not cursor.fetchone()[0]:
+            return 0
+         cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+         return cursor.fetchone()[0]
 
 def create_table_rawdata(delete=False):
    with db_connection() as conn:
@@ -76,7 +229,11 @@ def create_table_jobs(delete=False):
                              starttime   TIMESTAMP WITH TIME ZONE,
                              endtime     TIMESTAMP WITH TIME ZONE,
                              exitcode    INT,
-                             UNIQUE(project, cluster, process));
+                             task        INT     DEFAULT 0       NOT NULL,
+                             lease_expires TIMESTAMP WITH TIME ZONE,
+                             site        TEXT,
+                             local       BOOLEAN,
+                             UNIQUE(project, cluster, process, task));
                         """)
 
 def create_table_projects(delete=False):
@@ -103,11 +260,12 @@ def create_table_slices(delete=False):
                             ijob        INT     REFERENCES jobs(id),
                             iraw        INT     REFERENCES rawdata(id),
                             block1      INT                     NOT NULL,
-                            block2      INT                     NOT NULL);
+                            block2      INT                     NOT NULL,
+                            nstarts     INT     DEFAULT 0       NOT NULL);
                         """)
 
 def create_table_bindings(delete=False):
-   with db_connection().cursor() as conn:
+   with db_connection() as conn:
       with conn.cursor() as cursor:
          if delete:
             cursor.execute("DROP TABLE bindings;")
@@ -121,80 +279,625 @@ def create_table_bindings(delete=False):
                             UNIQUE(iraw));
                         """)
 
+def create_table_blockrates(delete=False):
+   """
+   Creates the blockrates table, which holds the running totals of
+   blocks processed and cpu seconds used by the successful jobs of
+   each run at each site, and the one-row blockrates_folded table
+   that records how far the jobs table has been folded into them.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         if delete:
+            cursor.execute("DROP TABLE blockrates, blockrates_folded;")
+         cursor.execute("""CREATE TABLE blockrates
+                           (id          SERIAL  PRIMARY KEY     NOT NULL,
+                            run         INT                     NOT NULL,
+                            site        TEXT                    NOT NULL,
+                            njobs       INT     DEFAULT 0       NOT NULL,
+                            nblocks     BIGINT  DEFAULT 0       NOT NULL,
+                            cpuseconds  DOUBLE PRECISION DEFAULT 0 NOT NULL,
+                            UNIQUE(run, site));
+                        """)
+         cursor.execute("""CREATE TABLE blockrates_folded
+                           (folded      TIMESTAMP WITH TIME ZONE NOT NULL);
+                        """)
+         cursor.execute("""INSERT INTO blockrates_folded
+                           VALUES ('-infinity');
+                        """)
+
+def create_function_blockrates():
+   """
+   Creates or replaces the osgprod_site function, which maps a worker
+   address to the /24 (ipv4) or /64 (ipv6) subnet of its site, and the
+   osgprod_fold_blockrates function, which adds the jobs that ended
+   successfully since the last call to the totals in blockrates and
+   returns the number of (run, site) rows it touched. Jobs that ended
+   within the last minute are left for the next call, so that an exit
+   whose transaction is still open is not skipped.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("""CREATE OR REPLACE FUNCTION osgprod_site
+                            (p_worker TEXT)
+                           RETURNS TEXT
+                           AS $$
+                              SELECT CASE
+                                 WHEN p_worker ~ '^[0-9]+[.][0-9]+[.][0-9]+[.][0-9]+$'
+                                 THEN network(set_masklen(p_worker::INET, 24))::TEXT
+                                 WHEN p_worker ~ '^[0-9a-fA-F:]+$'
+                                 THEN network(set_masklen(p_worker::INET, 64))::TEXT
+                                 ELSE COALESCE(p_worker, '')
+                              END;
+                           $$ LANGUAGE sql IMMUTABLE;
+                        """)
+         cursor.execute("""CREATE OR REPLACE FUNCTION osgprod_fold_blockrates
+                            (OUT nfolded INT)
+                           AS $$
+                           DECLARE
+                              v_from TIMESTAMP WITH TIME ZONE;
+                              v_to TIMESTAMP WITH TIME ZONE;
+                           BEGIN
+                              SELECT folded INTO v_from
+                              FROM blockrates_folded
+                              FOR UPDATE;
+                              v_to := TIMEZONE('GMT', NOW()) -
+                                      INTERVAL '1 minute';
+                              nfolded := 0;
+                              IF v_to <= v_from THEN
+                                 RETURN;
+                              END IF;
+                              INSERT INTO blockrates (run, site, njobs,
+                                                      nblocks, cpuseconds)
+                              SELECT rawdata.run,
+                                     osgprod_site(jobs.worker),
+                                     COUNT(*),
+                                     SUM(slices.block2 - slices.block1),
+                                     SUM(EXTRACT(EPOCH FROM jobs.endtime -
+                                                            jobs.starttime) *
+                                         jobs.ncpus)
+                              FROM jobs JOIN slices
+                              ON slices.ijob = jobs.id
+                              JOIN rawdata
+                              ON rawdata.id = slices.iraw
+                              WHERE jobs.endtime > v_from
+                              AND jobs.endtime <= v_to
+                              AND jobs.exitcode = 0
+                              AND jobs.endtime > jobs.starttime
+                              AND jobs.ncpus > 0
+                              GROUP BY 1, 2
+                              ON CONFLICT (run, site) DO UPDATE SET
+                                 njobs = blockrates.njobs + EXCLUDED.njobs,
+                                 nblocks = blockrates.nblocks +
+                                           EXCLUDED.nblocks,
+                                 cpuseconds = blockrates.cpuseconds +
+                                              EXCLUDED.cpuseconds;
+                              GET DIAGNOSTICS nfolded = ROW_COUNT;
+                              UPDATE blockrates_folded SET folded = v_to;
+                           END;
+                           $$ LANGUAGE plpgsql;
+                        """)
+
+def fold_blockrates(rebuild=False):
+   """
+   Runs the osgprod_fold_blockrates function once, as the dispatcher
+   does every few minutes, and returns the number of rows updated.
+   With rebuild=True the totals are first cleared, so that they are
+   recomputed from the whole history of the jobs table.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         if rebuild:
+            cursor.execute("DELETE FROM blockrates;")
+            cursor.execute("UPDATE blockrates_folded SET folded = '-infinity';")
+         cursor.execute("SELECT osgprod_fold_blockrates();")
+         return cursor.fetchone()[0]
+
+def create_function_checkout():
+   """
+   Creates or replaces the osgprod_checkout function called by the
+   osgprod_wsgi dispatcher, which claims the job row and the slice of
+   work for a worker in one statement. It must be created after the
+   projects, rawdata, jobs, slices and blockrates tables. Task p_task
+   of a job is a separate row in jobs with a slice of its own, so that
+   one worker can lease several slices at once. The lease on the slice
+   runs for p_lease seconds unless it is renewed by a heartbeat.
+   A new slice is sized to take about p_target seconds of walltime on
+   p_ncpus cores, at the rate per block measured in blockrates for its
+   run at the site of the worker, or for its run at all sites if that
+   site has fewer than 3 jobs in it, capped at 10 times p_nblocks.
+   Without enough history, or if p_target is 0, it is p_nblocks long.
+   The new slice is taken from one of the last 8 rawdata files that
+   jobs from the same site started on within the last p_window seconds,
+   the most recent first and in block order, if any of those has
+   unassigned slices left, so that the site cache gets to serve the
+   file again, and otherwise in id order. local_slice tells which
+   way it was chosen, and is NULL if the job already held its slice.
+   A slice is handed out at most p_maxstarts times, counting restarts
+   of the job that holds it and reissues after its lease expired; when
+   it would go out again its job is marked failed with exit code -1,
+   and the slice stays with it until recycle_slices puts it back.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         for signature in checkout_signatures_old:
+            cursor.execute("DROP FUNCTION IF EXISTS osgprod_checkout" +
+                           signature + ";")
+         cursor.execute("""CREATE OR REPLACE FUNCTION osgprod_checkout
+                            (p_project INT, p_script TEXT, p_worker TEXT,
+                             p_cluster INT, p_process INT, p_ncpus INT,
+                             p_nblocks INT, p_task INT, p_lease INT,
+                             p_target INT, p_window INT, p_maxstarts INT,
+                             OUT status TEXT,
+                             OUT job_id INT,
+                             OUT job_nstarts INT,
+                             OUT job_started TIMESTAMP,
+                             OUT raw_id INT,
+                             OUT first_block INT,
+                             OUT last_block INT,
+                             OUT raw_path TEXT,
+                             OUT local_slice BOOLEAN)
+                           AS $$
+                           DECLARE
+                              v_slice slices%ROWTYPE;
+                              v_run INT;
+                              v_rate DOUBLE PRECISION;
+                              v_nblocks INT;
+                              v_site TEXT := osgprod_site(p_worker);
+                           BEGIN
+                              PERFORM jobs.id
+                              FROM jobs JOIN projects
+                              ON projects.id = jobs.project
+                              WHERE jobs.cluster = p_cluster
+                              AND jobs.process = p_process
+                              AND jobs.task = p_task
+                              AND projects.projectname =
+                                  (SELECT projectname FROM projects
+                                   WHERE id = p_project)
+                              AND jobs.endtime IS NOT NULL
+                              AND jobs.exitcode IS NOT NULL
+                              FOR UPDATE OF jobs;
+                              IF FOUND THEN
+                                 status := 'completed';
+                                 RETURN;
+                              END IF;
+                              SELECT jobs.id, jobs.nstarts
+                              INTO job_id, job_nstarts
+                              FROM jobs JOIN projects
+                              ON projects.id = jobs.project
+                              WHERE jobs.cluster = p_cluster
+                              AND jobs.process = p_process
+                              AND jobs.task = p_task
+                              AND projects.projectname =
+                                  (SELECT projectname FROM projects
+                                   WHERE id = p_project)
+                              AND jobs.endtime IS NULL
+                              AND jobs.exitcode IS NULL
+                              FOR UPDATE OF jobs;
+                              IF NOT FOUND THEN
+                                 INSERT INTO jobs (project, cluster, process,
+                                                   task)
+                                 VALUES (p_project, p_cluster, p_process,
+                                         p_task)
+                                 RETURNING id INTO job_id;
+                              END IF;
+                              job_nstarts := COALESCE(job_nstarts, 0) + 1;
+                              job_started := TIMEZONE('GMT', NOW());
+                              UPDATE jobs SET script = p_script,
+                                              worker = p_worker,
+                                              ncpus = p_ncpus,
+                                              nstarts = job_nstarts,
+                                              starttime = job_started,
+                                              site = v_site,
+                                              lease_expires = NOW() +
+                                                 p_lease * INTERVAL '1 second'
+                              WHERE id = job_id;
+
+                              SELECT * INTO v_slice
+                              FROM slices
+                              WHERE ijob = job_id
+                              LIMIT 1;
+                              IF FOUND THEN
+                                 IF v_slice.nstarts >= p_maxstarts THEN
+                                    UPDATE jobs SET
+                                    endtime = TIMEZONE('GMT', NOW()),
+                                    exitcode = -1
+                                    WHERE id = job_id;
+                                    status := 'failed';
+                                    RETURN;
+                                 END IF;
+                                 UPDATE slices SET nstarts = nstarts + 1
+                                 WHERE id = v_slice.id;
+                                 last_block := v_slice.block2;
+                                 SELECT path INTO raw_path
+                                 FROM rawdata
+                                 WHERE id = v_slice.iraw;
+                              ELSE
+                                 local_slice := FALSE;
+                                 IF p_window > 0 THEN
+                                    SELECT free.* INTO v_slice
+                                    FROM (SELECT held.iraw,
+                                                 MAX(near.starttime)
+                                                 AS started
+                                          FROM jobs AS near
+                                          JOIN slices AS held
+                                          ON held.ijob = near.id
+                                          WHERE near.site = v_site
+                                          AND near.starttime > job_started -
+                                              p_window * INTERVAL '1 second'
+                                          GROUP BY held.iraw
+                                          ORDER BY started DESC
+                                          LIMIT 8) AS recent
+                                    JOIN slices AS free
+                                    ON free.iraw = recent.iraw
+                                    WHERE free.ijob ISNULL
+                                    ORDER BY recent.started DESC, free.block1
+                                    LIMIT 1
+                                    FOR UPDATE OF free SKIP LOCKED;
+                                    local_slice := FOUND;
+                                 END IF;
+                                 IF NOT local_slice THEN
+                                    SELECT * INTO v_slice
+                                    FROM slices
+                                    WHERE ijob ISNULL
+                                    ORDER BY id
+                                    LIMIT 1
+                                    FOR UPDATE SKIP LOCKED;
+                                    IF NOT FOUND THEN
+                                       status := 'nowork';
+                                       RETURN;
+                                    END IF;
+                                 END IF;
+                                 SELECT path, run INTO raw_path, v_run
+                                 FROM rawdata
+                                 WHERE id = v_slice.iraw;
+                                 v_nblocks := p_nblocks;
+                                 IF p_target > 0 THEN
+                                    SELECT nblocks / cpuseconds INTO v_rate
+                                    FROM blockrates
+                                    WHERE run = v_run
+                                    AND site = osgprod_site(p_worker)
+                                    AND njobs >= 3
+                                    AND cpuseconds > 0;
+                                    IF v_rate IS NULL THEN
+                                       SELECT SUM(nblocks) / SUM(cpuseconds)
+                                       INTO v_rate
+                                       FROM blockrates
+                                       WHERE run = v_run
+                                       HAVING SUM(njobs) >= 3
+                                       AND SUM(cpuseconds) > 0;
+                                    END IF;
+                                    IF v_rate IS NOT NULL THEN
+                                       v_nblocks := GREATEST(1,
+                                          LEAST(10.0 * p_nblocks,
+                                                FLOOR(p_target * p_ncpus *
+                                                      v_rate)));
+                                    END IF;
+                                 END IF;
+                                 last_block := v_slice.block1 + v_nblocks;
+                                 IF last_block + 1 >= v_slice.block2 THEN
+                                    last_block := v_slice.block2;
+                                 END IF;
+                                 UPDATE slices SET ijob = job_id,
+                                                   block2 = last_block,
+                                                   nstarts = nstarts + 1
+                                 WHERE id = v_slice.id;
+                                 UPDATE jobs SET local = local_slice
+                                 WHERE id = job_id;
+                                 IF last_block < v_slice.block2 THEN
+                                    INSERT INTO slices (iraw, block1, block2)
+                                    VALUES (v_slice.iraw, last_block,
+                                            v_slice.block2);
+                                 END IF;
+                              END IF;
+                              first_block := v_slice.block1;
+                              raw_id := v_slice.iraw;
+                              status := 'ok';
+                           END;
+                           $$ LANGUAGE plpgsql;
+                        """)
+
+def create_function_reap():
+   """
+   Creates or replaces the osgprod_reap function, which returns the
+   slices held by unfinished jobs whose lease has expired to the pool
+   of unassigned slices, and returns how many it released. The jobs
+   rows themselves are left alone, so that a preempted job that comes
+   back later is recognized and given a new slice. A slice that was
+   already handed out p_maxstarts times is not released but stays with
+   its job, which is marked failed with exit code -1.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("DROP FUNCTION IF EXISTS osgprod_reap();")
+         cursor.execute("""CREATE OR REPLACE FUNCTION osgprod_reap
+                            (p_maxstarts INT, OUT nreaped INT)
+                           AS $$
+                           BEGIN
+                              WITH expired AS
+                                 (SELECT slices.id, slices.ijob, slices.nstarts
+                                  FROM slices JOIN jobs
+                                  ON jobs.id = slices.ijob
+                                  WHERE jobs.endtime ISNULL
+                                  AND jobs.lease_expires < NOW()
+                                  FOR UPDATE OF slices, jobs SKIP LOCKED),
+                              failed AS
+                                 (UPDATE jobs SET
+                                  endtime = TIMEZONE('GMT', NOW()),
+                                  exitcode = -1
+                                  FROM expired
+                                  WHERE jobs.id = expired.ijob
+                                  AND expired.nstarts >= p_maxstarts)
+                              UPDATE slices SET ijob = NULL
+                              FROM expired
+                              WHERE slices.id = expired.id
+                              AND expired.nstarts < p_maxstarts;
+                              GET DIAGNOSTICS nreaped = ROW_COUNT;
+                           END;
+                           $$ LANGUAGE plpgsql;
+                        """)
+
+def reap_slices(maxstarts=5):
+   """
+   Runs the osgprod_reap function once, as the dispatcher does every
+   few minutes, and returns the number of slices released. Slices
+   that were handed out maxstarts times already stay with their jobs,
+   which are marked failed.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("SELECT osgprod_reap(%s);", (maxstarts,))
+         return cursor.fetchone()[0]
+
 def add_project(name, subnet, script, xrootd, maxblocks):
    """
    Add a new entry to the project database.
    """
    with db_connection() as conn:
       with conn.cursor() as cursor:
-         cursor.execute("""INSERT INTO project (projectname,
-                                                workersubnet,
-                                                scripttemplate,
-                                                xrootdserver,
-                                                maxblockspercore)
-                           VALUES (%s,%s,%s,%s);
-                        """, (name, subnet, script, xrootd, maxblocks)) 
+         cursor.execute("""INSERT INTO projects (projectname,
+                                                 workersubnet,
+                                                 workscript,
+                                                 xrootdprefix,
+                                                 maxblockspercore)
+                           VALUES (%s,%s,%s,%s,%s);
+                        """, (name, subnet, script, xrootd, maxblocks))
+
+def find_rawdata_files(dir):
+   """
+   Generates the absolute paths of all raw data files in the
+   directory tree under dir.
+   """
+   for root, subdir, files in os.walk(dir):
+      for file in files:
+         if rawdata_pattern.match(file):
+            yield os.path.join(os.path.abspath(root), file)
+
+def scan_rawdata_file(path):
+   """
+   Returns the rawdata row (run, seqno, path, nbytes, nblocks) for
+   the raw data file at path, followed by its mtime in ns and inode
+   number and None, or by an error message if the file could not be
+   read. Runs in the scan processes.
+   """
+   param = rawdata_pattern.match(os.path.basename(path))
+   run = int(param.group(1))
+   seqno = int(param.group(2))
+   try:
+      stat = os.stat(path)
+      nblocks = evio.count_blocks(path)
+   except (OSError, evio.EvioError) as err:
+      return (run, seqno, path, 0, 0, 0, 0, str(err))
+   return (run, seqno, path, stat.st_size, nblocks, stat.st_mtime_ns,
+           stat.st_ino, None)
+
+def merge_rawdata(cursor, rows):
+   """
+   Copies rows into the rawdata_staging table and enters those that
+   are not yet in rawdata, then checks the rest against what rawdata
+   says about them. Returns the number of rows entered and the set of
+   paths that failed the checks.
+   """
+   buf = io.StringIO()
+   csv.writer(buf).writerows(rows)
+   buf.seek(0)
+   cursor.copy_expert("""COPY rawdata_staging (run,seqno,path,nbytes,nblocks)
+                         FROM STDIN WITH (FORMAT csv);
+                      """, buf)
+   cursor.execute("""INSERT INTO rawdata (run,seqno,path,nbytes,nblocks)
+                     SELECT run,seqno,path,nbytes,nblocks
+                     FROM rawdata_staging
+                     ORDER BY run,seqno
+                     ON CONFLICT DO NOTHING;
+                  """)
+   inserted = cursor.rowcount
+   cursor.execute("""SELECT staged.path, rawdata.path, rawdata.run,
+                            rawdata.seqno, rawdata.nbytes, rawdata.nblocks,
+                            staged.run, staged.seqno, staged.nbytes,
+                            staged.nblocks
+                     FROM rawdata_staging AS staged
+                     JOIN rawdata
+                     ON rawdata.path = staged.path
+                     OR (rawdata.run = staged.run AND
+                         rawdata.seqno = staged.seqno)
+                     WHERE (rawdata.path, rawdata.run, rawdata.seqno,
+                            rawdata.nbytes, rawdata.nblocks)
+                     IS DISTINCT FROM (staged.path, staged.run, staged.seqno,
+                                       staged.nbytes, staged.nblocks);
+                  """)
+   failed = set()
+   for row in cursor.fetchall():
+      failed.add(row[0])
+      if row[0] != row[1]:
+         print("Duplicate entry in database entry for rawdata file", row[0],
+               "- database has run", row[2], "sequence", row[3], "at", row[1])
+      elif row[2] != row[6]:
+         print("Database run number check failed for", row[0],
+               "- database says run number should be", row[2])
+      elif row[3] != row[7]:
+         print("Database sequence number check failed for", row[0],
+               "- database says sequence number should be", row[3])
+      elif row[4] != row[8]:
+         print("Database file size check failed for", row[0],
+               "- database says files size should be", row[4])
+      elif row[5] != row[9]:
+         print("Database block count check failed for", row[0],
+               "- database says block count should be", row[5])
+   return inserted, failed
+
+def print_scan_progress(nfiles, nbytes, t0):
+   dt = max(time.time() - t0, 1e-6)
+   print("scanned {0} files, {1:.2f} GB in {2:.1f} s, {3:.1f} files/s, "
+         "{4:.2f} GB/s".format(nfiles, nbytes / 1e9, dt, nfiles / dt,
+                               nbytes / 1e9 / dt))
 
-def load_rawdata_files(dir):
+def merge_rawdata_files(paths, nprocs=None, known=()):
+   """
+   Scans the raw data files in paths on nprocs processes (scan_procs
+   by default), and copies the results into the database, together
+   with the rawdata rows in known that need no scan, where they are
+   entered into rawdata or checked against it in batches of merge_every
+   files. Returns the number of files entered, the list of the results
+   of scan_rawdata_file for the files that were read and passed the
+   checks, and the set of paths that failed them.
+   """
+   filecount = 0
+   nfiles = 0
+   nbytes = 0
+   scanned = []
+   failed = set()
+   t0 = time.time()
+   last_report = t0
+   # the scanning processes are forked before a connection is checked
+   # out, so that none of them inherits one in the middle of a transaction
+   rows = list(known)
+   with multiprocessing.Pool(nprocs or scan_procs) as pool:
+      with db_connection() as conn:
+         with conn.cursor() as cursor:
+            cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS rawdata_staging
+                              (run         INT,
+                               seqno       INT,
+                               path        TEXT,
+                               nbytes      BIGINT,
+                               nblocks     INT)
+                              ON COMMIT DELETE ROWS;
+                           """)
+            conn.commit()
+            for result in pool.imap_unordered(scan_rawdata_file, paths):
+               nfiles += 1
+               if result[7] is not None:
+                  print("Unable to scan rawdata file", result[2], "-",
+                        result[7])
+                  continue
+               nbytes += result[3]
+               rows.append(result[:5])
+               scanned.append(result)
+               if len(rows) >= merge_every:
+                  inserted, bad = merge_rawdata(cursor, rows)
+                  conn.commit()
+                  filecount += inserted
+                  failed |= bad
+                  rows = []
+               if time.time() - last_report > progress_interval:
+                  print_scan_progress(nfiles, nbytes, t0)
+                  last_report = time.time()
+            if rows:
+               inserted, bad = merge_rawdata(cursor, rows)
+               filecount += inserted
+               failed |= bad
+   print_scan_progress(nfiles, nbytes, t0)
+   return (filecount, [result for result in scanned if result[2] not in failed],
+           failed)
+
+def load_rawdata_files(dir, nprocs=None):
    """
    Walks the entire directory tree under dir looking for raw data
    files, and all that it finds are entered into the rawdata table
    of the osgprod database, if they are not already there. If they
-   are there, it verifies that the db values are correct.
+   are there, it verifies that the db values are correct. The files
+   are scanned on nprocs processes (scan_procs by default), and the
+   results are copied into the database and merged into rawdata in
+   batches of merge_every files. Returns the number of files entered.
    """
+   return merge_rawdata_files(find_rawdata_files(dir), nprocs)[0]
+
+def read_manifest(manifest):
+   """
+   Returns the entries of the manifest file at path manifest, as a
+   dict of (nbytes, mtime, inode, nblocks) keyed by path.
+   """
+   entries = {}
+   if os.path.exists(manifest):
+      with open(manifest, newline="") as fman:
+         for row in csv.reader(fman):
+            entries[row[0]] = tuple([int(value) for value in row[1:5]])
+   return entries
+
+def write_manifest(manifest, entries):
+   """
+   Replaces the manifest file at path manifest with entries, written
+   to a new file first so that an interrupted write loses nothing.
+   """
+   with open(manifest + ".new", "w", newline="") as fman:
+      writer = csv.writer(fman)
+      for path in sorted(entries):
+         writer.writerow((path,) + entries[path])
+   os.replace(manifest + ".new", manifest)
+
+def sync_rawdata_files(dir, manifest=None, nprocs=None):
+   """
+   Brings the rawdata table up to date with the raw data files under
+   dir like load_rawdata_files, but only scans the files that are new,
+   or whose size, mtime or inode changed, since they were recorded in
+   the manifest (rawdata_manifest by default). Unchanged files that are
+   missing from rawdata are entered from the manifest, and files that
+   failed the checks against rawdata are scanned again next time.
+   Files in rawdata under dir that are no longer on disk are reported.
+   Returns the number of files entered and the list of missing paths.
+   """
+   manifest = manifest or rawdata_manifest
+   top = os.path.join(os.path.abspath(dir), "")
+   entries = read_manifest(manifest)
    with db_connection() as conn:
       with conn.cursor() as cursor:
-         filecount = 0
-         commit_every = 1
-         rawpat = re.compile(r"hd_rawdata_([0-9]+)_([0-9]+).evio")
-         for root, subdir, files in os.walk(dir):
-            for file in files:
-               print(file)
-               param = rawpat.match(file)
-               if param:
-                  run = int(param.group(1))
-                  seqno = int(param.group(2))
-                  path = os.path.join(os.path.abspath(root), file)
-                  nbytes = os.path.getsize(path)
-                  nblocks = 0
-                  offset = 0
-                  fevio = open(path, 'rb')
-                  while offset < nbytes:
-                     try:
-                        fevio.seek(offset, 0)
-                        bhead = fevio.read(4)
-                        wsize = struct.unpack(">I", bhead)
-                        offset += wsize[0] * 4
-                        nblocks += 1
-                     except:
-                        break
-                  cursor.execute("SELECT id,run,seqno,nbytes,nblocks " +
-                                 "FROM rawdata where path = %s;", (path,))
-                  rows = cursor.fetchall()
-                  if len(rows) == 0:
-                     cursor.execute("INSERT INTO rawdata " +
-                                    "(run,seqno,path,nbytes,nblocks)" +
-                                    "VALUES (%s,%s,%s,%s,%s);",
-                                    (run, seqno, path, nbytes, nblocks))
-                     filecount += 1
-                     if (filecount % commit_every) == 0:
-                        conn.commit()
-                  elif len(rows) == 1:
-                     if rows[0][1] != run:
-                        print("Database run number check failed for", file,
-                              "- database says run number should be", rows[0][1])
-                     elif rows[0][2] != seqno:
-                        print("Database sequence number check failed for", file,
-                              "- database says sequence number should be", rows[0][2])
-                     elif rows[0][3] != nbytes:
-                        print("Database file size check failed for", file,
-                              "- database says files size should be", rows[0][3])
-                     elif rows[0][4] != nblocks:
-                        print("Database block count check failed for", file,
-                              "- database says block count should be", rows[0][4])
-                  else:
-                     print("Duplicate entry in database entry for rawdata file", file)
-   return filecount
+         cursor.execute("""SELECT path FROM rawdata
+                           WHERE LEFT(path, %s) = %s;
+                        """, (len(top), top))
+         indb = set([row[0] for row in cursor.fetchall()])
+   ondisk = set()
+   changed = []
+   known = []
+   for path in find_rawdata_files(dir):
+      ondisk.add(path)
+      try:
+         stat = os.stat(path)
+      except OSError:
+         changed.append(path)
+         continue
+      entry = entries.get(path)
+      if entry and entry[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+         if not path in indb:
+            param = rawdata_pattern.match(os.path.basename(path))
+            known.append((int(param.group(1)), int(param.group(2)), path,
+                          entry[0], entry[3]))
+      else:
+         entries.pop(path, None)
+         changed.append(path)
+   filecount, scanned, failed = merge_rawdata_files(changed, nprocs, known)
+   for path in failed:
+      entries.pop(path, None)
+   for result in scanned:
+      entries[result[2]] = (result[3], result[5], result[6], result[4])
+   for path in list(entries):
+      if path.startswith(top) and not path in ondisk:
+         del entries[path]
+   write_manifest(manifest, entries)
+   missing = sorted(indb - ondisk)
+   for path in missing:
+      print("Rawdata file", path, "is in the database but no longer on disk")
+   print("synced {0} files under {1}: {2} scanned, {3} entered, {4} missing"
+         .format(len(ondisk), dir, len(changed), filecount, len(missing)))
+   return filecount, missing
 
 def load_slices(runs=(0,999999)):
    """
@@ -230,7 +933,10 @@ def recycle_slices(runs=(0,999999)):
    associated with that slice so that the work dispatcher
    will rerun production on that slice, then remove the
    failed bindings entry so that binding will be tried
-   again as soon as the production finishes.
+   again as soon as the production finishes. Slices whose
+   job was failed with exit code -1 for reaching max_starts
+   never get a bindings entry, so those are put back too,
+   with their start counts cleared.
    """
    badslices = {}
    with db_connection() as conn:
@@ -269,4 +975,15 @@ def recycle_slices(runs=(0,999999)):
             cursor.execute("""DELETE FROM bindings
                               WHERE iraw = %s;
                            """, (iraw,))
+         cursor.execute("""UPDATE slices
+                           SET ijob = NULL,
+                               nstarts = 0
+                           FROM jobs, rawdata
+                           WHERE jobs.id = slices.ijob
+                           AND rawdata.id = slices.iraw
+                           AND rawdata.run >= %s
+                           AND rawdata.run < %s
+                           AND jobs.exitcode = -1;
+                        """, (runs[0], runs[1]))
+         recycled += cursor.rowcount
    return recycled
@@ -6,26 +6,37 @@
 # author: richard.t.jones at uconn.edu
 # version: november 16, 2020
 #
-# usage: ./osgrod_exec.sh <cluster> <process> [<ncpus>]
+# usage: ./osgrod_exec.sh <cluster> <process> [<ncpus> [<nslices>]]
 #  where <cluster> and <process> are two numerical identifiers
 #  that are used to uniquely identify a grid job within the
 #  osgprod environment. Normally they correspond to the
 #  condor job cluster and process number on the submit host.
 #  If a third argument is given it must be the number of cores
-#  available for this job, otherwise it defaults to 1.
+#  available for this job, otherwise it defaults to 1. If a
+#  fourth argument is given, the job leases that many slices
+#  at once in a single request and runs them side by side,
+#  each with its share of the cores, in subdirectories task_N.
+#  The results of task N > 0 are returned in tarball
+#  job_<cluster>_<process>_N.tar.gz.
 
 osgprod_url="https://cn410.storrs.hpc.uconn.edu/osgprod"
 magic_words="good+curry"
 project="osg-11-2020"
 output_collector="srm://cn446.storrs.hpc.uconn.edu:8443/gluex/resilient"
-curl="curl -s -f --capath /etc/grid-security/certificates"
+curl="curl -s -f --compressed --capath /etc/grid-security/certificates"
+heartbeat_interval=600
 
-if [ $# = 3 ]; then
+if [ $# = 4 ]; then
     ncpus=$3
+    nslices=$4
+elif [ $# = 3 ]; then
+    ncpus=$3
+    nslices=1
 elif [ $# = 2 ]; then
     ncpus=1
+    nslices=1
 else
-    echo "usage: ./osgprod_exec.py <cluster> <process> [<ncpus>]"
+    echo "usage: ./osgprod_exec.py <cluster> <process> [<ncpus> [<nslices>]]"
     exit 1
 fi
 
@@ -33,6 +44,10 @@ export CLUSTER=$1
 export PROCESS=$2
 export NTHREADS=$ncpus
 
+# each task runs in a process group of its own, so that all of its
+# processes can be stopped together if its lease expires
+set -m
+
 function error_exit {
     echo "error code $1"
     exit $1
@@ -45,7 +60,111 @@ function report_exit {
     exit 0
 }
 
+function heartbeat {
+    # renews the leases on the slices of tasks $1 (comma-separated)
+    # every heartbeat_interval seconds, and stops any task whose slice
+    # the dispatcher has given to another job in the meantime
+    while sleep $heartbeat_interval; do
+        reply=`$curl "$osgprod_url/workscript.heartbeat?tasks=$1&cluster=$CLUSTER&process=$PROCESS&project=$project&magic=$magic_words;"`
+        case "$reply" in
+        "Lease expired: "*)
+            for task in `echo ${reply#Lease expired: } | tr , ' '`; do
+                echo "lease on the slice of task $task expired, stopping it"
+                kill -TERM -${pids[$task]}
+            done
+            ;;
+        esac
+    done
+}
+
+function run_task {
+    task=$1
+    jobtag=${CLUSTER}_${PROCESS}
+    [ $task = 0 ] || jobtag=${jobtag}_$task
+    mkdir -p task_$task || return $?
+    mv workscript_$task.bash task_$task/workscript.bash || return $?
+    cd task_$task
+    chmod +x workscript.bash
+    ../osg-container.sh ./workscript.bash >workscript.stdout 2>workscript.stderr
+    retcode=$?
+    if [ $retcode != 0 ]; then
+        flog=job_$jobtag.flog
+        echo "======================" > $flog
+        echo "Failed job stdout log:" >> $flog
+        echo "======================" >> $flog
+        cat workscript.stdout >> $flog
+        echo "======================" >> $flog
+        echo "Failed job stderr log:" >> $flog
+        echo "======================" >> $flog
+        cat workscript.stderr >> $flog
+        srmcp file:///`pwd`/$flog $output_collector/$flog
+        cd ..
+        rm -rf task_$task
+        return $retcode
+    fi
+    outfiles=`find . -maxdepth 1 -type f -newer workscript.bash ! -name "*x509*"`
+    tarfile=job_$jobtag.tar.gz
+    if [ -z "$outfiles" ]; then
+        retcode=99
+    elif tar -zcf $tarfile $outfiles; then
+        srmcp file:///`pwd`/$tarfile $output_collector/$tarfile
+        retcode=$?
+    else
+        retcode=$?
+    fi
+    cd ..
+    rm -rf task_$task
+    return $retcode
+}
+
+function batch_exec {
+    echo -n "fetching $nslices job slice workscripts from osgprod server..."
+    taskcpus=$(( ncpus / nslices ))
+    [ $taskcpus -gt 0 ] || taskcpus=1
+    export NTHREADS=$taskcpus
+    for retry in 0 1 2; do
+        $curl -o workscripts.bash "$osgprod_url/workscript.batch?cluster=$CLUSTER&process=$PROCESS&project=$project&cpus=$taskcpus&count=$nslices&magic=$magic_words;"
+        retcode=$?
+        if [ $retcode = 0 -a -r workscripts.bash ]; then
+            break
+        elif [ $retry = 2 ]; then
+            echo "failed"
+            error_exit $retcode
+        fi
+        sleep 1
+    done
+    bash workscripts.bash || error_exit $?
+    rm -f workscripts.bash
+    tasks=`ls workscript_*.bash 2>/dev/null | sed 's/workscript_//;s/.bash//'`
+    if [ -z "$tasks" ]; then
+        echo "nothing to do"
+        exit 0
+    fi
+    echo "succeeded"
+
+    echo -n "executing workscripts for tasks" $tasks "..."
+    for task in $tasks; do
+        run_task $task >task_$task.log 2>&1 &
+        pids[$task]=$!
+    done
+    heartbeat `echo $tasks | tr ' ' ,` &
+    heartpid=$!
+    exitcodes=""
+    for task in $tasks; do
+        wait ${pids[$task]}
+        exitcodes="$exitcodes${exitcodes:+,}$task:$?"
+        rm -f task_$task.log
+    done
+    kill -- -$heartpid
+    echo "finished with exit codes $exitcodes"
+    echo -n "sending job report back to job dispatch..."
+    $curl "$osgprod_url/workscript.exit?exitcodes=$exitcodes&cluster=$CLUSTER&process=$PROCESS&project=$project&magic=$magic_words;" || error_exit $?
+    echo
+    exit 0
+}
+
 echo "Job $1.$2 is executing on" `hostname -f`
+[ $nslices -gt 1 ] && batch_exec
 echo -n "fetching new job slice workscript from osgprod server..."
 for retry in 0 1 2; do
     $curl -o workscript.bash "$osgprod_url/workscript.bash?cluster=$CLUSTER&process=$PROCESS&project=$project&cpus=$ncpus&magic=$magic_words;"
@@ -62,8 +181,13 @@ done
 echo "succeeded"
 
 echo -n "executing workscript..."
-./osg-container.sh ./workscript.bash >workscript.stdout 2>workscript.stderr
+./osg-container.sh ./workscript.bash >workscript.stdout 2>workscript.stderr &
+pids[0]=$!
+heartbeat 0 &
+heartpid=$!
+wait ${pids[0]}
 retcode=$?
+kill -- -$heartpid
 if [ $retcode = 139 ]; then
     echo -n "job segfaulted..."
     error_exit $retcode
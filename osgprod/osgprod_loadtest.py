@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+#
+# osgprod_loadtest.py - load generator that plays the part of thousands
+#                       of condor pilots against a local osgprod dispatcher.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# usage: osgprod_loadtest.py [options]
+#  Each simulated pilot follows the protocol of osgprod_exec.sh: it
+#  checks out a workscript for its cluster.process job, sleeps for a
+#  runtime drawn from a lognormal distribution in place of running it,
+#  sending a heartbeat every heartbeat interval along the way, and then
+#  reports its exit code. Up to -c pilots run at once, the way the slots
+#  of a condor pool fill up after a large submission, until -j jobs have
+#  been run. The pilots are spread over -S sites, each of them a /24
+#  subnet of the loopback network 127.0.0.0/8 that they send their
+#  requests from. The dispatcher is started locally against the scratch
+#  database of osgprod_bench.py, which is reseeded first, so never point
+#  this script at the production database. While the test runs, the
+#  database is sampled for backends that are waiting on a lock. At the
+#  end the latency percentiles and error counts of each kind of request
+#  are reported, together with the rate at which slices were claimed
+#  and the fraction of them that were chosen for data locality.
+
+import sys
+import math
+import time
+import random
+import asyncio
+import resource
+import threading
+import osgprod_db
+import osgprod_wsgi
+import osgprod_bench
+
+njobs = 10000
+concurrency = 1000
+runtime = 5.
+runtime_spread = 0.5
+heartbeat_interval = 600.
+failure_rate = 0.02
+request_timeout = 60.
+sample_interval = 0.5
+cluster = 2000
+nsites = 20
+server = "asgi"
+
+servers = {"wsgi": osgprod_bench.wsgi_server,
+           "asgi": osgprod_bench.asgi_server}
+
+latencies = {"checkout": [], "heartbeat": [], "exit": []}
+errors = {"checkout": 0, "heartbeat": 0, "exit": 0}
+error_messages = {}
+outcomes = {}
+claim_times = []
+
+lock_query = """SELECT COUNT(*) FILTER (WHERE wait_event_type = 'Lock'),
+                       COUNT(*) FILTER (WHERE state = 'active')
+                FROM pg_stat_activity
+                WHERE datname = current_database()
+                AND pid <> pg_backend_pid();
+             """
+locality_query = """SELECT COUNT(*) FILTER (WHERE local), COUNT(local)
+                    FROM jobs
+                    WHERE cluster = %s;
+                 """
+deadlock_query = """SELECT deadlocks
+                    FROM pg_stat_database
+                    WHERE datname = current_database();
+                 """
+
+def count(outcome):
+   outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+async def request(port, path, kind, **pars):
+   """
+   Sends one request of the given kind to the dispatcher on port and
+   records its latency, returns the text of the reply or None if the
+   request failed the way curl -f in osgprod_exec.sh would see it.
+   """
+   t0 = time.perf_counter()
+   try:
+      status, reply = await asyncio.wait_for(osgprod_bench.http_get(port, path,
+                                                                    **pars),
+                                             request_timeout)
+      if status != 200:
+         raise RuntimeError("http status " + str(status))
+   except Exception as err:
+      reply = None
+      errors[kind] += 1
+      message = kind + ": " + (str(err) or err.__class__.__name__)
+      error_messages[message] = error_messages.get(message, 0) + 1
+   latencies[kind].append(time.perf_counter() - t0)
+   return reply
+
+async def pilot(port, process):
+   """
+   Runs the life of job cluster.process as osgprod_exec.sh would.
+   """
+   pars = {"project": "bench", "cluster": cluster, "process": process,
+           "source_addr": "127.0.{0}.{1}".format(process % nsites + 1,
+                                                 process // nsites % 250 + 1)}
+   reply = await request(port, "/workscript.bash", "checkout",
+                         cpus=osgprod_bench.cpus, **pars)
+   if reply is None:
+      return
+   elif not reply.startswith("#!/bin/bash"):
+      count(reply.strip())
+      return
+   claim_times.append(time.time())
+   count("claimed")
+   seconds = random.lognormvariate(math.log(runtime), runtime_spread)
+   while seconds > heartbeat_interval:
+      await asyncio.sleep(heartbeat_interval)
+      seconds -= heartbeat_interval
+      reply = await request(port, "/workscript.heartbeat", "heartbeat",
+                            **pars)
+      if reply is not None and reply.startswith("Lease expired"):
+         count("lease expired")
+         return
+   await asyncio.sleep(seconds)
+   exitcode = 1 if random.random() < failure_rate else 0
+   reply = await request(port, "/workscript.exit", "exit",
+                         exitcode=exitcode, **pars)
+   if reply is not None:
+      count("exit " + reply.strip())
+
+async def storm(port):
+   """
+   Runs njobs pilots against the dispatcher on port, in concurrency
+   slots that each start the next job as soon as their last one ends.
+   """
+   jobs = iter(range(njobs))
+   async def slot():
+      for process in jobs:
+         await pilot(port, process)
+   await asyncio.gather(*[slot() for n in range(concurrency)])
+
+def sample_locks(stop, samples):
+   """
+   Appends the number of backends waiting on a lock and the number
+   of active backends to samples every sample_interval seconds, until
+   stop is set.
+   """
+   while not stop.wait(sample_interval):
+      try:
+         with osgprod_db.db_connection() as conn:
+            with conn.cursor() as curr:
+               curr.execute(lock_query)
+               samples.append(curr.fetchone())
+      except:
+         pass
+
+def locality():
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as curr:
+         curr.execute(locality_query, (cluster,))
+         return curr.fetchone()
+
+def deadlocks():
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as curr:
+         curr.execute(deadlock_query)
+         return curr.fetchone()[0]
+
+def peak_rate(times):
+   """
+   Returns the largest number of events in times that fall in any
+   one second of wall clock time.
+   """
+   seconds = {}
+   for t in times:
+      seconds[int(t)] = seconds.get(int(t), 0) + 1
+   return max(seconds.values()) if seconds else 0
+
+def usage():
+   print("Usage: osgprod_loadtest.py [options]")
+   print(" where options include any of the following:")
+   print("   -s <server> : postgres server host, default localhost")
+   print("   -d <dbname> : scratch database, default osgprod_bench")
+   print("   -m <dispatcher> : wsgi or asgi, default", server)
+   print("   -j <jobs> : number of jobs to run, default", njobs)
+   print("   -c <pilots> : pilots running at once, default", concurrency)
+   print("   -S <sites> : sites the pilots run at, default", nsites)
+   print("   -r <seconds> : median job runtime, default", runtime)
+   print("   -H <seconds> : heartbeat interval, default", heartbeat_interval)
+   print("   -x <fraction> : fraction of jobs that fail, default", failure_rate)
+   print("   -T <seconds> : request timeout, default", request_timeout)
+   print("   -f <files> : rawdata files to seed, default", osgprod_bench.nfiles)
+   print("   -b <blocks> : blocks per rawdata file, default",
+         osgprod_bench.nblocks)
+   sys.exit(1)
+
+argc = 1
+while argc < len(sys.argv):
+   if argc + 1 >= len(sys.argv):
+      usage()
+   opt = sys.argv[argc]
+   val = sys.argv[argc + 1]
+   if opt == "-s":
+      osgprod_bench.dbserver = val
+   elif opt == "-d":
+      osgprod_bench.dbname = val
+   elif opt == "-m" and val in servers:
+      server = val
+   elif opt == "-j":
+      njobs = int(val)
+   elif opt == "-c":
+      concurrency = int(val)
+   elif opt == "-S" and 0 < int(val) < 255:
+      nsites = int(val)
+   elif opt == "-r":
+      runtime = float(val)
+   elif opt == "-H":
+      heartbeat_interval = float(val)
+   elif opt == "-x":
+      failure_rate = float(val)
+   elif opt == "-T":
+      request_timeout = float(val)
+   elif opt == "-f":
+      osgprod_bench.nfiles = int(val)
+   elif opt == "-b":
+      osgprod_bench.nblocks = int(val)
+   else:
+      usage()
+   argc += 2
+
+for module in (osgprod_db, osgprod_wsgi):
+   module.dbserver = osgprod_bench.dbserver
+   module.dbname = osgprod_bench.dbname
+
+# every pilot in flight holds a socket open in this process and another
+# one in the dispatcher, which inherits the raised limit
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+if hard == resource.RLIM_INFINITY or hard > soft:
+   resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+osgprod_bench.seed()
+deadlocks0 = deadlocks()
+docroot = osgprod_bench.make_docroot()
+try:
+   proc, port = osgprod_bench.start_server(servers[server], docroot)
+   samples = []
+   stop = threading.Event()
+   sampler = threading.Thread(target=sample_locks, args=(stop, samples))
+   sampler.start()
+   try:
+      t0 = time.time()
+      asyncio.run(storm(port))
+      seconds = time.time() - t0
+   finally:
+      stop.set()
+      sampler.join()
+      proc.terminate()
+      proc.wait()
+finally:
+   osgprod_bench.shutil.rmtree(docroot)
+
+print("{0} jobs on {1} pilots against the {2} dispatcher in {3:.1f} s"
+      .format(njobs, concurrency, server, seconds))
+print("{0:10s} {1:>9s} {2:>8s} {3:>9s} {4:>9s} {5:>9s}"
+      .format("request", "count", "errors", "p50 ms", "p99 ms", "max ms"))
+for kind in ("checkout", "heartbeat", "exit"):
+   values = sorted(latencies[kind])
+   if values:
+      print("{0:10s} {1:9d} {2:8d} {3:9.2f} {4:9.2f} {5:9.2f}"
+            .format(kind, len(values), errors[kind],
+                    osgprod_bench.percentile(values, 0.5) * 1e3,
+                    osgprod_bench.percentile(values, 0.99) * 1e3,
+                    values[-1] * 1e3))
+for message in sorted(error_messages):
+   print("  error", message, "x", error_messages[message])
+for outcome in sorted(outcomes):
+   print("{0:40s} {1:9d}".format(outcome, outcomes[outcome]))
+if samples:
+   waiting = [sample[0] for sample in samples]
+   print("lock waits: {0:.1f}% of {1} samples, mean {2:.2f}, max {3} backends"
+         .format(100. * len([w for w in waiting if w > 0]) / len(waiting),
+                 len(waiting), sum(waiting) / len(waiting), max(waiting)) +
+         ", max {0} active".format(max([sample[1] for sample in samples])))
+print("deadlocks:", deadlocks() - deadlocks0)
+nlocal, nclaimed = locality()
+print("locality: {0} of {1} new slices from a file already read at the site"
+      .format(nlocal, nclaimed) +
+      (", {0:.1f}%".format(100. * nlocal / nclaimed) if nclaimed else ""))
+print("slices claimed: {0}, {1:.1f} per second, peak {2} per second"
+      .format(len(claim_times), len(claim_times) / seconds,
+              peak_rate(claim_times)))
+osgprod_db.db_close()
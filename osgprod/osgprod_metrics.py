@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# osgprod_metrics.py - in-process counters and latency histograms of
+#                      the osgprod work dispatcher, rendered for the
+#                      /metrics path in the Prometheus text format.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# Recording a request or a query costs one lock and a few additions,
+# so it is done on every request. Each dispatcher process keeps its
+# own values, which start from zero when the process starts, so a
+# scrape through Apache sees the mod_wsgi daemon process that happened
+# to answer it. Labels are given as tuples of (name, value) pairs.
+
+import os
+import time
+import bisect
+import threading
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1., 2.5, 5., 10., 30.)
+
+metric_help = {
+   "osgprod_requests_total":
+      ("counter", "Requests answered, by endpoint and http status."),
+   "osgprod_request_seconds":
+      ("histogram", "Time taken to answer a request, by endpoint."),
+   "osgprod_query_seconds":
+      ("histogram", "Time taken by a database statement, by query."),
+   "osgprod_query_errors_total":
+      ("counter", "Database statements that raised an error, by query."),
+   "osgprod_checkouts_total":
+      ("counter", "Tasks checked out, by the status of the checkout."),
+   "osgprod_slices_claimed_total":
+      ("counter", "New slices handed out, by whether chosen for locality."),
+   "osgprod_exits_total":
+      ("counter", "Exit reports of tasks, by result."),
+}
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+started = time.time()
+
+class Histogram:
+   """
+   Counts of the values observed that fall into each of buckets,
+   together with their number and sum.
+   """
+   def __init__(self, buckets=latency_buckets):
+      self.buckets = buckets
+      self.counts = [0] * (len(buckets) + 1)
+      self.total = 0.
+      self.count = 0
+
+   def observe(self, value):
+      self.counts[bisect.bisect_left(self.buckets, value)] += 1
+      self.total += value
+      self.count += 1
+
+def increment(name, labels=(), n=1):
+   """
+   Adds n to counter name with the given labels.
+   """
+   with lock:
+      series = counters.setdefault(name, {})
+      series[labels] = series.get(labels, 0) + n
+
+def observe(name, labels, value):
+   """
+   Records value in histogram name with the given labels.
+   """
+   with lock:
+      series = histograms.setdefault(name, {})
+      if labels not in series:
+         series[labels] = Histogram()
+      series[labels].observe(value)
+
+def observe_request(endpoint, status, seconds):
+   increment("osgprod_requests_total", (("endpoint", endpoint),
+                                        ("code", str(status))))
+   observe("osgprod_request_seconds", (("endpoint", endpoint),), seconds)
+
+def observe_query(query, seconds, failed=False):
+   observe("osgprod_query_seconds", (("query", query),), seconds)
+   if failed:
+      increment("osgprod_query_errors_total", (("query", query),))
+
+def format_labels(labels):
+   if not labels:
+      return ""
+   return "{" + ",".join([key + '="' + str(value).replace("\\", "\\\\")
+                                                  .replace('"', '\\"')
+                                                  .replace("\n", "\\n") + '"'
+                          for key, value in labels]) + "}"
+
+def format_value(value):
+   if isinstance(value, float):
+      return repr(value) if value == value else "NaN"
+   return str(value)
+
+def render(gauges=()):
+   """
+   Returns the text of a scrape, with the counters and histograms
+   recorded so far, the uptime and cpu time of the process, and the
+   samples in gauges, a list of (name, type, help, samples) where
+   samples is a list of (labels, value) collected by the caller.
+   """
+   lines = []
+   def header(name, kind, text):
+      lines.append("# HELP " + name + " " + text)
+      lines.append("# TYPE " + name + " " + kind)
+   with lock:
+      for name in sorted(counters):
+         kind, text = metric_help.get(name, ("counter", name))
+         header(name, kind, text)
+         for labels in sorted(counters[name]):
+            lines.append(name + format_labels(labels) + " " +
+                         format_value(counters[name][labels]))
+      for name in sorted(histograms):
+         kind, text = metric_help.get(name, ("histogram", name))
+         header(name, kind, text)
+         for labels in sorted(histograms[name]):
+            hist = histograms[name][labels]
+            cumulative = 0
+            for bound, count in zip(hist.buckets + ("+Inf",), hist.counts):
+               cumulative += count
+               lines.append(name + "_bucket" +
+                            format_labels(labels + (("le", bound),)) + " " +
+                            str(cumulative))
+            lines.append(name + "_sum" + format_labels(labels) + " " +
+                         format_value(hist.total))
+            lines.append(name + "_count" + format_labels(labels) + " " +
+                         str(hist.count))
+   header("osgprod_uptime_seconds", "gauge",
+          "Seconds since this dispatcher process started.")
+   lines.append("osgprod_uptime_seconds " + format_value(time.time() - started))
+   header("osgprod_process_cpu_seconds_total", "counter",
+          "Cpu seconds used by this dispatcher process.")
+   times = os.times()
+   lines.append("osgprod_process_cpu_seconds_total " +
+                format_value(times.user + times.system))
+   for name, kind, text, samples in gauges:
+      header(name, kind, text)
+      for labels, value in samples:
+         lines.append(name + format_labels(labels) + " " + format_value(value))
+   return "\n".join(lines) + "\n"
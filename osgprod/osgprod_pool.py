@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+#
+# osgprod_pool.py - thread-safe pool of connections to the osgprod
+#                   database, shared by the osgprod scripts.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# Each request checks a connection out of the pool for the duration
+# of a with block, as in
+#
+#   with pool.connection() as conn:
+#      with conn.cursor() as curr:
+#         ...
+#
+# which commits the transaction at the end of the block, or rolls it
+# back if an exception was raised, and then returns the connection to
+# the pool. Connections that have been idle for a while are checked
+# before they are handed out, and connections that fail are dropped
+# and replaced by new ones, so that a database restart does not leave
+# the process holding a dead connection.
+
+import time
+import threading
+import psycopg2
+
+class PoolTimeout(Exception):
+   """
+   Raised when no connection becomes free within the pool timeout.
+   """
+   pass
+
+class PooledConnection:
+   """
+   Context manager that checks out a connection from pool on entry
+   and returns it on exit, after committing or rolling back.
+   """
+   def __init__(self, pool):
+      self.pool = pool
+      self.conn = None
+
+   def __enter__(self):
+      self.conn = self.pool.getconn()
+      return self.conn
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      conn = self.conn
+      self.conn = None
+      broken = isinstance(exc_value, (psycopg2.OperationalError,
+                                      psycopg2.InterfaceError))
+      try:
+         if not conn.closed and not broken:
+            if exc_type is None:
+               conn.commit()
+            else:
+               conn.rollback()
+      except psycopg2.Error:
+         broken = True
+         if exc_type is None:
+            raise
+      finally:
+         self.pool.putconn(conn, broken)
+      return False
+
+class ConnectionPool:
+   """
+   Pool of up to maxconn connections to the database described by
+   the psycopg2.connect keyword arguments in dsn. A thread that asks
+   for a connection when all of them are in use waits for up to
+   timeout seconds for one to be returned. Idle connections older
+   than idle_check seconds are pinged before they are reused.
+   """
+   def __init__(self, maxconn=8, timeout=30, idle_check=60, **dsn):
+      self.dsn = dsn
+      self.maxconn = maxconn
+      self.timeout = timeout
+      self.idle_check = idle_check
+      self.idle = []
+      self.nconn = 0
+      self.lock = threading.Condition()
+      self.stats = {"checkouts": 0,
+                    "waits": 0,
+                    "wait_seconds": 0.,
+                    "connects": 0,
+                    "reconnects": 0,
+                    "discards": 0,
+                    "timeouts": 0}
+
+   def connection(self):
+      return PooledConnection(self)
+
+   def getconn(self):
+      """
+      Returns a healthy connection from the pool, opening a new one
+      if none are idle and the pool is not full, otherwise waiting.
+      """
+      t0 = time.time()
+      with self.lock:
+         waited = False
+         while not self.idle and self.nconn >= self.maxconn:
+            remaining = t0 + self.timeout - time.time()
+            if remaining <= 0:
+               self.stats["timeouts"] += 1
+               raise PoolTimeout("no database connection free after " +
+                                 "{0} s".format(self.timeout))
+            waited = True
+            self.lock.wait(remaining)
+         if waited:
+            self.stats["waits"] += 1
+            self.stats["wait_seconds"] += time.time() - t0
+         self.stats["checkouts"] += 1
+         if self.idle:
+            conn, last = self.idle.pop()
+         else:
+            conn, last = None, 0
+            self.nconn += 1
+      try:
+         if conn is None:
+            conn = self._connect("connects")
+         elif conn.closed or (time.time() - last > self.idle_check and
+                              not self._ping(conn)):
+            self._close(conn)
+            conn = self._connect("reconnects")
+      except:
+         with self.lock:
+            self.nconn -= 1
+            self.lock.notify()
+         raise
+      return conn
+
+   def putconn(self, conn, broken=False):
+      """
+      Returns conn to the pool, or closes it if it is broken.
+      """
+      if broken or conn.closed:
+         self._close(conn)
+         with self.lock:
+            self.nconn -= 1
+            self.stats["discards"] += 1
+            self.lock.notify()
+      else:
+         with self.lock:
+            self.idle.append((conn, time.time()))
+            self.lock.notify()
+
+   def closeall(self):
+      with self.lock:
+         idle = self.idle
+         self.idle = []
+         self.nconn -= len(idle)
+      for conn, last in idle:
+         self._close(conn)
+
+   def metrics(self):
+      """
+      Returns a dict with the current pool occupancy and the counters
+      of checkouts, waits for a free connection, and reconnections.
+      """
+      with self.lock:
+         metrics = dict(self.stats)
+         metrics["size"] = self.nconn
+         metrics["idle"] = len(self.idle)
+         metrics["in_use"] = self.nconn - len(self.idle)
+         metrics["max_size"] = self.maxconn
+      return metrics
+
+   def _connect(self, counter):
+      conn = psycopg2.connect(**self.dsn)
+      with self.lock:
+         self.stats[counter] += 1
+      return conn
+
+   def _ping(self, conn):
+      try:
+         with conn.cursor() as curr:
+            curr.execute("SELECT 1;")
+         conn.rollback()
+         return True
+      except psycopg2.Error:
+         return False
+
+   def _close(self, conn):
+      try:
+         conn.close()
+      except psycopg2.Error:
+         pass
+
+shared_pools = {}
+shared_pools_lock = threading.Lock()
+
+def shared_pool(maxconn=8, **dsn):
+   """
+   Returns the process-wide pool for the database described by dsn,
+   creating it on first use.
+   """
+   key = tuple(sorted(dsn.items()))
+   with shared_pools_lock:
+      if key not in shared_pools:
+         shared_pools[key] = ConnectionPool(maxconn, **dsn)
+      return shared_pools[key]
+
+def close_pools():
+   """
+   Closes the idle connections of all of the shared pools.
+   """
+   with shared_pools_lock:
+      pools = list(shared_pools.values())
+   for pool in pools:
+      pool.closeall()
+
+def shared_metrics():
+   """
+   Returns the metrics of all of the shared pools added together.
+   """
+   with shared_pools_lock:
+      pools = list(shared_pools.values())
+   totals = {}
+   for pool in pools:
+      for key, value in pool.metrics().items():
+         totals[key] = totals.get(key, 0) + value
+   return totals
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+#
+# osgprod_querybench.py - query plans and timings of the statements that
+#                         the osgprod scripts run in production, before
+#                         and after the indexes of osgprod_db.migrate.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+#
+# usage: osgprod_querybench.py [options]
+#  The scratch database (osgprod_bench by default) is dropped and
+#  seeded with a production-sized history: nfiles rawdata files of
+#  nblocks blocks, most of them already cut into slices that were
+#  processed by one job each, with the jobs spread over many sites and
+#  a few thousand of them still running, and bindings for most of the
+#  processed files. Each statement is then run under EXPLAIN ANALYZE
+#  in a transaction that is rolled back, first with only the primary
+#  keys and unique constraints in place and then after migrate(), and
+#  the median execution time is reported together with the scans that
+#  the planner chose. The statements that run inside the plpgsql
+#  functions are listed one by one, since EXPLAIN does not look inside
+#  a function call. Never point this script at the production database.
+
+import sys
+import json
+import time
+import osgprod_db
+import osgprod_wsgi
+import osgprod_bench
+
+nfiles = 10000
+nblocks = 1000
+slice_blocks = 8
+processed = 0.9
+bound = 0.8
+nrunning = 2000
+nsites = 200
+repeats = 5
+verbose = False
+
+# the statements of the osgprod scripts, with the arguments they are
+# given for one typical request; those from inside osgprod_checkout,
+# osgprod_reap and osgprod_fold_blockrates, and those of osgprod_bind
+# (which cannot be imported) are copied from there
+def statements(sample):
+   return [
+   ("checkout", osgprod_wsgi.checkout_query,
+    osgprod_wsgi.checkout_arguments({"cluster": 9999, "process": 1,
+                                     "cpus": 4}, sample["worker"],
+                                    sample["project"], 1)),
+   ("checkout job", """SELECT jobs.id, jobs.nstarts
+                       FROM jobs JOIN projects
+                       ON projects.id = jobs.project
+                       WHERE jobs.cluster = %s
+                       AND jobs.process = %s
+                       AND jobs.task = 0
+                       AND projects.projectname =
+                           (SELECT projectname FROM projects
+                            WHERE id = %s)
+                       AND jobs.endtime IS NULL
+                       AND jobs.exitcode IS NULL
+                       FOR UPDATE OF jobs;
+                    """, (sample["cluster"], sample["process"],
+                          sample["project"][0])),
+   ("checkout held slice", """SELECT * FROM slices
+                              WHERE ijob = %s
+                              LIMIT 1;
+                           """, (sample["job"],)),
+   ("checkout local slice", """SELECT free.*
+                               FROM (SELECT held.iraw,
+                                            MAX(near.starttime) AS started
+                                     FROM jobs AS near
+                                     JOIN slices AS held
+                                     ON held.ijob = near.id
+                                     WHERE near.site = %s
+                                     AND near.starttime >
+                                         TIMEZONE('GMT', NOW()) -
+                                         INTERVAL '6 hours'
+                                     GROUP BY held.iraw
+                                     ORDER BY started DESC
+                                     LIMIT 8) AS recent
+                               JOIN slices AS free
+                               ON free.iraw = recent.iraw
+                               WHERE free.ijob ISNULL
+                               ORDER BY recent.started DESC, free.block1
+                               LIMIT 1
+                               FOR UPDATE OF free SKIP LOCKED;
+                            """, (sample["site"],)),
+   ("checkout free slice", """SELECT * FROM slices
+                              WHERE ijob ISNULL
+                              ORDER BY id
+                              LIMIT 1
+                              FOR UPDATE SKIP LOCKED;
+                           """, None),
+   ("checkout blockrate", """SELECT nblocks / cpuseconds
+                             FROM blockrates
+                             WHERE run = %s
+                             AND site = %s;
+                          """, (sample["run"], sample["site"])),
+   ("heartbeat", osgprod_wsgi.heartbeat_query,
+    (osgprod_wsgi.lease_seconds, sample["worker"], sample["cluster"],
+     sample["process"], [0], "bench")),
+   ("exit", osgprod_wsgi.exit_query,
+    ([0], [0], sample["worker"], sample["cluster"], sample["process"],
+     "bench")),
+   ("reap", """SELECT slices.id, slices.ijob, slices.nstarts
+               FROM slices JOIN jobs
+               ON jobs.id = slices.ijob
+               WHERE jobs.endtime ISNULL
+               AND jobs.lease_expires < NOW()
+               FOR UPDATE OF slices, jobs SKIP LOCKED;
+            """, None),
+   ("fold", """SELECT rawdata.run, osgprod_site(jobs.worker), COUNT(*),
+                      SUM(slices.block2 - slices.block1),
+                      SUM(EXTRACT(EPOCH FROM jobs.endtime - jobs.starttime) *
+                          jobs.ncpus)
+               FROM jobs JOIN slices
+               ON slices.ijob = jobs.id
+               JOIN rawdata
+               ON rawdata.id = slices.iraw
+               WHERE jobs.endtime > TIMEZONE('GMT', NOW()) - INTERVAL '3 hours'
+               AND jobs.endtime <= TIMEZONE('GMT', NOW()) - INTERVAL '1 minute'
+               AND jobs.exitcode = 0
+               AND jobs.endtime > jobs.starttime
+               AND jobs.ncpus > 0
+               GROUP BY 1, 2;
+            """, None),
+   ("backlog", osgprod_wsgi.backlog_query, None),
+   ("projects", osgprod_wsgi.projects_query, None),
+   ("bind next", """SELECT rawdata.id,rawdata.run,rawdata.seqno,
+                           slices.block1,slices.block2,
+                           jobs.cluster,jobs.process,jobs.task
+                    FROM rawdata
+                    LEFT JOIN bindings
+                    ON bindings.iraw = rawdata.id
+                    INNER JOIN slices
+                    ON slices.iraw = rawdata.id
+                    LEFT JOIN jobs
+                    ON slices.ijob = jobs.id
+                    AND jobs.exitcode = 0
+                    WHERE bindings.id IS NULL
+                    ORDER BY rawdata.id,slices.block1
+                    LIMIT 2000;
+                 """, None),
+   ("bind file", """SELECT rawdata.id,rawdata.run,rawdata.seqno,
+                           slices.block1,slices.block2,
+                           jobs.cluster,jobs.process,jobs.task
+                    FROM rawdata
+                    JOIN slices
+                    ON slices.iraw = rawdata.id
+                    JOIN jobs
+                    ON slices.ijob = jobs.id
+                    AND jobs.exitcode = 0
+                    WHERE rawdata.id = %s
+                    ORDER BY rawdata.id,slices.block1;
+                 """, (sample["iraw"],)),
+   ("recycle slice", """UPDATE slices
+                        SET ijob = NULL
+                        WHERE iraw = %s
+                        AND block1 = %s
+                        AND block2 = %s;
+                     """, (sample["iraw"], sample["block1"],
+                           sample["block2"])),
+   ]
+
+def populate(iproject):
+   """
+   Fills the scratch database with the history described at the top,
+   on top of the rawdata rows that osgprod_bench.insert_rawdata made.
+   """
+   nslices = (nblocks + slice_blocks - 1) // slice_blocks
+   ndone = int(nfiles * processed)
+   njobs = ndone * nslices
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("""INSERT INTO jobs (project, script, worker,
+                                            cluster, process, ncpus,
+                                            nstarts, starttime, endtime,
+                                            exitcode, task, lease_expires,
+                                            site, local)
+                           SELECT %s, %s, worker, 5000 + n / 10000,
+                                  n %% 10000, 4, 1, started,
+                                  CASE WHEN n >= %s THEN NULL
+                                       ELSE started + INTERVAL '3 hours' END,
+                                  CASE WHEN n >= %s THEN NULL
+                                       WHEN n %% 50 = 0 THEN 1
+                                       ELSE 0 END,
+                                  0,
+                                  CASE WHEN n >= %s THEN
+                                     started + INTERVAL '1 hour' END,
+                                  osgprod_site(worker), n %% 10 > 0
+                           FROM generate_series(0, %s) AS n,
+                           LATERAL (SELECT '10.' || (n %% %s) || '.' ||
+                                           (n / %s %% 250) || '.7' AS worker,
+                                           TIMEZONE('GMT', NOW()) -
+                                           (%s - n) * INTERVAL '10 seconds' -
+                                           INTERVAL '3 hours' AS started)
+                                   AS w;
+                        """, (iproject, osgprod_bench.workscript,
+                              njobs - nrunning, njobs - nrunning,
+                              njobs - nrunning, njobs - 1, nsites, nsites,
+                              njobs))
+         cursor.execute("""INSERT INTO slices (ijob, iraw, block1, block2)
+                           SELECT CASE WHEN rawdata.id <= %s
+                                       THEN (rawdata.id - 1) * %s + k + 1
+                                  END,
+                                  rawdata.id, 1 + k * %s,
+                                  LEAST(1 + (k + 1) * %s, rawdata.nblocks + 1)
+                           FROM rawdata,
+                           LATERAL generate_series(0, %s) AS k
+                           WHERE rawdata.id <= %s
+                           OR k = 0;
+                        """, (ndone, nslices, slice_blocks, slice_blocks,
+                              nslices - 1, ndone))
+         cursor.execute("""UPDATE slices SET block2 = rawdata.nblocks + 1
+                           FROM rawdata
+                           WHERE rawdata.id = slices.iraw
+                           AND slices.ijob ISNULL;
+                        """)
+         cursor.execute("""INSERT INTO bindings (iraw, starttime, endtime,
+                                                exitcode, details)
+                           SELECT id, NOW(), NOW(), 0, ''
+                           FROM rawdata
+                           WHERE id <= %s;
+                        """, (int(nfiles * bound),))
+   osgprod_db.fold_blockrates(rebuild=True)
+
+def pick_sample(iproject):
+   """
+   Returns the arguments for the statements, taken from a running
+   job in the middle of the seeded history.
+   """
+   with osgprod_db.db_connection() as conn:
+      with conn.cursor() as cursor:
+         cursor.execute("""SELECT jobs.id, jobs.worker, jobs.cluster,
+                                  jobs.process, jobs.site, rawdata.run,
+                                  slices.iraw, slices.block1, slices.block2
+                           FROM jobs JOIN slices
+                           ON slices.ijob = jobs.id
+                           JOIN rawdata
+                           ON rawdata.id = slices.iraw
+                           WHERE jobs.endtime ISNULL
+                           ORDER BY jobs.id
+                           LIMIT 1;
+                        """)
+         row = cursor.fetchone()
+   keys = ("job", "worker", "cluster", "process", "site", "run", "iraw",
+           "block1", "block2")
+   sample = dict(zip(keys, row))
+   sample["project"] = osgprod_wsgi.lookup_project("bench", row[1])
+   return sample
+
+def scans(plan):
+   """
+   Returns the list of the scan nodes in plan, each as its type and
+   the relation or index that it reads.
+   """
+   found = []
+   if "Scan" in plan["Node Type"]:
+      found.append(plan["Node Type"] + " " + plan.get("Index Name",
+                                         plan.get("Relation Name",
+                                         plan.get("Function Name", ""))))
+   for child in plan.get("Plans", []):
+      found += scans(child)
+   return found
+
+def explain(query, args):
+   """
+   Runs query with args under EXPLAIN ANALYZE repeats times, each time
+   rolled back, and returns the median execution time in ms, the
+   scans of the plan, and the plan in text form.
+   """
+   times = []
+   for n in range(repeats):
+      with osgprod_db.db_connection() as conn:
+         with conn.cursor() as cursor:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query,
+                           args)
+            result = cursor.fetchone()[0]
+            if isinstance(result, str):
+               result = json.loads(result)
+            times.append(result[0]["Execution Time"])
+            plan = result[0]["Plan"]
+            if n == repeats - 1 and verbose:
+               cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, args)
+               text = "\n".join([row[0] for row in cursor.fetchall()])
+            else:
+               text = ""
+         conn.rollback()
+   return sorted(times)[len(times) // 2], scans(plan), text
+
+def measure(sample):
+   results = {}
+   for name, query, args in statements(sample):
+      results[name] = explain(query, args)
+   return results
+
+def usage():
+   print("Usage: osgprod_querybench.py [options]")
+   print(" where options include any of the following:")
+   print("   -s <server> : postgres server host, default localhost")
+   print("   -d <dbname> : scratch database, default osgprod_bench")
+   print("   -f <files> : rawdata files to seed, default", nfiles)
+   print("   -b <blocks> : blocks per rawdata file, default", nblocks)
+   print("   -r <repeats> : runs of each statement, default", repeats)
+   print("   -v yes : print the full plans after migration")
+   sys.exit(1)
+
+argc = 1
+while argc < len(sys.argv):
+   if argc + 1 >= len(sys.argv):
+      usage()
+   opt = sys.argv[argc]
+   val = sys.argv[argc + 1]
+   if opt == "-s":
+      osgprod_bench.dbserver = val
+   elif opt == "-d":
+      osgprod_bench.dbname = val
+   elif opt == "-f":
+      nfiles = int(val)
+   elif opt == "-b":
+      nblocks = int(val)
+   elif opt == "-r" and int(val) > 0:
+      repeats = int(val)
+   elif opt == "-v":
+      verbose = val in ("yes", "y", "1")
+   else:
+      usage()
+   argc += 2
+
+for module in (osgprod_db, osgprod_wsgi):
+   module.dbserver = osgprod_bench.dbserver
+   module.dbname = osgprod_bench.dbname
+osgprod_bench.nfiles = nfiles
+osgprod_bench.nblocks = nblocks
+
+t0 = time.time()
+iproject = osgprod_bench.create_schema()
+osgprod_bench.insert_rawdata()
+osgprod_db.migrate(1)
+populate(iproject)
+with osgprod_db.db_connection() as conn:
+   with conn.cursor() as cursor:
+      cursor.execute("ANALYZE;")
+      cursor.execute("""SELECT (SELECT COUNT(*) FROM rawdata),
+                               (SELECT COUNT(*) FROM slices),
+                               (SELECT COUNT(*) FROM jobs),
+                               (SELECT COUNT(*) FROM bindings);
+                     """)
+      counts = cursor.fetchone()
+print("seeded {0} rawdata, {1} slices, {2} jobs, {3} bindings in {4:.1f} s"
+      .format(*(counts + (time.time() - t0,))))
+sample = pick_sample(iproject)
+before = measure(sample)
+t0 = time.time()
+osgprod_db.migrate()
+print("migrated to schema version {0} in {1:.1f} s"
+      .format(osgprod_db.schema_version(), time.time() - t0))
+after = measure(sample)
+
+print("{0:22s} {1:>10s} {2:>10s}  {3}"
+      .format("statement", "before ms", "after ms", "scans before -> after"))
+for name, query, args in statements(sample):
+   print("{0:22s} {1:10.3f} {2:10.3f}  {3} -> {4}"
+         .format(name, before[name][0], after[name][0],
+                 ", ".join(before[name][1]) or "-",
+                 ", ".join(after[name][1]) or "-"))
+if verbose:
+   for name, query, args in statements(sample):
+      print("\n" + name + ":\n" + after[name][2])
+osgprod_db.db_close()
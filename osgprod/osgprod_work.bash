@@ -16,17 +16,40 @@
 
 # Entry here should be inside a fresh container instance
 
-# Input rawdata file list goes here, as in
-#input_eviofile_list="root://xrootd.server.dns/path/to/file.evio ..."
+# Input rawdata file and the range of blocks to read from it go here, as in
+#input_eviofile_range="root://xrootd.server.dns/path/to/file.evio first,last"
+# which stands for the list of urls file.evio+b,b+1 for blocks b from first
+# up to but not including last; the dispatcher may instead give the list
+# itself in input_eviofile_list
 
 # Output filename goes here, as in
 #output_filename="file.evio"
 
+function input_list() {
+    if [ -n "$input_eviofile_range" ]; then
+        set -- $input_eviofile_range
+        block=${2%,*}
+        while [ $block -lt ${2#*,} ]; do
+            echo "$1+$block,$(( block + 1 ))"
+            block=$(( block + 1 ))
+        done
+    else
+        echo $input_eviofile_list
+    fi
+}
+
 function staging() {
     n=0
-    for remote_input in $input_eviofile_list; do
+    for remote_input in `input_list`; do
         echo "staging loop: fetching $remote_input"
-        cat $remote_input >staging.evio
+        case $remote_input in
+            http://*|https://*)
+                curl -s -f -o staging.evio "$remote_input"
+                ;;
+            *)
+                cat $remote_input >staging.evio
+                ;;
+        esac
         echo -n "staging loop: waiting..."
         [ $n -gt 0 ] && cat /dev/null >waitout
         echo "injecting into input sequence"
@@ -52,7 +75,7 @@ function safe_exit() {
 
 n=0
 local_input_list=""
-for rawdata in $input_eviofile_list; do
+for rawdata in `input_list`; do
     local_input_list="$local_input_list waitin $output_filename waitout"
     n=`expr $n + 1`
 done   
@@ -7,17 +7,94 @@
 # version: november 16, 2020
 #
 
+import os
 import re
 import sys
-import psycopg2
+import gzip
+import time
+import hashlib
+import ipaddress
+import threading
+
+# mod_wsgi does not put the directory of this script on the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import osgprod_pool
+import osgprod_metrics
 
 dbserver = "cn445.storrs.hpc.uconn.edu"
 dbname = "osgprod"
 dbuser = "gluex"
 dbpass = "slicing+dicing"
+dbpool_size = 16
 magic_words = "good+curry"
 documentroot = "/var/www/html"
 
+# largest number of slices handed out by one /workscript.batch request
+max_batch_count = 64
+
+# a slice goes back to the pool if its job has not sent a heartbeat
+# for lease_seconds, which is checked every reap_interval seconds by
+# one of the dispatcher processes, the one holding advisory lock
+# reap_lock_key on the database at the time
+lease_seconds = 3600
+reap_interval = 120
+reap_lock_key = 0x6f736770
+reaper = None
+reaper_lock = threading.Lock()
+
+# a slice is handed out at most max_starts times, counting both restarts
+# of its job and reissues by the reaper, after which its job is marked
+# failed with exit code -1 and the slice is left for recycle_slices
+max_starts = 5
+
+# new slices are sized to run for about target_walltime seconds, from
+# the seconds per block measured for their run at the site of the
+# worker, which the same process folds in from the finished jobs under
+# advisory lock fold_lock_key; 0 keeps the fixed maxblockspercore size
+target_walltime = 4 * 3600
+fold_lock_key = 0x6f736771
+
+# a new slice is taken if possible from a raw file that other jobs at
+# the same site started on within the last locality_window seconds, 0
+# to hand out slices in id order only
+locality_window = 6 * 3600
+
+# header lines of the workscript template that are filled in per job
+template_slots = [("# project:", "project"),
+                  ("# cluster:", "cluster"),
+                  ("# process:", "process"),
+                  ("# nstarts:", "nstarts"),
+                  ("# ncpus:", "cpus"),
+                  ("# source:", "workscript"),
+                  ("# started:", "started")]
+template_inpat = re.compile("#input_eviofile_list=\"root://xrootd.server.dns"
+                            + "/path/to/file.evio ...\"")
+template_rangepat = re.compile("#input_eviofile_range=\"root://xrootd.server.dns"
+                               + "/path/to/file.evio first,last\"")
+template_outpat = re.compile("#output_filename=\"file.evio\"")
+
+templates = {}
+templates_lock = threading.Lock()
+
+# rows of the projects table are cached for this many seconds, and
+# reloaded early when a client matches no project, but not more often
+# than every project_cache_retry seconds
+project_cache_ttl = 60
+project_cache_retry = 5
+project_table = (None, 0)
+project_table_lock = threading.Lock()
+
+# the number of unassigned slices and blocks reported by /metrics is
+# counted by the reaper thread every backlog_interval seconds, so that
+# scrapes are answered from the last count without touching the database
+backlog_interval = 60
+backlog = (None, 0)
+
+# replies of at least gzip_min_length bytes are sent compressed to
+# clients that accept gzip
+gzip_min_length = 1024
+gzip_level = 6
+
 def query_parameters(query):
    """
    Scan the query string for url-encoded parameters passed
@@ -31,224 +108,587 @@ def query_parameters(query):
          pars[key] = val
    return pars
 
-def db_connection():
+def run_query(curr, name, query, args=None):
    """
-   Returns a persistent connection to the osgprod database.
+   Executes query with args on cursor curr and returns the rows,
+   recording the time it took in the metrics of the query name.
    """
-   global dbconnection
+   t0 = time.perf_counter()
    try:
-      conn = dbconnection
+      curr.execute(query, args)
+      rows = curr.fetchall()
    except:
-      dbconnection = psycopg2.connect(user = dbuser,
-                                      password = dbpass,
-                                      host = dbserver,
-                                      port = "5432",
-                                      database = dbname)
-      conn = dbconnection
-   return conn
+      osgprod_metrics.observe_query(name, time.perf_counter() - t0, True)
+      raise
+   osgprod_metrics.observe_query(name, time.perf_counter() - t0)
+   return rows
+
+def db_connection():
+   """
+   Returns a context manager that checks out a connection to the
+   osgprod database from the shared pool for the duration of a with
+   block, committing at the end or rolling back on an exception.
+   """
+   return osgprod_pool.shared_pool(dbpool_size,
+                                   user = dbuser,
+                                   password = dbpass,
+                                   host = dbserver,
+                                   port = "5432",
+                                   database = dbname).connection()
 
-def checkout_workscript(environ, output):
+def compile_template(path):
+   """
+   Parses the workscript template at path into a render plan, which
+   is a format string with the literal text of the template and named
+   slots for the per-job header values, the input file list or range
+   and the output filename.
+   """
+   plan = []
+   with open(path) as template:
+      lines = template.readlines()
+   for line in lines:
+      for prefix, slot in template_slots:
+         if line.startswith(prefix):
+            line = prefix + " {" + slot + "}\n"
+            break
+      else:
+         line = line.replace("{", "{{").replace("}", "}}")
+      plan.append(line)
+      if template_inpat.match(line):
+         plan.append("input_eviofile_list=\"\\\n{inputs}\"\n")
+      elif template_rangepat.match(line):
+         plan.append("input_eviofile_range=\"{inputrange}\"\n")
+      elif template_outpat.match(line):
+         plan.append("output_filename=\"{outputfile}\"\n")
+   return "".join(plan)
+
+def lookup_template(path):
+   """
+   Returns the render plan for the workscript template at path,
+   compiled on first use and again whenever the file is modified.
+   """
+   mtime = os.stat(path).st_mtime_ns
+   with templates_lock:
+      cached = templates.get(path)
+   if cached and cached[0] == mtime:
+      return cached[1]
+   plan = compile_template(path)
+   with templates_lock:
+      templates[path] = (mtime, plan)
+   return plan
+
+projects_query = """SELECT id, projectname, workersubnet,
+                           workscript, xrootdprefix,
+                           maxblockspercore
+                    FROM projects
+                    ORDER BY id;
+                 """
+
+def subnet_networks(pattern):
+   """
+   Converts the workersubnet of a project to a list of ipaddress
+   networks, accepting CIDR notation, a single address, or a LIKE
+   pattern of the form 10.1.% as has been used up to now. Returns
+   None for patterns that are none of these.
+   """
+   try:
+      if pattern == "%":
+         return [ipaddress.ip_network("0.0.0.0/0"),
+                 ipaddress.ip_network("::/0")]
+      elif pattern.endswith(".%"):
+         octets = pattern[:-2].split(".")
+         if len(octets) > 3 or not all([octet.isdigit() for octet in octets]):
+            return None
+         octets += ["0"] * (4 - len(octets))
+         return [ipaddress.ip_network("{0}/{1}".format(".".join(octets),
+                                      8 * len(pattern[:-2].split("."))))]
+      return [ipaddress.ip_network(pattern, strict=False)]
+   except ValueError:
+      return None
+
+def build_project_table(rows):
+   """
+   Builds the lookup structure for resolving a project name and client
+   address to a projects row. For each project name and ip version it
+   holds a list of (prefixlen, {network: row}) with the longest prefix
+   first, so that a lookup is one dict probe per distinct prefix length.
+   Subnet patterns that are not networks are kept as regular expressions
+   with the LIKE semantics, and tried last.
+   """
+   table = {}
+   for row in rows:
+      entry = table.setdefault(row[1], {4: {}, 6: {}, "like": []})
+      networks = subnet_networks(row[2])
+      if networks is None:
+         regex = "".join([".*" if c == "%" else "." if c == "_" else
+                          re.escape(c) for c in row[2]])
+         entry["like"].append((re.compile(regex + "$"), row))
+         continue
+      for net in networks:
+         prefixes = entry[net.version].setdefault(net.prefixlen, {})
+         key = int(net.network_address) >> (net.max_prefixlen - net.prefixlen)
+         prefixes.setdefault(key, row)
+   for entry in table.values():
+      for version in (4, 6):
+         entry[version] = sorted(entry[version].items(), reverse=True)
+   return table
+
+def match_project(entry, client):
+   addr = ipaddress.ip_address(client)
+   if addr.version == 6 and addr.ipv4_mapped:
+      addr = addr.ipv4_mapped
+   value = int(addr)
+   for prefixlen, prefixes in entry[addr.version]:
+      row = prefixes.get(value >> (addr.max_prefixlen - prefixlen))
+      if row:
+         return row
+   for regex, row in entry["like"]:
+      if regex.match(client):
+         return row
+   return None
+
+def load_project_table(wait):
+   """
+   Reloads the projects table into project_table, unless another thread
+   is already doing so and wait is False.
+   """
+   global project_table
+   if not project_table_lock.acquire(wait):
+      return
+   try:
+      with db_connection() as conn:
+         with conn.cursor() as curr:
+            rows = run_query(curr, "projects", projects_query)
+      project_table = (build_project_table(rows), time.time())
+   finally:
+      project_table_lock.release()
+
+def lookup_project(project, client):
+   """
+   Returns the projects row for project whose workersubnet contains
+   the client address, taken from the in-process cache of the table.
+   """
+   table, loaded = project_table
+   if table is None or time.time() - loaded > project_cache_ttl:
+      load_project_table(table is None)
+      table, loaded = project_table
+   row = None
+   if project in table:
+      row = match_project(table[project], client)
+   if row is None and time.time() - loaded > project_cache_retry:
+      load_project_table(True)
+      table, loaded = project_table
+      if project in table:
+         row = match_project(table[project], client)
+   if row is None:
+      raise LookupError("no project " + project + " for " + client)
+   return row
+
+# the statements issued by the dispatcher, shared with osgprod_asgi
+checkout_query = """SELECT tasks.task, checkout.*
+                    FROM generate_series(0, %s) AS tasks(task),
+                    LATERAL osgprod_checkout(%s, %s, %s, %s, %s, %s, %s,
+                                             tasks.task, %s, %s, %s, %s)
+                            AS checkout
+                    ORDER BY tasks.task;
+                 """
+exit_query = """UPDATE jobs SET
+                endtime = TIMEZONE('GMT', NOW()),
+                exitcode = exits.exitcode
+                FROM projects,
+                     unnest(%s::INT[], %s::INT[])
+                     AS exits(task, exitcode)
+                WHERE projects.id = jobs.project
+                AND jobs.worker = %s
+                AND jobs.cluster = %s
+                AND jobs.process = %s
+                AND jobs.task = exits.task
+                AND projects.projectname = %s
+                AND jobs.endtime ISNULL
+                AND jobs.exitcode ISNULL
+                RETURNING jobs.id;
+             """
+heartbeat_query = """UPDATE jobs SET
+                     lease_expires = NOW() + %s * INTERVAL '1 second'
+                     FROM projects
+                     WHERE projects.id = jobs.project
+                     AND jobs.worker = %s
+                     AND jobs.cluster = %s
+                     AND jobs.process = %s
+                     AND jobs.task = ANY(%s)
+                     AND projects.projectname = %s
+                     AND jobs.endtime ISNULL
+                     RETURNING jobs.task,
+                               EXISTS (SELECT 1 FROM slices
+                                       WHERE slices.ijob = jobs.id);
+                  """
+backlog_query = """SELECT COUNT(*), COALESCE(SUM(block2 - block1), 0)
+                   FROM slices
+                   WHERE ijob ISNULL;
+                """
+reap_query = """SELECT CASE WHEN pg_try_advisory_xact_lock(%s)
+                            THEN osgprod_reap(%s)
+                            ELSE 0 END;
+             """
+fold_query = """SELECT CASE WHEN pg_try_advisory_xact_lock(%s)
+                            THEN osgprod_fold_blockrates()
+                            ELSE 0 END;
+             """
+
+def checkout_arguments(pars, client, row, count):
+   """
+   Returns the arguments of checkout_query for a request with
+   parameters pars from client for count slices, given the projects
+   row of the project. Tasks 0..count-1 of the job are claimed, each
+   one with the job and the slice of work that goes with it, split
+   off from the next unassigned slice if it does not have one already.
+   """
+   cpus = int(pars["cpus"])
+   return (count - 1, int(row[0]), row[3], client, pars["cluster"],
+           pars["process"], cpus, int(row[5]) * cpus, lease_seconds,
+           target_walltime, locality_window, max_starts)
+
+def render_workscript(plan, project, cluster, process, cpus, workscript,
+                      xrootdprefix, claim):
+   """
+   Returns the text of the workscript for the slice in claim, a row
+   returned by checkout_query. Templates with an input_eviofile_range
+   line get the file and its range of blocks, which the workscript
+   expands itself, older ones the full list of one url per block.
+   """
+   task, status, ijob, nstarts, now, iraw, block1, lastblock, rawpath = claim[:9]
+   xrootdpath = re.sub(r"^/dcache", xrootdprefix, rawpath)
+   inputrange = "{0} {1},{2}".format(xrootdpath, block1, lastblock)
+   inputs = ""
+   if "{inputs}" in plan:
+      inputs = "".join([xrootdpath + "+{0},{1} \\\n".format(block, block + 1)
+                        for block in range(block1, lastblock)])
+   outputfile = re.sub(r"^.*/([^/]*).evio", r"\1", rawpath)
+   outputfile += "+{0},{1}.evio".format(block1, lastblock)
+   return plan.format(project=project, cluster=cluster, process=process,
+                      nstarts=nstarts, cpus=cpus, workscript=workscript,
+                      started=now, inputs=inputs, inputrange=inputrange,
+                      outputfile=outputfile)
+
+def count_claims(claims):
+   """
+   Adds the rows claims returned by checkout_query to the metrics, by
+   their status, and the new slices among them by whether they were
+   chosen for locality.
+   """
+   for claim in claims:
+      osgprod_metrics.increment("osgprod_checkouts_total",
+                                (("status", claim[1]),))
+      if claim[1] == "ok" and claim[9] is not None:
+         osgprod_metrics.increment("osgprod_slices_claimed_total",
+                                   (("locality", "local" if claim[9]
+                                                 else "global"),))
+
+def template_path(pars, row):
+   return documentroot + "/" + pars["project"] + "/" + row[3]
+
+def checkout_reply(pars, row, claims, bundle, plan=None):
+   """
+   Returns the reply to a checkout with parameters pars for the rows
+   claims returned by checkout_query, either the workscript of the one
+   slice, or if bundle is True a bundle script that writes the
+   workscript of task n to workscript_n.bash when it is run. Tasks
+   that already completed are left out of the bundle, and so are tasks
+   whose slice failed too many times. The workscript template is looked
+   up unless its render plan is given in plan.
+   """
+   if all([claim[1] in ("completed", "failed") for claim in claims]):
+      if any([claim[1] == "failed" for claim in claims]):
+         return "echo Slice failed too many times, quitting."
+      return "echo Job already completed, quitting."
+   claims = [claim for claim in claims if claim[1] == "ok"]
+   if len(claims) == 0:
+      return "echo No work left to do, quitting."
+
+   project = pars["project"]
+   cluster = pars["cluster"]
+   process = pars["process"]
+   cpus = int(pars["cpus"])
+   if plan is None:
+      plan = lookup_template(template_path(pars, row))
+   if not bundle:
+      return render_workscript(plan, project, cluster, process, cpus,
+                               row[3], row[4], claims[0])
+   reply = ["#!/bin/bash\n"]
+   reply.append("# osgprod workscript bundle for job {0}.{1}, {2} slices\n"
+                .format(cluster, process, len(claims)))
+   for claim in claims:
+      reply.append("cat >workscript_{0}.bash <<'EOF_workscript_{0}'\n"
+                   .format(claim[0]))
+      reply.append(render_workscript(plan, project, cluster, process, cpus,
+                                     row[3], row[4], claim))
+      reply.append("EOF_workscript_{0}\n".format(claim[0]))
+   return "".join(reply)
+
+def batch_count(pars):
+   count = int(pars["count"])
+   if count < 1 or count > max_batch_count:
+      raise ValueError("batch count out of range")
+   return count
+
+def exit_arguments(pars, client):
+   """
+   Returns the arguments of exit_query for a request with parameters
+   pars from client, which carries either exitcode for task 0 or
+   exitcodes=t:c,... with the exit codes c of several tasks t.
+   """
+   if "exitcodes" in pars:
+      tasks = []
+      exitcodes = []
+      for taskcode in pars["exitcodes"].split(","):
+         task, exitcode = taskcode.split(":")
+         tasks.append(int(task))
+         exitcodes.append(int(exitcode))
+   else:
+      tasks = [0]
+      exitcodes = [int(pars["exitcode"])]
+   return (tasks, exitcodes, client, pars["cluster"], pars["process"],
+           pars["project"])
+
+def count_exits(args, rows):
+   """
+   Adds the exit codes in args, the arguments of exit_query, to the
+   metrics, or as unknown if exit_query matched no job.
+   """
+   if len(rows) == 0:
+      osgprod_metrics.increment("osgprod_exits_total",
+                                (("result", "unknown"),), len(args[1]))
+      return
+   for exitcode in args[1]:
+      osgprod_metrics.increment("osgprod_exits_total",
+                                (("result", "ok" if exitcode == 0
+                                            else "failed"),))
+
+def exit_reply(rows):
+   return "Got it." if len(rows) > 0 else "Never heard of you."
+
+def heartbeat_arguments(pars, client):
+   tasks = [int(task) for task in pars.get("tasks", "0").split(",")]
+   return (lease_seconds, client, pars["cluster"], pars["process"], tasks,
+           pars["project"])
+
+def heartbeat_reply(rows):
+   """
+   Returns the reply to a heartbeat, which lists the tasks whose slices
+   were already taken back by the reaper so that the job can stop
+   working on them.
+   """
+   if len(rows) == 0:
+      return "Never heard of you."
+   elif all([row[1] for row in rows]):
+      return "Got it."
+   expired = sorted([row[0] for row in rows if not row[1]])
+   return "Lease expired: " + ",".join([str(task) for task in expired])
+
+def checkout_workscript(environ, output, bundle=False):
    """
    Checks out the next slice of work from the osgprod
    database and returns a job workscript for a new slice.
    """
    pars = query_parameters(environ["QUERY_STRING"])
    client = environ["REMOTE_ADDR"]
-   cluster = pars["cluster"]
-   process = pars["process"]
-   project = pars["project"]
-   cpus = int(pars["cpus"])
-   xrootdprefix = ""
-   workersubnet = ""
-   workscript = ""
-   maxblockspercore = 1
-   
+   count = batch_count(pars) if bundle else 1
+   row = lookup_project(pars["project"], client)
    with db_connection() as conn:
       with conn.cursor() as curr:
-         curr.execute("""SELECT id, projectname, workersubnet,
-                                workscript, xrootdprefix,
-                                maxblockspercore
-                         FROM projects
-                         WHERE %s = projectname
-                         AND %s LIKE workersubnet;
-                      """, (project, client))
-         row = curr.fetchone()
-         iproject = int(row[0])
-         xrootdprefix = row[4]
-         workscript = row[3]
-         workscriptpath = documentroot + "/" + project + "/" + row[3]
-         maxblockspercore = int(row[5])
-   
-         curr.execute("""SELECT jobs.id, jobs.cluster, jobs.process,
-                                jobs.nstarts, projects.projectname
-                         FROM jobs LEFT JOIN projects
-                         ON projects.id = jobs.project
-                         WHERE jobs.cluster = %s
-                         AND jobs.process = %s
-                         AND projects.projectname = %s
-                         AND jobs.endtime IS NOT NULL
-                         AND jobs.exitcode IS NOT NULL
-                         FOR UPDATE OF jobs;
-                      """, (cluster, process, project))
-         if curr.fetchone():
-            output.append("echo Job already completed, quitting.")
-            return "200 OK"
-         curr.execute("""SELECT jobs.id, jobs.cluster, jobs.process,
-                                jobs.nstarts, projects.projectname
-                         FROM jobs LEFT JOIN projects
-                         ON projects.id = jobs.project
-                         WHERE jobs.cluster = %s
-                         AND jobs.process = %s
-                         AND projects.projectname = %s
-                         AND jobs.endtime IS NULL
-                         AND jobs.exitcode IS NULL
-                         FOR UPDATE OF jobs;
-                      """, (cluster, process, project))
-         row = curr.fetchone()
-         if row:
-            ijob = int(row[0])
-            nstarts = int(row[3])
-         else:
-            curr.execute("""INSERT INTO jobs 
-                            (project, cluster, process)
-                            VALUES (%s, %s, %s)
-                            RETURNING id;
-                         """, (iproject, cluster, process))
-            row = curr.fetchone()
-            ijob = int(row[0])
-            nstarts = 0
-         curr.execute("SELECT TIMEZONE('GMT', NOW());")
-         now = curr.fetchone()[0]
-         nstarts += 1
-         curr.execute("""UPDATE jobs SET script = %s,
-                                         worker = %s,
-                                         ncpus = %s,
-                                         nstarts = %s,
-                                         starttime = %s
-                         WHERE id = %s;
-                      """, (workscript, client, cpus, nstarts, now, ijob))
+         claims = run_query(curr, "checkout", checkout_query,
+                            checkout_arguments(pars, client, row, count))
+   count_claims(claims)
+   output.append(checkout_reply(pars, row, claims, bundle))
+   return "200 OK"
 
+def checkout_batch(environ, output):
+   """
+   Checks out up to count slices of work for one job in a single
+   transaction, and returns them as a bundle of workscripts.
+   """
+   return checkout_workscript(environ, output, True)
+
+def return_workscript(environ, output):
+   """
+   Registers the exit code from a job that was previously
+   given a slice of work, or with parameter exitcodes=t:c,...
+   the exit codes c of several tasks t of a batch checkout.
+   """
+   pars = query_parameters(environ["QUERY_STRING"])
+   args = exit_arguments(pars, environ["REMOTE_ADDR"])
    with db_connection() as conn:
       with conn.cursor() as curr:
-         curr.execute("""SELECT id, ijob, iraw, block1, block2
-                         FROM slices
-                         WHERE ijob = %s;
-                      """, (ijob,))
-         row = curr.fetchone()
-         if row:
-            islice = int(row[0])
-            iraw = int(row[2])
-            block1 = int(row[3])
-            block2 = int(row[4])
-            lastblock = block2
-         else:
-            curr.execute("""SELECT id, ijob, iraw, block1, block2
-                            FROM slices
-                            WHERE ijob ISNULL
-                            ORDER BY id
-                            LIMIT 1
-                            FOR UPDATE SKIP LOCKED;
-                         """)
-            row = curr.fetchone()
-            if len(row) == 0:
-               output.append("echo No work left to do, quitting.")
-               return "200 OK"
-            islice = int(row[0])
-            iraw = int(row[2])
-            block1 = int(row[3])
-            block2 = int(row[4])
-            lastblock = block1 + maxblockspercore * cpus
-            lastblock = block2 if lastblock + 1 >= block2 else lastblock
-            curr.execute("""UPDATE slices SET 
-                            ijob = %s, block2 = %s
-                            WHERE id = %s;
-                         """, (ijob, lastblock, islice))
-            if lastblock < block2:
-               curr.execute("""INSERT INTO slices 
-                               (iraw, block1, block2)
-                               VALUES (%s, %s, %s);
-                            """, (iraw, lastblock, block2))
-         curr.execute("""SELECT path
-                         FROM rawdata
-                         WHERE id = %s;
-                      """, (iraw,))
-         row = curr.fetchone()
-         rawpath = row[0]
-
-   inpat = re.compile("#input_eviofile_list=\"root://xrootd.server.dns"
-                      + "/path/to/file.evio ...\"")
-   outpat = re.compile("#output_filename=\"file.evio\"")
-   for line in open(workscriptpath):
-      if re.match(r"^# project:", line):
-         line = "# project: {0}\n".format(project)
-      elif re.match(r"^# cluster:", line):
-         line = "# cluster: {0}\n".format(cluster)
-      elif re.match(r"^# process:", line):
-         line = "# process: {0}\n".format(process)
-      elif re.match(r"^# nstarts:", line):
-         line = "# nstarts: {0}\n".format(nstarts)
-      elif re.match(r"^# ncpus:", line):
-         line = "# ncpus: {0}\n".format(cpus)
-      elif re.match(r"^# source:", line):
-         line = "# source: {0}\n".format(workscript)
-      elif re.match(r"^# started:", line):
-         line = "# started: {0}\n".format(now)
-      output.append(line)
-      if inpat.match(line):
-         output.append("input_eviofile_list=\"\\\n")
-         for block in range(block1, lastblock):
-            blocksuffix = "+{0},{1}".format(block, block+1)
-            xrootdpath = re.sub(r"^/dcache", xrootdprefix, rawpath)
-            output.append(xrootdpath + blocksuffix + " \\\n")
-         output.append("\"\n")
-      elif outpat.match(line):
-         blocksuffix = "+{0},{1}".format(block1, lastblock)
-         outputfile = re.sub(r"^.*/([^/]*).evio", r"\1", rawpath)
-         outputfile += blocksuffix + ".evio"
-         output.append("output_filename=\"" + outputfile + "\"\n")
+         rows = run_query(curr, "exit", exit_query, args)
+   count_exits(args, rows)
+   output.append(exit_reply(rows))
    return "200 OK"
 
-def return_workscript(environ, output):
+def renew_lease(environ, output):
    """
-   Registers the exit code from a job that was previously
-   given a slice of work.
+   Extends the lease on the slices held by tasks (default 0) of a
+   job that is still running.
    """
    pars = query_parameters(environ["QUERY_STRING"])
-   client = environ["REMOTE_ADDR"]
-   cluster = pars["cluster"]
-   process = pars["process"]
-   project = pars["project"]
-   exitcode = pars["exitcode"]
+   with db_connection() as conn:
+      with conn.cursor() as curr:
+         rows = run_query(curr, "heartbeat", heartbeat_query,
+                          heartbeat_arguments(pars, environ["REMOTE_ADDR"]))
+   output.append(heartbeat_reply(rows))
+   return "200 OK"
 
+def reap_expired():
+   """
+   Returns the slices of jobs whose lease has expired to the pool of
+   unassigned slices, unless another dispatcher process is doing it at
+   the same time. Returns the number of slices released.
+   """
    with db_connection() as conn:
       with conn.cursor() as curr:
-         curr.execute("""SELECT jobs.id, jobs.worker, jobs.cluster,
-                                jobs.process, projects.projectname
-                         FROM jobs LEFT JOIN projects
-                         ON projects.id = jobs.project
-                         WHERE jobs.worker = %s
-                         AND jobs.cluster = %s
-                         AND jobs.process = %s
-                         AND projects.projectname = %s
-                         AND jobs.endtime ISNULL
-                         AND jobs.exitcode ISNULL;
-                      """, (client, cluster, process, project))
-         try:
-            row = curr.fetchone()
-            ijob = int(row[0])
-         except:
-            output.append("Never heard of you.")
-            return "200 OK"
-         curr.execute("SELECT TIMEZONE('GMT', NOW());")
-         now = curr.fetchone()[0]
-         curr.execute("""UPDATE jobs SET
-                         endtime = %s,
-                         exitcode = %s
-                         WHERE id = %s;
-                      """, (now, exitcode, ijob))
-   output.append("Got it.")
+         return run_query(curr, "reap", reap_query,
+                          (reap_lock_key, max_starts))[0][0]
+
+def fold_blockrates():
+   """
+   Adds the jobs that finished since the last call to the running
+   totals used to size new slices, unless another dispatcher process
+   is doing it at the same time.
+   """
+   with db_connection() as conn:
+      with conn.cursor() as curr:
+         return run_query(curr, "fold", fold_query, (fold_lock_key,))[0][0]
+
+def reaper_loop():
+   reaped = time.time()
+   while True:
+      try:
+         count_backlog()
+      except:
+         pass
+      time.sleep(min(backlog_interval, reap_interval))
+      if time.time() - reaped < reap_interval:
+         continue
+      reaped = time.time()
+      try:
+         reap_expired()
+      except:
+         pass
+      try:
+         fold_blockrates()
+      except:
+         pass
+
+def start_reaper():
+   """
+   Starts the background reaper thread of this process, once.
+   """
+   global reaper
+   with reaper_lock:
+      if reaper is None:
+         reaper = threading.Thread(target=reaper_loop, daemon=True)
+         reaper.start()
+
+def count_backlog():
+   """
+   Counts the unassigned slices and the blocks in them, and stores
+   the counts with their time in backlog for report_metrics.
+   """
+   global backlog
+   with db_connection() as conn:
+      with conn.cursor() as curr:
+         counts = run_query(curr, "backlog", backlog_query)[0]
+   backlog = (counts, time.time())
+
+def backlog_gauges(counts, counted):
+   return [("osgprod_backlog_slices", "gauge",
+            "Unassigned slices at the time of the last count.",
+            [((), counts[0])]),
+           ("osgprod_backlog_blocks", "gauge",
+            "Blocks in the unassigned slices at the time of the last count.",
+            [((), counts[1])]),
+           ("osgprod_backlog_age_seconds", "gauge",
+            "Seconds since the unassigned slices were last counted.",
+            [((), time.time() - counted)])]
+
+pool_gauges = [("checkouts", "counter", "Connections checked out of the pool."),
+               ("waits", "counter", "Checkouts that waited for a connection."),
+               ("wait_seconds", "counter", "Seconds spent waiting for a connection."),
+               ("connects", "counter", "Connections opened by the pool."),
+               ("reconnects", "counter", "Dead idle connections replaced."),
+               ("discards", "counter", "Broken connections closed."),
+               ("timeouts", "counter", "Checkouts that gave up waiting.")]
+
+def report_metrics(environ, output):
+   """
+   Returns the metrics of this dispatcher process in the Prometheus
+   text format, with the usage of its connection pool and the backlog
+   of unassigned slices.
+   """
+   metrics = osgprod_pool.shared_metrics()
+   gauges = [("osgprod_pool_connections", "gauge",
+              "Connections held by the pool, by state.",
+              [((("state", "in_use"),), metrics.get("in_use", 0)),
+               ((("state", "idle"),), metrics.get("idle", 0))]),
+             ("osgprod_pool_max_connections", "gauge",
+              "Largest number of connections the pool may open.",
+              [((), metrics.get("max_size", 0))])]
+   for key, kind, text in pool_gauges:
+      gauges.append(("osgprod_pool_" + key + "_total", kind, text,
+                     [((), metrics.get(key, 0))]))
+   if backlog[0] is not None:
+      gauges += backlog_gauges(*backlog)
+   output.append(osgprod_metrics.render(gauges))
    return "200 OK"
 
+def accepts_gzip(accept_encoding):
+   """
+   Returns True if the Accept-Encoding header accept_encoding lists
+   gzip, or any encoding, without q=0.
+   """
+   for coding in accept_encoding.lower().split(","):
+      name, _, params = coding.partition(";")
+      if name.strip() in ("gzip", "x-gzip", "*"):
+         try:
+            return float(params.strip().partition("q=")[2] or 1) > 0
+         except ValueError:
+            return False
+   return False
+
+def encode_reply(body, accept_encoding, if_none_match, cacheable):
+   """
+   Returns the body of a reply encoded for the client, and the headers
+   that describe it, as (not_modified, headers, body). The body is sent
+   with gzip if the client accepts it and it is at least gzip_min_length
+   bytes long. A cacheable body is tagged with an ETag of its content,
+   and if the tag is among those in the If-None-Match header
+   if_none_match, the reply is not_modified and its body is left empty.
+   Replies to requests that change the database are not cacheable, as
+   the change is already made by the time the reply is encoded, and
+   they are marked no-store so that no proxy answers them from a cache.
+   """
+   gzipped = len(body) >= gzip_min_length and accepts_gzip(accept_encoding)
+   headers = [("Vary", "Accept-Encoding")]
+   if not cacheable:
+      headers.append(("Cache-Control", "no-store"))
+   else:
+      etag = '"' + hashlib.sha1(body).hexdigest()[:24]
+      etag += '-gzip"' if gzipped else '"'
+      headers.append(("ETag", etag))
+   if cacheable and if_none_match:
+      tags = [tag.strip() for tag in if_none_match.split(",")]
+      tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+      if etag in tags or "*" in tags:
+         return True, headers, b""
+   if gzipped:
+      body = gzip.compress(body, gzip_level)
+      headers.append(("Content-Encoding", "gzip"))
+   return False, headers, body
+
+handlers = {"/workscript.bash": checkout_workscript,
+            "/workscript.batch": checkout_batch,
+            "/workscript.heartbeat": renew_lease,
+            "/workscript.exit": return_workscript}
+
 def application(environ, start_response):
    """
    Within the mod_wsgi, processing of the HTTP GET request 
@@ -257,35 +697,51 @@ def application(environ, start_response):
    the header that leads the output to be sent back to the
    client.
    """
+   if reaper is None:
+      start_reaper()
+   t0 = time.perf_counter()
    output = []
+   content_type = "text/plain"
+   path = environ.get("PATH_INFO", "")
    pars = query_parameters(environ["QUERY_STRING"])
-   if not "magic" in pars or pars["magic"] != magic_words:
+   if path == "/metrics":
+      status = report_metrics(environ, output)
+      content_type = "text/plain; version=0.0.4"
+   elif not "magic" in pars or pars["magic"] != magic_words:
       output = ["Be gone with your crazy magic!"]
       status = "200 OK"
-   elif "PATH_INFO" in environ and environ["PATH_INFO"]:
-      if environ["PATH_INFO"] == "/workscript.bash":
-         try:
-            status = checkout_workscript(environ, output)
-         except:
-            status = "400 Bad Request"
-            output = [""]
-      elif environ["PATH_INFO"] == "/workscript.exit":
-         try:
-            status = return_workscript(environ, output)
-         except:
-            status = "400 Bad Request"
-            output = [""]
-      else:
-         output = ["Be gone with your unknown path "]
-         status = "200 OK"
+   elif path in handlers:
+      try:
+         status = handlers[path](environ, output)
+      except:
+         status = "400 Bad Request"
+         output = [""]
+   elif path:
+      output = ["Be gone with your unknown path "]
+      status = "200 OK"
    else:
       output = ["Be gone with you."]
       status = "200 OK"
       for var in environ:
          output.append(var + ": " + str(environ[var]) + "\n")
 
-   output_len = sum([len(out) for out in output])
-   response_headers = [("Content-type", "text/plain"),
-                       ("Content-Length", str(output_len))]
+   body = "".join(output).encode("utf-8")
+   response_headers = [("Content-type", content_type)]
+   cacheable = path not in handlers
+   if status.startswith("200"):
+      not_modified, headers, body = encode_reply(body,
+                                       environ.get("HTTP_ACCEPT_ENCODING", ""),
+                                       environ.get("HTTP_IF_NONE_MATCH", ""),
+                                       cacheable)
+      if not_modified:
+         status = "304 Not Modified"
+      response_headers += headers
+   elif not cacheable:
+      response_headers.append(("Cache-Control", "no-store"))
+   response_headers.append(("Content-Length", str(len(body))))
    start_response(status, response_headers)
-   return output
+   if path not in handlers and path != "/metrics":
+      path = "other"
+   osgprod_metrics.observe_request(path, status.split()[0],
+                                   time.perf_counter() - t0)
+   return [body]